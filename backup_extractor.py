@@ -1,15 +1,30 @@
 import argparse
+import contextlib
+import logging
+import os
+import sys
 from argparse import RawTextHelpFormatter
 
 # locals
+import src.backup_archive
 import src.call_log_generator
+import src.call_log_sinks
 import src.mms_media_extractor
 import src.contacts_vcard_extractor
+import src.duplicate_finder
+import src.external_sort
+import src.extraction_stats
+import src.output_archive
+import src.output_layout
+import src.record_filter
+
+# Levels of --log-level, from the most to the least verbose
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
 
 if __name__ == "__main__":
 
     argparse_parser = argparse.ArgumentParser(
-        description="Extracts media files, call logs, or vcf/vCard media, from an SMS Backup & Restore backup archive.",
+        description="Extracts media files, call logs, or vcf/vCard media, from an SMS Backup & Restore backup archive, or removes duplicated media files.",
         formatter_class=RawTextHelpFormatter,
         epilog='''Examples:
   To extract all MMS media attachments:
@@ -18,21 +33,61 @@ if __name__ == "__main__":
   To extract only Video files:
      backup_extractor.py -t sms -i input_dir -o output_dir --no-images --no-audio --no-pdfs
 
+  To extract MMS media attachments from many backup files, using 4 processes:
+     backup_extractor.py -t sms -i input_dir -o output_dir --jobs 4
+
+  To extract MMS media attachments from one very large backup file, decoding on 4 threads while parsing:
+     backup_extractor.py -t sms -i input_dir -o output_dir --decode-threads 4
+
+  To extract MMS media attachments from a huge backup file without a full XML parse:
+     backup_extractor.py -t sms -i input_dir -o output_dir --engine scan
+
+  To extract MMS media attachments into one subdirectory per month:
+     backup_extractor.py -t sms -i input_dir -o output_dir --layout year-month
+
+  To extract MMS media attachments into a single zip file, or stream them as a tar file to another host:
+     backup_extractor.py -t sms -i input_dir -o media.zip --output-format zip
+     backup_extractor.py -t sms -i input_dir -o - --output-format tar | ssh backup-host "cat > media.tar"
+
+  To extract only the media one contact sent or received in 2023:
+     backup_extractor.py -t sms -i input_dir -o output_dir --address +18183457890 --since 2023-01-01 --until 2024-01-01
+
+  To add the media of new backups to a previous extraction:
+     backup_extractor.py -t sms -i input_dir -o output_dir --incremental
+
+  To follow the progress of a long extraction:
+     backup_extractor.py -t sms -i input_dir -o output_dir --progress
+
+  To record per-phase timings, throughput and peak memory of an extraction:
+     backup_extractor.py -t sms -i input_dir -o output_dir --stats stats.json
+
   To extract a de-duplicated call log:
      backup_extractor.py -t calls -i input_dir -o output_dir
 
+  To extract a de-duplicated call log as an SQLite database:
+     backup_extractor.py -t calls -i input_dir -o output_dir --call-log-format sqlite
+
+  To load all messages and calls into an SQLite archive, then extract media and calls from it:
+     backup_extractor.py -t archive -i input_dir -o archive_dir --archive-part-data
+     backup_extractor.py -t sms -i archive_dir -o output_dir --from-archive
+     backup_extractor.py -t calls -i archive_dir -o output_dir --from-archive
+
   To extract VCF/vCard media:
      backup_extractor.py -t vcf -i input_dir -o output_dir
+
+  To list, then remove, the duplicated files of an existing media folder:
+     backup_extractor.py -t dedup -i media_dir --dry-run
+     backup_extractor.py -t dedup -i media_dir
  
 '''
     )
 
     argparse_parser.add_argument("-i", "--input-dir", type=str, required=True,
-                                 help="The directory where XML files (for calls or messages) are located")
+                                 help="The directory where XML files (for calls or messages) are located (with '-t dedup', the media directory to remove duplicates from)")
     argparse_parser.add_argument("-t", "--backup-type", type=str, required=True,
-                                 help="The type of extraction. Either 'sms' for message media files, or 'calls' to create a call log, or 'vcf' to extract media from a VCF/vCard file")
-    argparse_parser.add_argument("-o", "--output-dir", type=str, required=True,
-                                 help="The directory where media files that are found, will be extracted to")
+                                 help="The type of extraction. Either 'sms' for message media files, or 'calls' to create a call log, or 'vcf' to extract media from a VCF/vCard file, or 'archive' to load messages and calls into an SQLite archive, or 'dedup' to remove duplicated files from a media directory")
+    argparse_parser.add_argument("-o", "--output-dir", type=str,
+                                 help="The directory where media files that are found, will be extracted to (with --output-format tar or zip, the archive file to create, or '-' for stdout)")
 
     argparse_parser.add_argument("--no-images", action='store_false',
                                  help="Don't extract image files from messages")
@@ -42,18 +97,145 @@ if __name__ == "__main__":
                                  help="Don't extract audio files from messages")
     argparse_parser.add_argument("--no-pdfs", action='store_false',
                                  help="Don't extract PDF files from messages")
+    argparse_parser.add_argument("-j", "--jobs", type=int, default=1,
+                                 help="The number of backup files to extract media from, or to read calls from, in parallel (default: 1)")
+    argparse_parser.add_argument("--decode-threads", type=int, default=0,
+                                 help="The number of threads decoding and writing attachments while a backup file is being parsed (default: 0, decode in the parsing thread)")
+    argparse_parser.add_argument("--engine", type=str, choices=src.mms_media_extractor.PARSE_ENGINES,
+                                 default=src.mms_media_extractor.DEFAULT_PARSE_ENGINE,
+                                 help="How SMS backup files are parsed: 'lxml' (an XML parser), or 'scan' (finds the attachments straight in the bytes of the memory-mapped file, handing messages it can't handle to lxml) (default: lxml)")
+    argparse_parser.add_argument("--fast-scan", action='store_true',
+                                 help="Only parse the MMS messages of SMS backup files, skipping over plain text messages")
+    argparse_parser.add_argument("--build-index", action='store_true',
+                                 help="Build (or refresh) a sidecar index next to each backup file, so this and later runs can seek straight to the records they need")
+    argparse_parser.add_argument("--incremental", action='store_true',
+                                 help="Allow a non-empty OUTPUT_DIR, and only extract media that previous runs into it haven't extracted yet")
+    argparse_parser.add_argument("--layout", type=str, choices=src.output_layout.OUTPUT_LAYOUTS,
+                                 default=src.output_layout.DEFAULT_OUTPUT_LAYOUT,
+                                 help="How extracted media is spread over subdirectories of OUTPUT_DIR: 'flat' (no subdirectories), 'year-month', 'sender', or 'hash-prefix' (default: flat)")
+    argparse_parser.add_argument("--blob-store", type=str, choices=src.output_layout.BLOB_LINK_MODES,
+                                 help="Store each unique attachment once under its content hash (in OUTPUT_DIR/.blobs), and create every attachment's filename as a 'hardlink' or 'symlink' to it")
+
+    argparse_parser.add_argument("--output-format", type=str, choices=src.output_archive.OUTPUT_FORMATS,
+                                 default=src.output_archive.DEFAULT_OUTPUT_FORMAT,
+                                 help="How extracted media is written: 'dir' (files in OUTPUT_DIR), or 'tar' or 'zip' (entries of the single archive file OUTPUT_DIR, streamed without creating a file per attachment) (default: dir)")
+
+    argparse_parser.add_argument("--since", type=src.record_filter.parse_date, metavar="DATE",
+                                 help="Only extract media from messages, or log calls, from this local date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM) on")
+    argparse_parser.add_argument("--until", type=src.record_filter.parse_date, metavar="DATE",
+                                 help="Only extract media from messages, or log calls, before this local date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM)")
+    argparse_parser.add_argument("--address", type=str, action='append', metavar="NUMBER",
+                                 help="Only extract media from messages, or log calls, to or from this phone number (or address). Can be given more than once.")
+    argparse_parser.add_argument("--max-size", type=src.record_filter.parse_size, metavar="SIZE",
+                                 help="Only extract attachments of at most this size, in bytes or with a K, M or G unit (e.g. 10M)")
+    argparse_parser.add_argument("--call-log-format", type=str, choices=src.call_log_generator.CALL_LOG_FORMATS,
+                                 default=src.call_log_generator.DEFAULT_CALL_LOG_FORMAT,
+                                 help="The format of the call log written to OUTPUT_DIR: 'csv', 'jsonl' (JSON Lines), 'sqlite' (indexed on date and number) or 'parquet' (needs pyarrow) (default: csv)")
+    argparse_parser.add_argument("--max-calls-in-memory", type=int, default=src.external_sort.DEFAULT_MAX_RECORDS_IN_MEMORY,
+                                 help=f"The number of calls sorted in memory before they are spilled to a temporary file, bounding the memory used for huge call logs (at least {src.external_sort.MIN_RECORDS_IN_MEMORY}, default: {src.external_sort.DEFAULT_MAX_RECORDS_IN_MEMORY})")
+    argparse_parser.add_argument("--archive-part-data", action='store_true',
+                                 help="With '-t archive', also store the (base64) data of MMS attachments in the archive, so media can be extracted from it")
+    argparse_parser.add_argument("--from-archive", action='store_true',
+                                 help=f"With '-t sms' or '-t calls', read from the archive INPUT_DIR/{src.backup_archive.ARCHIVE_FILENAME} instead of the XML backup files")
+    argparse_parser.add_argument("--dry-run", action='store_true',
+                                 help="With '-t dedup', only list the duplicated (or empty) files, without removing them")
+    argparse_parser.add_argument("--no-hash-cache", action='store_true',
+                                 help=f"With '-t dedup', don't read or update the hash cache INPUT_DIR/{src.duplicate_finder.HASH_CACHE_FILENAME}, which saves later runs from hashing unchanged files again")
+    argparse_parser.add_argument("--log-level", type=str.upper, choices=LOG_LEVELS, default="WARNING",
+                                 help="The lowest level of the log messages shown on stderr, e.g. DEBUG to follow the parsing of every file (and vCard line) (default: WARNING)")
+    argparse_parser.add_argument("--progress", action='store_true',
+                                 help="Show the progress through the input files (percentage, throughput, items found and ETA) on stderr")
+    argparse_parser.add_argument("--stats", type=str, metavar="STATS_FILE",
+                                 help="Write per-phase timings, throughput, counts and peak memory of the run to this JSON file")
+    argparse_parser.add_argument("--profile", type=str, metavar="PROFILE_FILE",
+                                 help="Run under cProfile, writing the profile to this file (readable with pstats). Worker processes aren't profiled.")
+    argparse_parser.add_argument("--trace-memory", action='store_true',
+                                 help="Trace memory allocations with tracemalloc, adding the top allocation sites to the --stats file")
 
     argparse_args = argparse_parser.parse_args()
 
-    if (argparse_args.backup_type == "sms"):
-        src.mms_media_extractor.reconstruct_mms_media(
-            argparse_args.input_dir, argparse_args.output_dir,
-            argparse_args.no_images, argparse_args.no_videos,
-            argparse_args.no_audio, argparse_args.no_pdfs)
+    logging.basicConfig(level=argparse_args.log_level, format="[%(levelname)s] %(message)s")
+
+    if argparse_args.call_log_format == "parquet" and not src.call_log_sinks.PARQUET_AVAILABLE:
+        argparse_parser.error("--call-log-format parquet needs pyarrow to be installed (pip install pyarrow)")
+
+    if argparse_args.output_dir is None and argparse_args.backup_type != "dedup":
+        argparse_parser.error("the following arguments are required: -o/--output-dir")
+
+    if (argparse_args.dry_run or argparse_args.no_hash_cache) and argparse_args.backup_type != "dedup":
+        argparse_parser.error("--dry-run and --no-hash-cache only work with '-t dedup'")
+
+    if argparse_args.max_calls_in_memory < src.external_sort.MIN_RECORDS_IN_MEMORY:
+        argparse_parser.error(f"--max-calls-in-memory must be at least {src.external_sort.MIN_RECORDS_IN_MEMORY}")
+
+    if argparse_args.trace_memory and not argparse_args.stats:
+        argparse_parser.error("--trace-memory requires --stats")
+
+    if argparse_args.from_archive:
+        if argparse_args.backup_type not in ("sms", "calls"):
+            argparse_parser.error("--from-archive only works with '-t sms' and '-t calls'")
+        if not os.path.isfile(src.backup_archive.get_archive_path(argparse_args.input_dir)):
+            argparse_parser.error(f"There is no {src.backup_archive.ARCHIVE_FILENAME} in {argparse_args.input_dir}, create one with '-t archive' first")
+
+    is_archive_output = src.output_archive.is_archive_output(argparse_args.output_format)
+    if is_archive_output:
+        if argparse_args.backup_type != "sms":
+            argparse_parser.error("--output-format tar and zip only work with '-t sms'")
+        if argparse_args.jobs > 1 or argparse_args.incremental or argparse_args.blob_store:
+            argparse_parser.error("--output-format tar and zip can't be combined with --jobs, --incremental or --blob-store")
+    elif argparse_args.output_dir == src.output_archive.STDOUT_PATH:
+        argparse_parser.error("OUTPUT_DIR can only be '-' (stdout) with --output-format tar or zip")
+
+    record_filter = src.record_filter.RecordFilter(argparse_args.since, argparse_args.until, argparse_args.address,
+                                                   argparse_args.max_size)
+    if record_filter.is_selecting_everything():
+        record_filter = None
+    elif argparse_args.backup_type not in ("sms", "calls"):
+        argparse_parser.error("--since, --until, --address and --max-size only work with '-t sms' and '-t calls'")
+    elif argparse_args.max_size is not None and argparse_args.backup_type != "sms":
+        argparse_parser.error("--max-size only works with '-t sms'")
+
+    stats = src.extraction_stats.ExtractionStats(argparse_args.backup_type)
+
+    # With the archive going to stdout, everything else that would be printed goes to stderr
+    writes_archive_to_stdout = is_archive_output and argparse_args.output_dir == src.output_archive.STDOUT_PATH
+
+    with src.extraction_stats.profiling(stats, argparse_args.profile, argparse_args.trace_memory), \
+            (contextlib.redirect_stdout(sys.stderr) if writes_archive_to_stdout else contextlib.nullcontext()):
+        if (argparse_args.backup_type == "sms"):
+            src.mms_media_extractor.reconstruct_mms_media(
+                argparse_args.input_dir, argparse_args.output_dir,
+                argparse_args.no_images, argparse_args.no_videos,
+                argparse_args.no_audio, argparse_args.no_pdfs,
+                jobs=argparse_args.jobs, decode_threads=argparse_args.decode_threads,
+                fast_scan=argparse_args.fast_scan, build_index=argparse_args.build_index,
+                incremental=argparse_args.incremental, layout=argparse_args.layout,
+                blob_link_mode=argparse_args.blob_store, stats=stats, show_progress=argparse_args.progress,
+                from_archive=argparse_args.from_archive, record_filter=record_filter,
+                engine=argparse_args.engine, output_format=argparse_args.output_format)
+
+        elif (argparse_args.backup_type == "calls"):
+            src.call_log_generator.create_call_log(argparse_args.input_dir, argparse_args.output_dir,
+                                                   build_index=argparse_args.build_index,
+                                                   stats=stats, show_progress=argparse_args.progress,
+                                                   max_calls_in_memory=argparse_args.max_calls_in_memory,
+                                                   jobs=argparse_args.jobs,
+                                                   call_log_format=argparse_args.call_log_format,
+                                                   from_archive=argparse_args.from_archive,
+                                                   record_filter=record_filter)
+
+        elif (argparse_args.backup_type == "vcf"):
+            src.contacts_vcard_extractor.parse_contacts_from_vcf_files(
+                argparse_args.input_dir, argparse_args.output_dir, stats=stats, show_progress=argparse_args.progress)
+
+        elif (argparse_args.backup_type == "archive"):
+            src.backup_archive.create_backup_archive(
+                argparse_args.input_dir, argparse_args.output_dir, store_part_data=argparse_args.archive_part_data,
+                stats=stats, show_progress=argparse_args.progress)
 
-    elif (argparse_args.backup_type == "calls"):
-        src.call_log_generator.create_call_log(argparse_args.input_dir)
+        elif (argparse_args.backup_type == "dedup"):
+            src.duplicate_finder.remove_duplicate_files(argparse_args.input_dir, dry_run=argparse_args.dry_run,
+                                                        use_cache=not argparse_args.no_hash_cache, stats=stats)
 
-    elif (argparse_args.backup_type == "vcf"):
-        src.contacts_vcard_extractor.parse_contacts_from_vcf_files(
-            argparse_args.input_dir, argparse_args.output_dir)
+    if argparse_args.stats:
+        stats.write_json(argparse_args.stats)
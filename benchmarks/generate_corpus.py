@@ -0,0 +1,290 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import xml.sax.saxutils
+
+# Where each kind of backup is written, relative to the corpus directory. The extractors expect each kind
+# in its own input directory.
+SMS_SUBDIR, CALLS_SUBDIR, VCF_SUBDIR = "sms", "calls", "vcf"
+CORPUS_INFO_FILENAME = "corpus.json"
+
+DEFAULT_MIME_MIX = "image/jpeg=0.55,image/png=0.15,image/gif=0.1,video/mp4=0.1,audio/amr=0.05,application/pdf=0.05"
+
+FIRST_MESSAGE_DATE_MS = 1420070400000  # 2015-01-01
+ONE_YEAR_MS = 365 * 24 * 60 * 60 * 1000
+
+# How many earlier attachments duplicates are picked from, this bounds the generator's memory use
+PAYLOAD_POOL_SIZE = 256
+
+# The vCard standard folds lines longer than this
+VCARD_LINE_LENGTH = 75
+
+WORDS = ["hey", "ok", "see", "you", "at", "the", "store", "later", "call", "me", "when", "home", "dinner",
+         "tonight", "love", "thanks", "on", "my", "way", "running", "late", "sounds", "good", "what", "time"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie", "Avery", "Quinn"]
+LAST_NAMES = ["Smith", "Garcia", "Nguyen", "Okafor", "Kowalski", "Haddad", "Tanaka", "Silva", "Novak", "Byrne"]
+
+
+def parse_mime_mix(mime_mix: str) -> tuple:
+    """
+    Turns "image/jpeg=0.6,video/mp4=0.4" into (["image/jpeg", "video/mp4"], [0.6, 0.4])
+    """
+    mime_types, weights = [], []
+    for mime_and_weight in mime_mix.split(","):
+        mime_type, _, weight = mime_and_weight.partition("=")
+        mime_types.append(mime_type.strip())
+        weights.append(float(weight) if weight else 1.0)
+
+    return mime_types, weights
+
+
+def get_readable_date(epoch_ms: int) -> str:
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000).strftime("%b %d, %Y %I:%M:%S %p")
+
+
+def make_attributes(attributes: dict) -> str:
+    return " ".join(f"{name}={xml.sax.saxutils.quoteattr(str(value))}" for name, value in attributes.items())
+
+
+class CorpusGenerator:
+    """
+    Generates SMS Backup & Restore style backups. Everything is derived from the seed, so the same arguments
+    always produce the same corpus, which keeps benchmark results comparable across commits.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.mime_types, self.mime_weights = parse_mime_mix(args.mime_mix)
+        self.phone_numbers = [f"+1{self.rng.randint(2000000000, 9999999999)}" for _ in range(args.num_contacts)]
+        self.contact_names = [f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}"
+                              for _ in range(args.num_contacts)]
+        # Attachments already generated, that duplicates (e.g. forwarded memes) are picked from
+        self.payload_pool = []
+        self.info = {"seed": args.seed, "sms": 0, "mms": 0, "attachments": 0, "attachment_bytes": 0,
+                     "duplicate_attachments": 0, "calls": 0, "contacts": 0, "contact_photos": 0}
+
+    def random_date(self) -> int:
+        return FIRST_MESSAGE_DATE_MS + self.rng.randrange(self.args.years * ONE_YEAR_MS)
+
+    def random_text(self, min_words: int, max_words: int) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(min_words, max_words)))
+
+    def random_attachment_size(self) -> int:
+        # Log-normal, like real media: mostly small pictures, with a long tail of large videos
+        size = int(self.rng.lognormvariate(0, self.args.attachment_size_sigma) * self.args.attachment_median_bytes)
+        return max(1, min(size, self.args.attachment_max_bytes))
+
+    def random_payload(self) -> bytes:
+        if self.payload_pool and self.rng.random() < self.args.duplicate_ratio:
+            self.info["duplicate_attachments"] += 1
+            return self.rng.choice(self.payload_pool)
+
+        payload = self.rng.randbytes(self.random_attachment_size())
+        if len(self.payload_pool) < PAYLOAD_POOL_SIZE:
+            self.payload_pool.append(payload)
+        else:
+            self.payload_pool[self.rng.randrange(PAYLOAD_POOL_SIZE)] = payload
+        return payload
+
+    def write_sms(self, xml_file, contact_idx: int) -> None:
+        message_date = self.random_date()
+        xml_file.write("  <sms " + make_attributes({
+            "protocol": 0, "address": self.phone_numbers[contact_idx], "date": message_date,
+            "type": self.rng.choice((1, 2)), "subject": "null", "body": self.random_text(1, 30), "toa": "null",
+            "sc_toa": "null", "service_center": "null", "read": 1, "status": -1, "locked": 0,
+            "date_sent": message_date - self.rng.randint(0, 5000), "sub_id": 1,
+            "readable_date": get_readable_date(message_date), "contact_name": self.contact_names[contact_idx],
+        }) + " />\n")
+        self.info["sms"] += 1
+
+    def write_mms(self, xml_file, contact_idx: int) -> None:
+        message_date = self.random_date()
+        address = self.phone_numbers[contact_idx]
+        xml_file.write("  <mms " + make_attributes({
+            "date": message_date, "rr": "null", "sub": "null", "ct_t": "application/vnd.wap.multipart.related",
+            "read_status": "null", "seen": 1, "msg_box": self.rng.choice((1, 2)), "address": address,
+            "sub_cs": "null", "resp_st": "null", "retr_st": "null", "d_tm": "null", "text_only": 0, "exp": "null",
+            "locked": 0, "m_id": f"mms{self.info['mms']}", "st": "null", "retr_txt_cs": "null", "retr_txt": "null",
+            "creator": "com.google.android.apps.messaging", "date_sent": 0, "read": 1, "m_size": "null",
+            "rpt_a": "null", "ct_cls": "null", "pri": "null", "sub_id": 1, "tr_id": "null", "resp_txt": "null",
+            "ct_l": "null", "m_cls": "personal", "d_rpt": "null", "v": 18, "_id": self.info["mms"], "m_type": 132,
+            "readable_date": get_readable_date(message_date), "contact_name": self.contact_names[contact_idx],
+        }) + ">\n    <parts>\n")
+
+        xml_file.write("      <part " + make_attributes({
+            "seq": -1, "ct": "application/smil", "name": "null", "chset": "null", "cd": "null", "fn": "null",
+            "cid": "<smil>", "cl": "smil.xml", "ctt_s": "null", "ctt_t": "null",
+            "text": '<smil><body><par dur="5000ms"><img src="image000000.jpg" /></par></body></smil>',
+        }) + " />\n")
+
+        for part_seq in range(self.rng.randint(1, self.args.max_attachments_per_mms)):
+            mime_type = self.rng.choices(self.mime_types, self.mime_weights)[0]
+            payload = self.random_payload()
+            extension = mime_type.partition("/")[2]
+            xml_file.write("      <part " + make_attributes({
+                "seq": part_seq, "ct": mime_type, "name": "null", "chset": "null", "cd": "null", "fn": "null",
+                "cid": f"<part{part_seq}>",
+                # Some phones don't record a filename for attachments
+                "cl": f"{mime_type.partition('/')[0]}{part_seq:06d}.{extension}" if self.rng.random() < 0.8 else "null",
+                "ctt_s": "null", "ctt_t": "null", "text": "null",
+                "data": base64.b64encode(payload).decode("ascii"),
+            }) + " />\n")
+            self.info["attachments"] += 1
+            self.info["attachment_bytes"] += len(payload)
+
+        if self.rng.random() < 0.3:
+            xml_file.write("      <part " + make_attributes({
+                "seq": 0, "ct": "text/plain", "name": "null", "chset": 106, "cd": "null", "fn": "null",
+                "cid": "<text>", "cl": "text000000.txt", "ctt_s": "null", "ctt_t": "null",
+                "text": self.random_text(1, 15),
+            }) + " />\n")
+
+        xml_file.write("    </parts>\n    <addrs>\n")
+        xml_file.write("      <addr " + make_attributes({"address": address, "type": 137, "charset": 106}) + " />\n")
+        xml_file.write("      <addr " + make_attributes({"address": "insert-address-token", "type": 151,
+                                                          "charset": 106}) + " />\n")
+        xml_file.write("    </addrs>\n  </mms>\n")
+        self.info["mms"] += 1
+
+    def write_sms_backups(self, output_dir: str) -> None:
+        messages_per_file = (self.args.num_sms + self.args.num_mms) // self.args.num_files + 1
+        mms_probability = self.args.num_mms / max(1, self.args.num_sms + self.args.num_mms)
+        remaining_sms, remaining_mms = self.args.num_sms, self.args.num_mms
+
+        for file_idx in range(self.args.num_files):
+            file_path = os.path.join(output_dir, f"sms-{20240101000000 + file_idx}.xml")
+            with open(file_path, "w", encoding="utf-8") as xml_file:
+                xml_file.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
+                xml_file.write(f'<smses count="{messages_per_file}" backup_set="benchmark" backup_date="0" type="full">\n')
+
+                for _ in range(messages_per_file):
+                    if remaining_sms + remaining_mms == 0:
+                        break
+
+                    contact_idx = self.rng.randrange(self.args.num_contacts)
+                    if remaining_mms and (not remaining_sms or self.rng.random() < mms_probability):
+                        self.write_mms(xml_file, contact_idx)
+                        remaining_mms -= 1
+                    else:
+                        self.write_sms(xml_file, contact_idx)
+                        remaining_sms -= 1
+
+                xml_file.write("</smses>\n")
+
+    def write_calls_backups(self, output_dir: str) -> None:
+        calls_per_file = self.args.num_calls // self.args.num_files + 1
+        all_call_dates = [self.random_date() for _ in range(self.args.num_calls)]
+
+        for file_idx in range(self.args.num_files):
+            file_path = os.path.join(output_dir, f"calls-{20240101000000 + file_idx}.xml")
+            file_call_dates = all_call_dates[file_idx * calls_per_file:(file_idx + 1) * calls_per_file]
+            # Backups overlap, each one repeats some of the calls that were in the previous one
+            if file_idx > 0:
+                previous_file_dates = all_call_dates[(file_idx - 1) * calls_per_file:file_idx * calls_per_file]
+                file_call_dates += previous_file_dates[:int(len(previous_file_dates) * self.args.duplicate_ratio)]
+
+            with open(file_path, "w", encoding="utf-8") as xml_file:
+                xml_file.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
+                xml_file.write(f'<calls count="{len(file_call_dates)}" backup_set="benchmark" backup_date="0" type="full">\n')
+
+                for call_date in file_call_dates:
+                    # Seeded by the date, so a call repeated in several backups is identical in all of them
+                    call_rng = random.Random(call_date)
+                    contact_idx = call_rng.randrange(self.args.num_contacts)
+                    call_type = call_rng.choice((1, 1, 2, 2, 3, 5))
+                    xml_file.write("  <call " + make_attributes({
+                        "number": self.phone_numbers[contact_idx],
+                        "duration": 0 if call_type == 3 else call_rng.randint(0, 3600), "date": call_date,
+                        "type": call_type, "presentation": 1, "subscription_id": 1, "post_dial_digits": "",
+                        "subscription_component_name": "com.android.phone/com.android.services.telephony.TelephonyConnectionService",
+                        "readable_date": get_readable_date(call_date),
+                        "contact_name": self.contact_names[contact_idx] if call_rng.random() < 0.8 else "(Unknown)",
+                    }) + " />\n")
+
+                xml_file.write("</calls>\n")
+
+        self.info["calls"] = self.args.num_calls
+
+    def write_vcf_backup(self, output_dir: str) -> None:
+        with open(os.path.join(output_dir, "contacts.vcf"), "w", encoding="utf-8") as vcf_file:
+            for contact_idx in range(self.args.num_contacts):
+                family_name, _, given_name = self.contact_names[contact_idx].partition(" ")[::-1]
+                vcf_file.write("BEGIN:VCARD\n")
+                vcf_file.write("VERSION:2.1\n")
+                vcf_file.write(f"N:{family_name};{given_name}{contact_idx};;;\n")
+                vcf_file.write(f"FN:{given_name}{contact_idx} {family_name}\n")
+                vcf_file.write(f"TEL;TYPE=CELL:{self.phone_numbers[contact_idx]}\n")
+                vcf_file.write(f"EMAIL;TYPE=HOME:{given_name.lower()}{contact_idx}@example.com\n")
+
+                if self.rng.random() < self.args.contact_photo_ratio:
+                    photo = base64.b64encode(self.random_payload()).decode("ascii")
+                    photo_line = f"PHOTO;ENCODING=BASE64;JPEG:{photo}"
+                    vcf_file.write(photo_line[:VCARD_LINE_LENGTH] + "\n")
+                    for offset in range(VCARD_LINE_LENGTH, len(photo_line), VCARD_LINE_LENGTH - 1):
+                        vcf_file.write(" " + photo_line[offset:offset + VCARD_LINE_LENGTH - 1] + "\n")
+                    # vCard 2.1 ends base64 data with an empty line
+                    vcf_file.write("\n")
+                    self.info["contact_photos"] += 1
+
+                vcf_file.write("END:VCARD\n")
+
+        self.info["contacts"] = self.args.num_contacts
+
+    def generate(self, corpus_dir: str) -> dict:
+        for subdir in (SMS_SUBDIR, CALLS_SUBDIR, VCF_SUBDIR):
+            os.makedirs(os.path.join(corpus_dir, subdir), exist_ok=False)
+
+        self.write_sms_backups(os.path.join(corpus_dir, SMS_SUBDIR))
+        self.write_calls_backups(os.path.join(corpus_dir, CALLS_SUBDIR))
+        self.write_vcf_backup(os.path.join(corpus_dir, VCF_SUBDIR))
+
+        with open(os.path.join(corpus_dir, CORPUS_INFO_FILENAME), "w") as info_file:
+            json.dump(self.info, info_file, indent=2)
+
+        return self.info
+
+
+if __name__ == "__main__":
+
+    argparse_parser = argparse.ArgumentParser(
+        description="Generates a synthetic SMS Backup & Restore corpus (messages, calls and contacts) for benchmarking.")
+
+    argparse_parser.add_argument("-o", "--output-dir", type=str, required=True,
+                                 help="The directory the corpus is created in, it must not exist yet")
+    argparse_parser.add_argument("--seed", type=int, default=0,
+                                 help="Seed for the random generator, the same seed always produces the same corpus (default: 0)")
+    argparse_parser.add_argument("--num-files", type=int, default=2,
+                                 help="The number of sms-*.xml and calls-*.xml files to spread the records over (default: 2)")
+    argparse_parser.add_argument("--num-sms", type=int, default=20000,
+                                 help="The number of plain text messages (default: 20000)")
+    argparse_parser.add_argument("--num-mms", type=int, default=1000,
+                                 help="The number of multimedia messages (default: 1000)")
+    argparse_parser.add_argument("--num-calls", type=int, default=20000,
+                                 help="The number of distinct calls (default: 20000)")
+    argparse_parser.add_argument("--num-contacts", type=int, default=500,
+                                 help="The number of contacts, messages and calls are spread over them (default: 500)")
+    argparse_parser.add_argument("--years", type=int, default=5,
+                                 help="The number of years the messages and calls are spread over (default: 5)")
+    argparse_parser.add_argument("--max-attachments-per-mms", type=int, default=3,
+                                 help="Each MMS gets between 1 and this many attachments (default: 3)")
+    argparse_parser.add_argument("--attachment-median-bytes", type=int, default=100 * 1024,
+                                 help="Median attachment size (default: 102400)")
+    argparse_parser.add_argument("--attachment-size-sigma", type=float, default=1.0,
+                                 help="Spread of the (log-normal) attachment sizes (default: 1.0)")
+    argparse_parser.add_argument("--attachment-max-bytes", type=int, default=50 * 1024 * 1024,
+                                 help="Largest attachment size (default: 52428800)")
+    argparse_parser.add_argument("--mime-mix", type=str, default=DEFAULT_MIME_MIX,
+                                 help=f"Attachment MIME types and their weights (default: {DEFAULT_MIME_MIX})")
+    argparse_parser.add_argument("--duplicate-ratio", type=float, default=0.3,
+                                 help="Share of attachments that repeat an earlier one, and of calls repeated in the next calls backup (default: 0.3)")
+    argparse_parser.add_argument("--contact-photo-ratio", type=float, default=0.3,
+                                 help="Share of contacts that have a photo (default: 0.3)")
+
+    argparse_args = argparse_parser.parse_args()
+
+    corpus_info = CorpusGenerator(argparse_args).generate(argparse_args.output_dir)
+    print(json.dumps(corpus_info, indent=2))
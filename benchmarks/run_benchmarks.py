@@ -0,0 +1,197 @@
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# locals
+import src.call_log_generator
+import src.contacts_vcard_extractor
+import src.mms_media_extractor
+from src.extraction_stats import get_peak_rss_mb
+from generate_corpus import SMS_SUBDIR, CALLS_SUBDIR, VCF_SUBDIR, CORPUS_INFO_FILENAME
+
+# A result is reported as a regression when it is this much slower (or bigger) than the one compared against
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+
+def run_sms(input_dir: str, work_dir: str, **kwargs) -> None:
+    src.mms_media_extractor.reconstruct_mms_media(input_dir, os.path.join(work_dir, "media"),
+                                                  True, True, True, True, **kwargs)
+
+
+def run_calls(input_dir: str, work_dir: str, **kwargs) -> None:
+    src.call_log_generator.create_call_log(input_dir, work_dir, **kwargs)
+
+
+def run_vcf(input_dir: str, work_dir: str, **kwargs) -> None:
+    output_dir = os.path.join(work_dir, "media")
+    os.makedirs(output_dir)
+    src.contacts_vcard_extractor.parse_contacts_from_vcf_files(input_dir, output_dir, **kwargs)
+
+
+# name: (corpus subdirectory, function, keyword arguments, corpus.json counts making up the number of records)
+BENCHMARKS = {
+    "sms": (SMS_SUBDIR, run_sms, {}, ["sms", "mms"]),
+    "sms-fast-scan": (SMS_SUBDIR, run_sms, {"fast_scan": True}, ["sms", "mms"]),
+    "sms-scan-engine": (SMS_SUBDIR, run_sms, {"engine": "scan"}, ["sms", "mms"]),
+    "sms-jobs": (SMS_SUBDIR, run_sms, {"jobs": os.cpu_count()}, ["sms", "mms"]),
+    "sms-decode-threads": (SMS_SUBDIR, run_sms, {"decode_threads": 4}, ["sms", "mms"]),
+    "sms-tar-output": (SMS_SUBDIR, run_sms, {"output_format": "tar"}, ["sms", "mms"]),
+    "calls": (CALLS_SUBDIR, run_calls, {}, ["calls"]),
+    "calls-sqlite": (CALLS_SUBDIR, run_calls, {"call_log_format": "sqlite"}, ["calls"]),
+    "vcf": (VCF_SUBDIR, run_vcf, {}, ["contacts"]),
+}
+
+
+def run_benchmark_once(benchmark_name: str, corpus_dir: str, work_dir: str) -> dict:
+    """
+    Runs one benchmark. Called in a fresh process, so the peak memory measured belongs to this benchmark alone.
+    """
+    subdir, benchmark_function, kwargs, _ = BENCHMARKS[benchmark_name]
+
+    error = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        try:
+            benchmark_function(os.path.join(corpus_dir, subdir), work_dir, **kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed_s = time.perf_counter() - start_time
+
+    return {"seconds": elapsed_s, "peak_rss_mb": get_peak_rss_mb(), "error": error}
+
+
+def get_input_bytes(input_dir: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(input_dir) if entry.is_file())
+
+
+def run_benchmark(benchmark_name: str, corpus_dir: str, corpus_info: dict, repeat: int, work_root: str) -> dict:
+    subdir, _, _, record_count_keys = BENCHMARKS[benchmark_name]
+    input_bytes = get_input_bytes(os.path.join(corpus_dir, subdir))
+    num_records = sum(corpus_info.get(key, 0) for key in record_count_keys)
+
+    runs = []
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix=f"{benchmark_name}-", dir=work_root)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                runs.append(executor.submit(run_benchmark_once, benchmark_name, os.path.abspath(corpus_dir),
+                                            work_dir).result())
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # The fastest run is the one least disturbed by whatever else the machine was doing
+    best_seconds = min(run["seconds"] for run in runs)
+    peak_rss_values = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+
+    return {
+        "seconds": round(best_seconds, 4),
+        "all_seconds": [round(run["seconds"], 4) for run in runs],
+        "input_mb": round(input_bytes / (1024 * 1024), 2),
+        "mb_per_s": round(input_bytes / (1024 * 1024) / best_seconds, 2) if best_seconds else None,
+        "records_per_s": round(num_records / best_seconds) if best_seconds else None,
+        "peak_rss_mb": max(peak_rss_values) if peak_rss_values else None,
+        "error": next((run["error"] for run in runs if run["error"]), None),
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: dict, previous_results: dict, threshold: float) -> list:
+    """
+    Prints how each benchmark changed compared to a previous results file, returning the regressions found
+    """
+    regressions = []
+    for benchmark_name, result in results["benchmarks"].items():
+        previous_result = previous_results["benchmarks"].get(benchmark_name)
+        if previous_result is None:
+            continue
+
+        for metric in ("seconds", "peak_rss_mb"):
+            if not result.get(metric) or not previous_result.get(metric):
+                continue
+
+            change = (result[metric] - previous_result[metric]) / previous_result[metric]
+            is_regression = change > threshold
+            print(f"  {benchmark_name:<20} {metric:<12} {previous_result[metric]:>10} -> {result[metric]:>10} "
+                  f"({change:+.1%}){'  REGRESSION' if is_regression else ''}")
+            if is_regression:
+                regressions.append((benchmark_name, metric, change))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    argparse_parser = argparse.ArgumentParser(
+        description="Times the extractors against a corpus created by generate_corpus.py, reporting throughput and peak memory.")
+
+    argparse_parser.add_argument("-c", "--corpus-dir", type=str, required=True,
+                                 help="The corpus directory, as created by generate_corpus.py")
+    argparse_parser.add_argument("-b", "--benchmarks", type=str, nargs="+", choices=list(BENCHMARKS),
+                                 default=list(BENCHMARKS), help="The benchmarks to run (default: all of them)")
+    argparse_parser.add_argument("-r", "--repeat", type=int, default=3,
+                                 help="How many times each benchmark is run, the fastest run is reported (default: 3)")
+    argparse_parser.add_argument("-o", "--output", type=str,
+                                 help="Write the results to this JSON file")
+    argparse_parser.add_argument("--compare", type=str,
+                                 help="A results file from an earlier run (e.g. another commit) to compare against. Exits with status 1 if anything regressed.")
+    argparse_parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                                 help=f"Relative slowdown (or memory growth) counted as a regression (default: {DEFAULT_REGRESSION_THRESHOLD})")
+    argparse_parser.add_argument("--work-dir", type=str, default=None,
+                                 help="Where extracted output is written while benchmarking (default: the system's temporary directory)")
+
+    argparse_args = argparse_parser.parse_args()
+
+    with open(os.path.join(argparse_args.corpus_dir, CORPUS_INFO_FILENAME)) as corpus_info_file:
+        corpus_info = json.load(corpus_info_file)
+
+    results = {
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "corpus": corpus_info,
+        "benchmarks": dict(),
+    }
+
+    for benchmark_name in argparse_args.benchmarks:
+        result = run_benchmark(benchmark_name, argparse_args.corpus_dir, corpus_info, argparse_args.repeat,
+                               argparse_args.work_dir)
+        results["benchmarks"][benchmark_name] = result
+
+        if result["error"]:
+            print(f"{benchmark_name:<20} ERROR: {result['error']}")
+        else:
+            print(f"{benchmark_name:<20} {result['seconds']:>9.3f} s {result['mb_per_s']:>9.2f} MB/s "
+                  f"{result['records_per_s']:>10} records/s   peak RSS {result['peak_rss_mb']} MB")
+
+    if argparse_args.output:
+        with open(argparse_args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if argparse_args.compare:
+        with open(argparse_args.compare) as previous_results_file:
+            previous_results = json.load(previous_results_file)
+
+        print(f"Compared to {argparse_args.compare} (commit {previous_results.get('commit')}):")
+        if compare_results(results, previous_results, argparse_args.threshold):
+            sys.exit(1)
@@ -0,0 +1,334 @@
+import contextlib
+import logging
+import lxml.etree
+import os
+import sqlite3
+
+# locals
+from . import compressed_input
+from . import extraction_stats
+from . import progress_reporter
+from . import record_filter
+
+logger = logging.getLogger(__name__)
+
+# The archive is written to OUTPUT_DIR/backup_archive.sqlite, and read from INPUT_DIR/backup_archive.sqlite
+ARCHIVE_FILENAME = "backup_archive.sqlite"
+
+# How many records are inserted per transaction while loading backup files
+ARCHIVE_TRANSACTION_RECORDS = 50000
+
+# Messages are unique on (kind, date, address, box), calls on their date, so loading overlapping backups (or the
+# same backup twice) doesn't store anything twice
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archived_files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        date INTEGER,
+        address TEXT,
+        box INTEGER,
+        contact_name TEXT,
+        readable_date TEXT,
+        body TEXT,
+        UNIQUE (kind, date, address, box)
+    )""",
+    """CREATE TABLE IF NOT EXISTS parts (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL REFERENCES messages(id),
+        seq INTEGER,
+        ct TEXT,
+        cl TEXT,
+        name TEXT,
+        text TEXT,
+        encoded_length INTEGER NOT NULL,
+        data TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS calls (
+        id INTEGER PRIMARY KEY,
+        date INTEGER NOT NULL UNIQUE,
+        number TEXT,
+        type INTEGER,
+        duration INTEGER,
+        contact_name TEXT,
+        readable_date TEXT
+    )""",
+]
+
+# Only built once a load is done, which is much faster than maintaining them for every insert of the first load
+ARCHIVE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS messages_address ON messages (address)",
+    "CREATE INDEX IF NOT EXISTS messages_date ON messages (date)",
+    "CREATE INDEX IF NOT EXISTS parts_message_id ON parts (message_id)",
+    "CREATE INDEX IF NOT EXISTS parts_ct ON parts (ct)",
+    "CREATE INDEX IF NOT EXISTS calls_number ON calls (number)",
+]
+
+
+def get_archive_path(archive_dir: str) -> str:
+    return os.path.join(archive_dir, ARCHIVE_FILENAME)
+
+
+def is_archived_backup_file(filename: str) -> bool:
+    return filename.endswith(".xml") and filename.startswith(("sms", "calls"))
+
+
+def get_int_attribute(elem, name: str):
+    """
+    The value of an integer attribute, None if it is missing or not a number (e.g. "null")
+    """
+    try:
+        return int(elem.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_backup_records(xml_file):
+    """
+    Yields the <sms>, <mms> and <call> elements of an (open, binary) backup file, each one complete with its children,
+    dropping them from the tree once they have been handled
+    """
+    for event, elem in lxml.etree.iterparse(xml_file, events=('end',), tag=('sms', 'mms', 'call'),
+                                            huge_tree=True, recover=True):
+        yield elem
+
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class ArchiveLoader:
+    """
+    Inserts the records of backup files into an open archive, committing every ARCHIVE_TRANSACTION_RECORDS records.
+    Only the part data (the base64 payload of MMS attachments) is optional, it makes up most of a backup's size.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, store_part_data: bool, stats: extraction_stats.ExtractionStats):
+        self.connection = connection
+        self.store_part_data = store_part_data
+        self.stats = stats
+        self.uncommitted_records = 0
+
+    def add_message(self, elem) -> None:
+        kind = elem.tag
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO messages (kind, date, address, box, contact_name, readable_date, body)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, get_int_attribute(elem, 'date'), elem.get('address'),
+             get_int_attribute(elem, 'type' if kind == 'sms' else 'msg_box'),
+             elem.get('contact_name'), elem.get('readable_date'), elem.get('body')))
+
+        if cursor.rowcount == 0:
+            self.stats.count("duplicates")
+            return
+
+        self.stats.count(kind + "_archived")
+        if kind == 'mms':
+            parts = [(cursor.lastrowid, get_int_attribute(part, 'seq'), part.get('ct', '').lower(), part.get('cl'),
+                      part.get('name'), part.get('text'), len(part.get('data', '')),
+                      part.get('data') if self.store_part_data else None)
+                     for part in elem.iter('part')]
+            self.connection.executemany(
+                "INSERT INTO parts (message_id, seq, ct, cl, name, text, encoded_length, data)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", parts)
+            self.stats.count("parts_archived", len(parts))
+
+    def add_call(self, elem) -> None:
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO calls (date, number, type, duration, contact_name, readable_date)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (get_int_attribute(elem, 'date'), elem.get('number'), get_int_attribute(elem, 'type'),
+             get_int_attribute(elem, 'duration'), elem.get('contact_name'), elem.get('readable_date')))
+
+        self.stats.count("calls_archived" if cursor.rowcount else "duplicates")
+
+    def add_record(self, elem) -> None:
+        self.stats.count("records")
+        if elem.tag == 'call':
+            self.add_call(elem)
+        else:
+            self.add_message(elem)
+
+        self.uncommitted_records += 1
+        if self.uncommitted_records >= ARCHIVE_TRANSACTION_RECORDS:
+            self.connection.commit()
+            self.uncommitted_records = 0
+
+    def load_file(self, xml_file_path: str, progress: progress_reporter.ProgressReporter = None) -> None:
+        with compressed_input.open_input(xml_file_path) as xml_file:
+            if progress is not None:
+                progress.track(xml_file.tell)
+
+            for elem in self.stats.timed_iter(iter_backup_records(xml_file), extraction_stats.PHASE_XML_PARSE):
+                with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                    self.add_record(elem)
+                if progress is not None:
+                    progress.add_items()
+
+        self.connection.execute("INSERT OR REPLACE INTO archived_files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                                (os.path.abspath(xml_file_path), *compressed_input.get_input_signature(xml_file_path)))
+        self.connection.commit()
+        self.uncommitted_records = 0
+
+
+def open_archive(archive_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(archive_path)
+    # Transactions are large and few, so there's little to gain from fsync-ing each one. An interrupted load is
+    # simply run again, already archived records are ignored then.
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+def is_file_archived(connection: sqlite3.Connection, xml_file_path: str) -> bool:
+    """
+    Whether this very version (same size and modification time) of a backup file was loaded before
+    """
+    row = connection.execute("SELECT size, mtime_ns FROM archived_files WHERE path = ?",
+                             (os.path.abspath(xml_file_path),)).fetchone()
+    return row == compressed_input.get_input_signature(xml_file_path)
+
+
+def create_backup_archive(backup_xml_dir: str, output_dir: str, store_part_data: bool = False, stats: extraction_stats.ExtractionStats = None, show_progress: bool = False) -> None:
+    """
+    Loads the <sms>, <mms> (with their <part>s) and <call> records of all sms*.xml and calls*.xml backup files in
+    backup_xml_dir into a single SQLite archive in output_dir, indexed on address, date and content type, so later
+    extractions (see --from-archive) and queries don't have to parse the XML again.
+
+    An existing archive is added to: backup files it already holds are skipped, and records it already holds are
+    ignored. The base64 payloads of MMS parts are only archived with store_part_data, extracting media from the
+    archive needs them.
+    """
+
+    if stats is None:
+        stats = extraction_stats.ExtractionStats("archive")
+
+    os.makedirs(output_dir, exist_ok=True)
+    archive_path = get_archive_path(output_dir)
+
+    # Sorted, so that which copy of a repeated record is kept doesn't depend on the directory listing order
+    xml_file_paths = [xml_file_path for xml_file_path in compressed_input.list_input_files(backup_xml_dir)
+                      if is_archived_backup_file(compressed_input.get_backup_filename(xml_file_path))]
+
+    connection = open_archive(archive_path)
+    try:
+        for statement in ARCHIVE_SCHEMA:
+            connection.execute(statement)
+
+        new_file_paths = []
+        for xml_file_path in xml_file_paths:
+            if is_file_archived(connection, xml_file_path):
+                logger.debug("Skipping %s, it is already archived", compressed_input.get_backup_filename(xml_file_path))
+                stats.count("files_skipped")
+            else:
+                new_file_paths.append(xml_file_path)
+
+        input_bytes = sum(compressed_input.get_input_size(xml_file_path) for xml_file_path in new_file_paths)
+        stats.count("files", len(new_file_paths))
+        stats.count("input_bytes", input_bytes)
+
+        progress = progress_reporter.ProgressReporter(input_bytes, len(new_file_paths), "records") if show_progress else None
+
+        loader = ArchiveLoader(connection, store_part_data, stats)
+        with (progress if progress is not None else contextlib.nullcontext()):
+            for xml_file_path in new_file_paths:
+                xml_file_size = compressed_input.get_input_size(xml_file_path)
+                if progress is not None:
+                    progress.start_file(xml_file_path, xml_file_size)
+
+                loader.load_file(xml_file_path, progress)
+                logger.debug("Finished archiving file %s", compressed_input.get_backup_filename(xml_file_path))
+
+                if progress is not None:
+                    progress.finish_file(xml_file_size)
+
+        with stats.timed(extraction_stats.PHASE_FILE_WRITE):
+            for statement in ARCHIVE_INDEXES:
+                connection.execute(statement)
+            connection.commit()
+    finally:
+        connection.close()
+
+    stats.count("bytes_written", os.path.getsize(archive_path))
+
+    print(f"{stats.counters['sms_archived']} SMS, {stats.counters['mms_archived']} MMS "
+          f"({stats.counters['parts_archived']} parts) and {stats.counters['calls_archived']} calls added to "
+          f"{archive_path}, {stats.counters['duplicates']} duplicates ignored")
+
+
+def iter_archived_parts(archive_path: str, accepted_content_types, addresses=None, since_ms: int = None, until_ms: int = None, max_decoded_size: int = None):
+    """
+    Yields (date, address, cl, ct, data) for every archived MMS part of one of accepted_content_types, in the order
+    they were archived. data is None for parts archived without their payload.
+
+    Parts can be narrowed down further, by the indexes, to messages to or from one of addresses (exactly as archived),
+    sent from since_ms (inclusive) until until_ms (exclusive), and to payloads that may decode to at most
+    max_decoded_size bytes (judged by their length only, the caller has to check the data of those close to it).
+    """
+    conditions = [f"parts.ct IN ({', '.join('?' * len(accepted_content_types))})"]
+    parameters = list(accepted_content_types)
+
+    if addresses is not None:
+        conditions.append(f"messages.address IN ({', '.join('?' * len(addresses))})")
+        parameters.extend(addresses)
+    if since_ms is not None:
+        conditions.append("messages.date >= ?")
+        parameters.append(since_ms)
+    if until_ms is not None:
+        conditions.append("messages.date < ?")
+        parameters.append(until_ms)
+    if max_decoded_size is not None:
+        # Same estimate as record_filter.get_min_decoded_size()
+        conditions.append(f"MAX(parts.encoded_length * {record_filter.MIN_BASE64_LINE_LENGTH}"
+                          f" / {record_filter.MIN_BASE64_LINE_LENGTH + record_filter.MAX_LINE_BREAK_LENGTH}"
+                          f" * 3 / 4 - {record_filter.MAX_BASE64_PADDING}, 0) <= ?")
+        parameters.append(max_decoded_size)
+
+    connection = sqlite3.connect(f"file:{archive_path}?mode=ro", uri=True)
+    try:
+        yield from connection.execute(
+            "SELECT messages.date, messages.address, parts.cl, parts.ct, parts.data"
+            " FROM parts JOIN messages ON messages.id = parts.message_id"
+            f" WHERE {' AND '.join(conditions)} ORDER BY parts.id",
+            parameters)
+    finally:
+        connection.close()
+
+
+def get_archived_addresses(archive_path: str, kind: str) -> list:
+    """
+    The distinct addresses of the archived messages of a kind ('sms' or 'mms')
+    """
+    connection = sqlite3.connect(f"file:{archive_path}?mode=ro", uri=True)
+    try:
+        return [address for address, in connection.execute(
+            "SELECT DISTINCT address FROM messages WHERE kind = ?", (kind,))]
+    finally:
+        connection.close()
+
+
+def get_archived_part_content_types(archive_path: str) -> dict:
+    """
+    Returns {content type: number of archived MMS parts}
+    """
+    connection = sqlite3.connect(f"file:{archive_path}?mode=ro", uri=True)
+    try:
+        return dict(connection.execute("SELECT ct, count(*) FROM parts GROUP BY ct"))
+    finally:
+        connection.close()
+
+
+def iter_archived_calls(archive_path: str):
+    """
+    Yields (date, readable_date, type, contact_name, number, duration) for every archived call, in the order they were
+    archived
+    """
+    connection = sqlite3.connect(f"file:{archive_path}?mode=ro", uri=True)
+    try:
+        yield from connection.execute(
+            "SELECT date, readable_date, type, contact_name, number, duration FROM calls ORDER BY id")
+    finally:
+        connection.close()
@@ -0,0 +1,291 @@
+import mmap
+import os
+import re
+import struct
+
+# locals
+from . import compressed_input
+
+# Sidecar index files are stored next to the backup file they describe, e.g. "sms-20240101.xml.idx"
+INDEX_FILE_SUFFIX = ".idx"
+INDEX_MAGIC = b"SBRIDX"
+INDEX_VERSION = 1
+
+# magic, version, source file size, source file mtime (ns), number of addresses, number of records
+INDEX_HEADER_STRUCT = struct.Struct("<6sHQqII")
+# record kind, byte offset, byte length, date (epoch ms), address id, number of attachments
+INDEX_RECORD_STRUCT = struct.Struct("<BQQqII")
+INDEX_ADDRESS_LENGTH_STRUCT = struct.Struct("<H")
+
+RECORD_KINDS = {"sms": 1, "mms": 2, "call": 3}
+RECORD_KIND_NAMES = {kind_id: kind_name for kind_name, kind_id in RECORD_KINDS.items()}
+
+# The attribute holding the other party's phone number, per record kind
+RECORD_ADDRESS_ATTRIBUTES = {"sms": "address", "mms": "address", "call": "number"}
+
+# MIME discrete-types of the <part>s counted as attachments
+ATTACHMENT_CONTENT_TYPES = {"image", "video", "audio", "application"}
+
+RECORD_START_PATTERN = re.compile(rb"<(sms|mms|call)[\s/>]")
+# A whole start tag, quoted attribute values may contain '>' characters
+START_TAG_PATTERN = re.compile(rb"""<[\w:-]+(?:[^>"']|"[^"]*"|'[^']*')*>""")
+ATTRIBUTE_PATTERN = re.compile(rb"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+PART_CONTENT_TYPE_PATTERN = re.compile(rb"""<part\s[^>]*?\bct\s*=\s*["']([^"']*)["']""")
+
+# The only references XML resolves in attribute values: its 5 predefined entities, and numeric character references
+# (HTML's named entities, or references without their ';', aren't XML)
+XML_REFERENCE_PATTERN = re.compile(r"&(?:(lt|gt|amp|quot|apos)|#([0-9]+)|#x([0-9a-fA-F]+));")
+XML_PREDEFINED_ENTITIES = {"lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}
+# An XML parser turns every literal whitespace character of an attribute value into a space (line breaks, CRLF
+# included, having been normalized to "\n" already)
+XML_ATTRIBUTE_WHITESPACE = {ord("\t"): " ", ord("\n"): " ", ord("\r"): " "}
+
+
+def get_index_path(xml_file_path: str) -> str:
+    return xml_file_path + INDEX_FILE_SUFFIX
+
+
+def is_index_file(filename: str) -> bool:
+    return filename.endswith(INDEX_FILE_SUFFIX)
+
+
+def is_xml_char(code_point: int) -> bool:
+    return (code_point in (0x9, 0xA, 0xD) or 0x20 <= code_point <= 0xD7FF or 0xE000 <= code_point <= 0xFFFD
+            or 0x10000 <= code_point <= 0x10FFFF)
+
+
+def unescape_xml_attribute(value: str):
+    """
+    Returns a raw attribute value the way an XML parser reads it: references resolved and whitespace normalized.
+    Returns None if it has an '&' that isn't a valid XML reference, which only an XML parser (recovering from the
+    error) can make sense of.
+    """
+    if "\r" in value or "\t" in value or "\n" in value:
+        value = value.replace("\r\n", "\n").translate(XML_ATTRIBUTE_WHITESPACE)
+
+    if "&" not in value:
+        return value
+
+    references = XML_REFERENCE_PATTERN.findall(value)
+    if len(references) != value.count("&"):
+        return None
+
+    for _, decimal_code, hex_code in references:
+        if (decimal_code or hex_code) and not is_xml_char(int(decimal_code or hex_code, 10 if decimal_code else 16)):
+            return None
+
+    return XML_REFERENCE_PATTERN.sub(
+        lambda reference_match: XML_PREDEFINED_ENTITIES[reference_match.group(1)] if reference_match.group(1)
+        else chr(int(reference_match.group(2), 10) if reference_match.group(2) else int(reference_match.group(3), 16)),
+        value)
+
+
+def parse_start_tag_attributes(start_tag: bytes) -> dict:
+    """
+    Pulls the attributes out of a raw start tag, resolving any XML entities in their values (a value with
+    references that aren't XML is kept as is)
+    """
+    attributes = dict()
+    for name, double_quoted_value, single_quoted_value in ATTRIBUTE_PATTERN.findall(start_tag):
+        value = (double_quoted_value if double_quoted_value or not single_quoted_value
+                 else single_quoted_value).decode('utf-8', 'replace')
+        unescaped_value = unescape_xml_attribute(value)
+        attributes[name.decode('utf-8', 'replace')] = value if unescaped_value is None else unescaped_value
+
+    return attributes
+
+
+def count_attachments(mms_record: bytes) -> int:
+    num_attachments = 0
+    for ct_value in PART_CONTENT_TYPE_PATTERN.findall(mms_record):
+        if ct_value.lower().partition(b'/')[0].decode('ascii', 'replace') in ATTACHMENT_CONTENT_TYPES:
+            num_attachments += 1
+
+    return num_attachments
+
+
+def scan_backup_records(xml_file_path: str):
+    """
+    Scans the raw bytes of a backup file for <sms>, <mms> and <call> records, yielding
+    (kind, offset, length, date, address, number of attachments) for each one
+    """
+    with open(xml_file_path, 'rb') as xml_file:
+        if os.fstat(xml_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as xml_bytes:
+            pos = 0
+            while True:
+                record_match = RECORD_START_PATTERN.search(xml_bytes, pos)
+                if record_match is None:
+                    return
+
+                record_offset = record_match.start()
+                start_tag_match = START_TAG_PATTERN.match(xml_bytes, record_offset)
+                if start_tag_match is None:
+                    # Truncated file, nothing else can be indexed
+                    return
+
+                kind = record_match.group(1).decode('ascii')
+                start_tag = start_tag_match.group(0)
+                record_end = start_tag_match.end()
+
+                if not start_tag.endswith(b"/>"):
+                    end_tag = b"</" + record_match.group(1) + b">"
+                    end_tag_idx = xml_bytes.find(end_tag, record_end)
+                    if end_tag_idx < 0:
+                        return
+                    record_end = end_tag_idx + len(end_tag)
+
+                attributes = parse_start_tag_attributes(start_tag)
+                try:
+                    record_date = int(attributes.get('date', '0'))
+                except ValueError:
+                    record_date = 0
+
+                num_attachments = count_attachments(xml_bytes[record_offset:record_end]) if kind == 'mms' else 0
+
+                yield (kind, record_offset, record_end - record_offset, record_date,
+                       attributes.get(RECORD_ADDRESS_ATTRIBUTES[kind], ''), num_attachments)
+
+                pos = record_end
+
+
+def build_backup_index(xml_file_path: str) -> str:
+    """
+    Creates (or replaces) the sidecar index of a backup file, returning the index's path
+    """
+    source_stat = os.stat(xml_file_path)
+
+    address_ids = dict()
+    packed_records = []
+    for kind, offset, length, record_date, address, num_attachments in scan_backup_records(xml_file_path):
+        address_id = address_ids.setdefault(address, len(address_ids))
+        packed_records.append(INDEX_RECORD_STRUCT.pack(RECORD_KINDS[kind], offset, length, record_date,
+                                                       address_id, num_attachments))
+
+    index_path = get_index_path(xml_file_path)
+    # Written under a temporary name first, so an interrupted build never leaves a truncated index behind
+    with open(index_path + ".tmp", 'wb') as index_file:
+        index_file.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, INDEX_VERSION, source_stat.st_size,
+                                                  source_stat.st_mtime_ns, len(address_ids), len(packed_records)))
+        for address in address_ids:
+            address_bytes = address.encode('utf-8')
+            index_file.write(INDEX_ADDRESS_LENGTH_STRUCT.pack(len(address_bytes)))
+            index_file.write(address_bytes)
+        index_file.write(b"".join(packed_records))
+
+    os.replace(index_path + ".tmp", index_path)
+    return index_path
+
+
+class BackupIndex:
+    """
+    The records of a loaded sidecar index, kept packed and only unpacked as they are iterated over, so a backup of
+    millions of records doesn't turn into millions of tuples up front
+    """
+
+    def __init__(self, records_bytes, addresses: list):
+        self.records_bytes = records_bytes
+        self.addresses = addresses
+
+    def __len__(self) -> int:
+        return len(self.records_bytes) // INDEX_RECORD_STRUCT.size
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def iter_records(self, kind: str = None, record_filter=None):
+        """
+        Yields (kind, offset, length, date, address, number of attachments) for the records of the given kind (or of
+        any kind) that record_filter (if given) selects by their date and address, in file order. The others are
+        skipped while unpacking.
+        """
+        kind_id = None if kind is None else RECORD_KINDS[kind]
+
+        for record_kind_id, offset, length, record_date, address_id, num_attachments \
+                in INDEX_RECORD_STRUCT.iter_unpack(self.records_bytes):
+            if kind_id is not None and record_kind_id != kind_id:
+                continue
+
+            address = self.addresses[address_id]
+            if record_filter is not None and not record_filter.selects_record(record_date, address):
+                continue
+
+            yield RECORD_KIND_NAMES[record_kind_id], offset, length, record_date, address, num_attachments
+
+
+def load_backup_index(xml_file_path: str):
+    """
+    Loads the sidecar index of a backup file, as a BackupIndex.
+    Returns None if there is no index, or if it is out of date (the backup file's size or modification time changed).
+    """
+    index_path = get_index_path(xml_file_path)
+    if not os.path.isfile(index_path):
+        return None
+
+    source_stat = os.stat(xml_file_path)
+
+    with open(index_path, 'rb') as index_file:
+        index_bytes = index_file.read()
+
+    try:
+        magic, version, source_size, source_mtime_ns, num_addresses, num_records = \
+            INDEX_HEADER_STRUCT.unpack_from(index_bytes, 0)
+    except struct.error:
+        return None
+
+    if (magic != INDEX_MAGIC or version != INDEX_VERSION or source_size != source_stat.st_size
+            or source_mtime_ns != source_stat.st_mtime_ns):
+        return None
+
+    pos = INDEX_HEADER_STRUCT.size
+    addresses = []
+    for _ in range(num_addresses):
+        (address_len,) = INDEX_ADDRESS_LENGTH_STRUCT.unpack_from(index_bytes, pos)
+        pos += INDEX_ADDRESS_LENGTH_STRUCT.size
+        addresses.append(index_bytes[pos:pos + address_len].decode('utf-8'))
+        pos += address_len
+
+    records_end = pos + num_records * INDEX_RECORD_STRUCT.size
+    if len(index_bytes) != records_end:
+        return None
+
+    return BackupIndex(memoryview(index_bytes)[pos:records_end], addresses)
+
+
+def get_backup_index(xml_file_path: str, build_index: bool):
+    """
+    Returns the up-to-date index of a backup file, (re)building it first if asked to.
+    Returns None if there's no usable index. Compressed backup files are never indexed, they can't be seeked in.
+    """
+    if not compressed_input.is_plain_file(xml_file_path):
+        return None
+
+    backup_index = load_backup_index(xml_file_path)
+
+    if backup_index is None and build_index:
+        try:
+            build_backup_index(xml_file_path)
+        except OSError as e:
+            print(f"ERROR: Couldn't write index for {xml_file_path}: {e}")
+            return None
+        backup_index = load_backup_index(xml_file_path)
+
+    return backup_index
+
+
+def iter_indexed_record_bytes(xml_file, index_records, chunk_size: int):
+    """
+    Seeks to each of the given index records in an (open, binary) backup file, yielding their raw bytes in pieces
+    of at most chunk_size bytes
+    """
+    for _, offset, length, _, _, _ in index_records:
+        xml_file.seek(offset)
+        remaining = length
+        while remaining > 0:
+            piece = xml_file.read(min(remaining, chunk_size))
+            if not piece:
+                break
+            remaining -= len(piece)
+            yield piece
@@ -1,8 +1,44 @@
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import functools
+import itertools
+import logging
 import os
+import sys
+import tempfile
 import xml.etree.ElementTree
 
+# locals
+from . import backup_archive
+from . import backup_index as backup_index_helper
+from . import call_log_sinks
+from . import compressed_input
+from . import external_sort
+from . import extraction_stats
+from . import progress_reporter
+from . import record_filter as record_filter_helper
 
+logger = logging.getLogger(__name__)
+
+CALL_LOG_COLUMNS = ["Call Date (timestamp)", "Call date", "Call type", "Caller name", "Caller #",
+                    "Call duration (s)", "Call duration", "Call Id #"]
+
+# https://developer.android.com/reference/android/provider/CallLog.Calls#TYPE
+CALL_TYPE_NAMES = {"1": "Incoming", "2": "Outgoing", "3": "Missed",
+                   "4": "Voicemail", "5": "Rejected", "6": "Blocked", "7": "AnsweredExternally"}
+MISSED_CALL_TYPE = "Missed"
+
+# One call of the log. There can be millions of them, so they are kept compact: the timestamp, duration and id are
+# ints, and the strings repeated across calls (call type, caller name and number) are shared between them.
+# duration is None for missed calls, the CSV formatting is only done when the log is written.
+CallRecord = collections.namedtuple("CallRecord", [
+    "timestamp", "readable_date", "call_type", "contact_name", "number", "duration", "call_id"])
+
+
+# Durations repeat a lot across calls, so each one is only formatted once
+@functools.lru_cache(maxsize=4096)
 def get_human_readable_duration(duration_raw_s: str) -> str:
     """
     Converts the number of seconds into a formatted and correctly pluralized reading of hours, minutes, and seconds
@@ -36,79 +72,340 @@ def get_human_readable_duration(duration_raw_s: str) -> str:
     return formatted_str
 
 
-def create_call_log(calls_xml_dir) -> None:
+def iter_call_elements(calls_xml_file_path: str, build_index: bool = False, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Yields the <call> elements of a calls*.xml backup file. If the file has an up-to-date sidecar index
+    (built first, with build_index) and record_filter (if given) leaves out some of its calls, by the date and number
+    in the index, only the selected calls are read, each on its own straight from its offset in the file. Otherwise
+    the whole file is parsed in one go, which is faster than reading every call on its own.
+    The read position in the file is tracked by progress, if given.
+    """
+    is_filtered = record_filter is not None and not record_filter.is_selecting_everything()
+    backup_index = backup_index_helper.get_backup_index(calls_xml_file_path, build_index) \
+        if is_filtered or build_index else None
+
+    call_spans = None
+    if backup_index is not None and is_filtered:
+        num_calls = 0
+        call_spans = []
+        for _, offset, length, date, number, _ in backup_index.iter_records('call'):
+            num_calls += 1
+            if record_filter.selects_record(date, number):
+                call_spans.append((offset, length))
+
+        if len(call_spans) == num_calls:
+            call_spans = None
+
+    if call_spans is None:
+        with compressed_input.open_input(calls_xml_file_path) as calls_xml_file:
+            if progress is not None:
+                progress.track(calls_xml_file.tell)
+
+            # Parse incrementally, dropping every call from the tree once it has been handled, so memory doesn't
+            # grow with the size of the file
+            root = None
+            for event, elem in xml.etree.ElementTree.iterparse(calls_xml_file, events=("start", "end")):
+                if root is None:
+                    root = elem
+                elif event == "end" and elem.tag == "call":
+                    yield elem
+                    elem.clear()
+                    root.clear()
+        return
+
+    with open(calls_xml_file_path, 'rb') as calls_xml_file:
+        if progress is not None:
+            progress.track(calls_xml_file.tell)
+        for offset, length in call_spans:
+            calls_xml_file.seek(offset)
+            yield xml.etree.ElementTree.fromstring(calls_xml_file.read(length))
+
+
+def is_calls_backup_file(filename: str) -> bool:
+    return filename.endswith(".xml") and filename.startswith("calls")
+
+
+def get_call_sort_key(call: CallRecord) -> int:
+    """
+    Calls are sorted by their timestamp, as a number (a string comparison would put e.g. 2001 before 1999)
+    """
+    return call.timestamp
 
-    all_calls_list = []
 
-    # https://developer.android.com/reference/android/provider/CallLog.Calls#TYPE
-    call_type_map = {"1": "Incoming", "2": "Outgoing", "3": "Missed",
-                     "4": "Voicemail", "5": "Rejected", "6": "Blocked", "7": "AnsweredExternally"}
+def parse_call_element(call_entry_xml, call_timestamp: int) -> CallRecord:
+    """
+    Converts a <call> element into a CallRecord. Its call id is assigned later, once the order of all calls is known.
+    """
+    call_attrib = call_entry_xml.attrib
+    call_type = CALL_TYPE_NAMES[call_attrib["type"]]
 
-    # Used to maintain uniqueness among calls, since multiple calls cannot happen at the same time
-    call_timestamps = set()
+    # Missed calls don't have "duration"
+    # But sometimes, incoming/outgoing calls do have a duration of 0 if you hang up really fast
+    call_duration = int(call_attrib["duration"]) if call_type != MISSED_CALL_TYPE else None
 
-    call_timestamp_key_name = "Call Date (timestamp)"
+    return CallRecord(call_timestamp, call_attrib["readable_date"], call_type,
+                      sys.intern(call_attrib["contact_name"]), sys.intern(call_attrib["number"]),
+                      call_duration, None)
 
-    num_calls = 0
 
-    for filename in os.listdir(calls_xml_dir):
+def iter_new_calls(calls_xml_file_path: str, call_timestamps: set, build_index: bool, stats: extraction_stats.ExtractionStats, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Yields a CallRecord for every call of a calls*.xml backup file whose timestamp isn't in call_timestamps yet,
+    adding the timestamps as it goes. Multiple calls can't happen at the same time, so a repeated timestamp is the
+    same call, backed up more than once. Calls record_filter (if given) doesn't select are left out.
+    """
+    for call_entry_xml in stats.timed_iter(iter_call_elements(calls_xml_file_path, build_index, progress, record_filter),
+                                           extraction_stats.PHASE_XML_PARSE):
+
+        stats.count("records")
+        if progress is not None:
+            progress.add_items()
+
+        call_timestamp = int(call_entry_xml.attrib["date"])
+
+        if record_filter is not None and not record_filter.selects_record(call_timestamp,
+                                                                          call_entry_xml.attrib["number"]):
+            stats.count("filtered_out")
+            continue
+
+        # Make sure this call hasn't already been logged before
+        if call_timestamp in call_timestamps:
+            stats.count("duplicates")
+            continue
+
+        call_timestamps.add(call_timestamp)
+        yield parse_call_element(call_entry_xml, call_timestamp)
+
+
+def iter_archived_new_calls(archive_path: str, call_timestamps: set, stats: extraction_stats.ExtractionStats, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as iter_new_calls(), but for the calls of a backup archive (see backup_archive). Reading the archive counts
+    as parsing.
+    """
+    for call_timestamp, readable_date, call_type_id, contact_name, number, call_duration in stats.timed_iter(
+            backup_archive.iter_archived_calls(archive_path), extraction_stats.PHASE_XML_PARSE):
+
+        stats.count("records")
+        if progress is not None:
+            progress.add_items()
+
+        if record_filter is not None and not record_filter.selects_record(call_timestamp, number):
+            stats.count("filtered_out")
+            continue
+
+        if call_timestamp in call_timestamps:
+            stats.count("duplicates")
+            continue
+
+        call_timestamps.add(call_timestamp)
+        call_type = CALL_TYPE_NAMES[str(call_type_id)]
+        yield CallRecord(call_timestamp, readable_date, call_type, sys.intern(contact_name or ""),
+                         sys.intern(number or ""), call_duration if call_type != MISSED_CALL_TYPE else None, None)
+
+
+def spill_calls_file(calls_xml_file_path: str, build_index: bool, spill_dir: str, record_filter: record_filter_helper.RecordFilter = None) -> tuple:
+    """
+    Parses one calls*.xml backup file in a worker process, writing its calls (each repeated call only once, in file
+    order) to a new file in spill_dir. Returns the path of that file, and the worker's extraction_stats as a dict.
+    """
+    stats = extraction_stats.ExtractionStats()
+
+    with tempfile.NamedTemporaryFile(dir=spill_dir, suffix=".calls", delete=False) as spill_file:
+        calls = []
+        for call in iter_new_calls(calls_xml_file_path, set(), build_index, stats, record_filter=record_filter):
+            calls.append(call)
+            if len(calls) >= external_sort.SPILL_BATCH_RECORDS:
+                external_sort.write_record_batches(calls, spill_file)
+                calls = []
+        external_sort.write_record_batches(calls, spill_file)
+
+    return spill_file.name, stats.to_dict()
+
+
+def report_calls_file_result(progress: progress_reporter.ProgressReporter, file_size: int, future: concurrent.futures.Future) -> None:
+    """
+    Counts a calls backup file parsed by a worker process towards the progress
+    """
+    if not future.cancelled() and future.exception() is None:
+        progress.add_items(future.result()[1]["counters"].get("records", 0))
+    progress.finish_file(file_size)
+
 
-        if filename.endswith(".xml") and filename.startswith("calls"):
-            xml_tree = xml.etree.ElementTree.parse(
-                os.path.join(calls_xml_dir, filename))
+def iter_spilled_new_calls(spill_file_path: str, call_timestamps: set, stats: extraction_stats.ExtractionStats):
+    """
+    Yields the calls of a file written by spill_calls_file() whose timestamp isn't in call_timestamps yet, adding them
+    """
+    with open(spill_file_path, 'rb') as spill_file:
+        for call in external_sort.iter_record_batches(spill_file):
+            if call.timestamp in call_timestamps:
+                stats.count("duplicates")
+                continue
 
-            for call_entry_xml in xml_tree.findall(".//call"):
+            call_timestamps.add(call.timestamp)
+            # Unpickled strings aren't shared anymore
+            yield call._replace(contact_name=sys.intern(call.contact_name), number=sys.intern(call.number))
 
-                # Make sure this call hasn't already been logged before
-                if not call_entry_xml.attrib['date'] in call_timestamps:
 
-                    call_entry_obj = dict()
+def iter_calls_by_file(calls_file_paths: list, call_timestamps: set, build_index: bool, stats: extraction_stats.ExtractionStats, progress: progress_reporter.ProgressReporter = None, from_archive: bool = False, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Yields (file path, iterator over the file's new calls, see iter_new_calls()) for each of calls_file_paths in
+    turn. Each iterator has to be used up before the next pair is asked for. With from_archive, the paths are backup
+    archives.
+    """
+    for calls_xml_file_path in calls_file_paths:
+        calls_file_size = compressed_input.get_input_size(calls_xml_file_path)
+        if progress is not None:
+            progress.start_file(calls_xml_file_path, calls_file_size)
 
-                    call_timestamp = call_entry_xml.attrib["date"]
+        if from_archive:
+            yield calls_xml_file_path, iter_archived_new_calls(calls_xml_file_path, call_timestamps, stats, progress,
+                                                               record_filter)
+        else:
+            yield calls_xml_file_path, iter_new_calls(calls_xml_file_path, call_timestamps, build_index, stats, progress,
+                                                      record_filter)
 
-                    call_entry_obj.update({call_timestamp_key_name: call_timestamp,
-                                           "Call date": call_entry_xml.attrib["readable_date"]})
+        if progress is not None:
+            progress.finish_file(calls_file_size)
 
-                    call_type = call_type_map[call_entry_xml.attrib["type"]]
-                    call_entry_obj["Call type"] = call_type
 
-                    call_entry_obj["Caller name"] = call_entry_xml.attrib["contact_name"]
-                    call_entry_obj["Caller #"] = call_entry_xml.attrib["number"]
+def iter_calls_by_file_in_parallel(calls_file_paths: list, call_timestamps: set, build_index: bool, stats: extraction_stats.ExtractionStats, jobs: int, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as iter_calls_by_file(), with the same calls in the same order, but with the files parsed by jobs worker
+    processes. Their calls are read back in file order, so which copy of a repeated call is kept never depends on
+    which worker finished first.
+    """
+    with tempfile.TemporaryDirectory(prefix="call_log_") as spill_dir, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
 
-                    # Missed calls don't have "duration"
-                    # But sometimes, incoming/outgoing calls do have a duration of 0 if you hang up really fast
-                    call_duration_raw = call_entry_xml.attrib["duration"]
+        # Start the biggest files first, so one large file doesn't end up running alone at the end
+        futures = {calls_xml_file_path: executor.submit(spill_calls_file, calls_xml_file_path, build_index, spill_dir,
+                                                        record_filter)
+                   for calls_xml_file_path in sorted(calls_file_paths, key=compressed_input.get_input_size, reverse=True)}
 
-                    if call_type != "Missed":
-                        # the 'raw' value
-                        call_entry_obj["Call duration (s)"] = call_duration_raw
-                        call_entry_obj["Call duration"] = get_human_readable_duration(
-                            call_duration_raw)
+        if progress is not None:
+            # Worker processes can't report their read position, so progress advances a whole file at a time
+            for calls_xml_file_path, future in futures.items():
+                future.add_done_callback(lambda future, file_size=compressed_input.get_input_size(calls_xml_file_path):
+                                         report_calls_file_result(progress, file_size, future))
 
-                    else:
-                        # The CSV writer is a bit finnicky, so we need to make sure that all dictionaries
-                        # have the same key names, ie we can't just leave off these 2 or that'll mess up the columns
-                        call_entry_obj["Call duration (s)"] = "N/A"
-                        call_entry_obj["Call duration"] = "N/A"
+        for calls_xml_file_path in calls_file_paths:
+            spill_file_path, file_stats = futures[calls_xml_file_path].result()
+            stats.merge(file_stats)
 
-                    call_entry_obj["Call Id #"] = num_calls
+            yield calls_xml_file_path, iter_spilled_new_calls(spill_file_path, call_timestamps, stats)
 
-                    call_timestamps.add(call_timestamp)
+            os.remove(spill_file_path)
 
-                    all_calls_list.append(call_entry_obj)
 
-                    num_calls += 1
+def format_call_row(call: CallRecord) -> list:
+    """
+    The call log CSV row of a call, see CALL_LOG_COLUMNS
+    """
+    if call.duration is not None:
+        # the 'raw' value, and the readable one
+        duration_columns = [call.duration, get_human_readable_duration(call.duration)]
+    else:
+        # Every row needs all the columns, or the rest of them would be shifted over
+        duration_columns = ["N/A", "N/A"]
 
-        print(
-            f'[DEBUG] Finished processing file {filename} .. now at {num_calls} calls total')
+    return [call.timestamp, call.readable_date, call.call_type, call.contact_name, call.number,
+            *duration_columns, call.call_id]
 
-    # All calls have been created. Now write the entire log to csv file
 
-    with open('call_log.csv', 'w') as csv_file_handle:
-        csv_writer = csv.writer(csv_file_handle)
+class CsvCallLogSink(call_log_sinks.CallLogSink):
+    """
+    The original call log format, with human-readable columns, see CALL_LOG_COLUMNS
+    """
+
+    extension = ".csv"
+
+    def __init__(self, output_dir: str):
+        super().__init__(output_dir)
+        self.file = open(self.path, 'w')
+        self.csv_writer = csv.writer(self.file)
 
         # Write the header
-        csv_writer.writerow(all_calls_list[0].keys())
+        self.csv_writer.writerow(CALL_LOG_COLUMNS)
+
+    def write_calls(self, calls: list) -> None:
+        self.csv_writer.writerows(map(format_call_row, calls))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+CALL_LOG_SINKS = {
+    "csv": CsvCallLogSink,
+    "jsonl": call_log_sinks.JsonLinesCallLogSink,
+    "sqlite": call_log_sinks.SqliteCallLogSink,
+    "parquet": call_log_sinks.ParquetCallLogSink,
+}
+CALL_LOG_FORMATS = list(CALL_LOG_SINKS)
+DEFAULT_CALL_LOG_FORMAT = "csv"
+
+# Calls handed to the call log sink at a time (e.g. one parquet row group, or one SQLite executemany())
+CALL_LOG_BATCH_CALLS = 10000
+
+
+def create_call_log(calls_xml_dir, output_dir: str = ".", build_index: bool = False, stats: extraction_stats.ExtractionStats = None, show_progress: bool = False, max_calls_in_memory: int = external_sort.DEFAULT_MAX_RECORDS_IN_MEMORY, jobs: int = 1, call_log_format: str = DEFAULT_CALL_LOG_FORMAT, from_archive: bool = False, record_filter: record_filter_helper.RecordFilter = None) -> None:
+    """
+    Writes the de-duplicated calls of all calls*.xml backup files in calls_xml_dir, or with from_archive, of the
+    backup archive in calls_xml_dir (see backup_archive), to a call log in output_dir, in chronological order.
+    call_log_format is one of CALL_LOG_FORMATS, the file is named call_log.<format>. At most max_calls_in_memory
+    calls are held in memory, sorted runs of them are spilled to temporary files and merged back together while the
+    call log is written. Only the calls record_filter (if given) selects, by date and number, are logged.
+
+    The files are handled in name order, with jobs > 1 they are parsed by that many worker processes. Either way the
+    first copy of a repeated call is the one kept, and call ids are numbered in the order the calls are found.
+    """
+
+    if stats is None:
+        stats = extraction_stats.ExtractionStats("calls")
+
+    # Used to maintain uniqueness among calls, since multiple calls cannot happen at the same time
+    call_timestamps = set()
+
+    num_calls = 0
+
+    calls_sorter = external_sort.ExternalSorter(get_call_sort_key, max_calls_in_memory, stats=stats)
+
+    # Sorted, so that which copy of a repeated call is kept doesn't depend on the directory listing order
+    if from_archive:
+        calls_file_paths = [backup_archive.get_archive_path(calls_xml_dir)]
+    else:
+        calls_file_paths = [calls_xml_file_path for calls_xml_file_path in compressed_input.list_input_files(calls_xml_dir)
+                            if is_calls_backup_file(compressed_input.get_backup_filename(calls_xml_file_path))]
+    input_bytes = sum(compressed_input.get_input_size(calls_xml_file_path) for calls_xml_file_path in calls_file_paths)
+    stats.count("files", len(calls_file_paths))
+    stats.count("input_bytes", input_bytes)
+
+    progress = progress_reporter.ProgressReporter(input_bytes, len(calls_file_paths), "calls") if show_progress else None
+
+    with (progress if progress is not None else contextlib.nullcontext()):
+        if jobs > 1 and len(calls_file_paths) > 1:
+            calls_by_file = iter_calls_by_file_in_parallel(calls_file_paths, call_timestamps, build_index, stats,
+                                                           jobs, progress, record_filter)
+        else:
+            calls_by_file = iter_calls_by_file(calls_file_paths, call_timestamps, build_index, stats, progress,
+                                               from_archive, record_filter)
+
+        for calls_xml_file_path, calls in calls_by_file:
+            for call in calls:
+                stats.count_content_type(call.call_type)
+                calls_sorter.add(call._replace(call_id=num_calls))
+                num_calls += 1
+
+            logger.debug("Finished processing file %s .. now at %d calls total",
+                         os.path.basename(calls_xml_file_path), num_calls)
+
+    # All calls have been created. Now merge the sorted runs straight into the call log
+
+    stats.count("calls_written", num_calls)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with calls_sorter, stats.timed(extraction_stats.PHASE_FILE_WRITE), \
+            CALL_LOG_SINKS[call_log_format](output_dir) as call_log_sink:
+        for calls in itertools.batched(calls_sorter.iter_sorted(), CALL_LOG_BATCH_CALLS):
+            call_log_sink.write_calls(calls)
 
-        for call_entry in sorted(all_calls_list, key=lambda k: k[call_timestamp_key_name]):
-            csv_writer.writerow(list(call_entry.values()))
+    stats.count("bytes_written", os.path.getsize(call_log_sink.path))
@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Optional, only needed for the parquet call log format
+    pyarrow = None
+
+PARQUET_AVAILABLE = pyarrow is not None
+
+# The call log is written to OUTPUT_DIR/call_log.<format's extension>
+CALL_LOG_BASENAME = "call_log"
+
+# Typed columns of the jsonl, sqlite and parquet formats: timestamps are epoch milliseconds and durations seconds,
+# as integers. duration_s is null for missed calls.
+CALL_LOG_FIELDS = ["call_id", "date_ms", "readable_date", "call_type", "contact_name", "number", "duration_s"]
+
+
+def get_call_values(call) -> tuple:
+    """
+    The values of a CallRecord, in CALL_LOG_FIELDS order
+    """
+    return (call.call_id, call.timestamp, call.readable_date, call.call_type, call.contact_name, call.number,
+            call.duration)
+
+
+class CallLogSink:
+    """
+    Writes the call log, handed over in batches of CallRecords in their final order, to a file in the output
+    directory. Any existing call log of the same format is replaced. Use it as a context manager.
+    """
+
+    extension = None
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, CALL_LOG_BASENAME + self.extension)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write_calls(self, calls: list) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonLinesCallLogSink(CallLogSink):
+    """
+    One JSON object per call and line
+    """
+
+    extension = ".jsonl"
+
+    def __init__(self, output_dir: str):
+        super().__init__(output_dir)
+        self.file = open(self.path, 'w', encoding='utf-8')
+
+    def write_calls(self, calls: list) -> None:
+        self.file.writelines(json.dumps(dict(zip(CALL_LOG_FIELDS, get_call_values(call))), ensure_ascii=False) + "\n"
+                             for call in calls)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SqliteCallLogSink(CallLogSink):
+    """
+    A "calls" table, with the call type as a reference into a "call_types" lookup table, and indexes on the call date
+    and number. The indexes are only built once all calls are in, which is much faster than maintaining them.
+    """
+
+    extension = ".sqlite"
+
+    def __init__(self, output_dir: str):
+        super().__init__(output_dir)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.connection = sqlite3.connect(self.path)
+        # Nothing to recover if writing fails halfway through, so skip the journal
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE call_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+        self.connection.execute("""CREATE TABLE calls (
+            call_id INTEGER PRIMARY KEY,
+            date_ms INTEGER NOT NULL,
+            readable_date TEXT,
+            call_type INTEGER NOT NULL REFERENCES call_types(id),
+            contact_name TEXT,
+            number TEXT,
+            duration_s INTEGER
+        )""")
+        # {call type name: id in call_types}
+        self.call_type_ids = dict()
+
+    def get_call_type_id(self, call_type: str) -> int:
+        if call_type not in self.call_type_ids:
+            self.call_type_ids[call_type] = len(self.call_type_ids) + 1
+            self.connection.execute("INSERT INTO call_types (id, name) VALUES (?, ?)",
+                                    (self.call_type_ids[call_type], call_type))
+
+        return self.call_type_ids[call_type]
+
+    def write_calls(self, calls: list) -> None:
+        self.connection.executemany(
+            "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(call.call_id, call.timestamp, call.readable_date, self.get_call_type_id(call.call_type),
+              call.contact_name, call.number, call.duration) for call in calls])
+
+    def close(self) -> None:
+        self.connection.execute("CREATE INDEX calls_date_ms ON calls (date_ms)")
+        self.connection.execute("CREATE INDEX calls_number ON calls (number)")
+        self.connection.commit()
+        self.connection.close()
+
+
+class ParquetCallLogSink(CallLogSink):
+    """
+    A Parquet file with one row group per batch. The call type is dictionary-encoded, i.e. stored as an enum.
+    Needs pyarrow.
+    """
+
+    extension = ".parquet"
+
+    def __init__(self, output_dir: str):
+        if pyarrow is None:
+            raise Exception("The parquet call log format needs pyarrow to be installed (pip install pyarrow)")
+
+        super().__init__(output_dir)
+        self.schema = pyarrow.schema([
+            ("call_id", pyarrow.int64()),
+            ("date_ms", pyarrow.int64()),
+            ("readable_date", pyarrow.string()),
+            ("call_type", pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+            ("contact_name", pyarrow.string()),
+            ("number", pyarrow.string()),
+            ("duration_s", pyarrow.int32()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+
+    def write_calls(self, calls: list) -> None:
+        columns = list(zip(*map(get_call_values, calls)))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
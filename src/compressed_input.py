@@ -0,0 +1,182 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import zipfile
+
+# Backup files compressed with one of these are decompressed on the fly while they are read,
+# e.g. "sms-20240101.xml.gz" is read as "sms-20240101.xml"
+DECOMPRESSORS = {
+    ".gz": lambda compressed_file: gzip.GzipFile(fileobj=compressed_file, mode='rb'),
+    ".xz": lzma.LZMAFile,
+    ".lzma": lzma.LZMAFile,
+    ".bz2": bz2.BZ2File,
+}
+
+# The members of a zip file in the input directory are read as if they were files in a directory of that name,
+# e.g. "input_dir/backups.zip/sms-20240101.xml"
+ZIP_SUFFIX = ".zip"
+
+
+def get_compression_suffix(path: str):
+    """
+    The suffix of the compression format of a (possibly compressed) backup file, None if it isn't compressed
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    return suffix if suffix in DECOMPRESSORS else None
+
+
+def get_backup_filename(path: str) -> str:
+    """
+    The filename of a backup file, without its compression suffix, e.g. "sms-20240101.xml" for
+    "input_dir/sms-20240101.xml.gz" or "input_dir/backups.zip/sms-20240101.xml"
+    """
+    filename = os.path.basename(path)
+    if get_compression_suffix(filename) is not None:
+        filename = os.path.splitext(filename)[0]
+    return filename
+
+
+def split_zip_member_path(path: str):
+    """
+    Returns (zip file path, member name) for the path of a zip file's member, None for any other path
+    """
+    zip_path, member_names = path, []
+    while not os.path.isfile(zip_path):
+        zip_path, member_name = os.path.split(zip_path)
+        if not member_name:
+            return None
+        member_names.insert(0, member_name)
+
+    if not member_names or not zip_path.lower().endswith(ZIP_SUFFIX):
+        return None
+
+    return zip_path, "/".join(member_names)
+
+
+def is_plain_file(path: str) -> bool:
+    """
+    Whether a backup file is stored as is, so it can be seeked in, memory-mapped, indexed...
+    """
+    return get_compression_suffix(path) is None and split_zip_member_path(path) is None
+
+
+def list_input_files(input_dir: str) -> list:
+    """
+    The paths of all files in input_dir, sorted, with every zip file replaced by the paths of its members (see
+    split_zip_member_path())
+    """
+    input_file_paths = []
+    for filename in sorted(os.listdir(input_dir)):
+        input_file_path = os.path.join(input_dir, filename)
+
+        if filename.lower().endswith(ZIP_SUFFIX) and zipfile.is_zipfile(input_file_path):
+            with zipfile.ZipFile(input_file_path) as input_zip:
+                input_file_paths.extend(os.path.join(input_file_path, *member_name.split("/"))
+                                        for member_name in sorted(input_zip.namelist())
+                                        if not member_name.endswith("/"))
+        else:
+            input_file_paths.append(input_file_path)
+
+    return input_file_paths
+
+
+def get_input_size(path: str) -> int:
+    """
+    The size of a backup file as it is stored, i.e. compressed, for a zip file's member too (the unit of the position
+    reported by tell() on a file returned by open_input())
+    """
+    zip_member = split_zip_member_path(path)
+    if zip_member is None:
+        return os.path.getsize(path)
+
+    zip_path, member_name = zip_member
+    with zipfile.ZipFile(zip_path) as input_zip:
+        return input_zip.getinfo(member_name).compress_size
+
+
+def get_input_signature(path: str) -> tuple:
+    """
+    (size, modification time in ns) of a backup file, or for a zip file's member, of the member (uncompressed) and
+    the zip file
+    """
+    zip_member = split_zip_member_path(path)
+    if zip_member is None:
+        return os.path.getsize(path), os.stat(path).st_mtime_ns
+
+    zip_path, member_name = zip_member
+    with zipfile.ZipFile(zip_path) as input_zip:
+        return input_zip.getinfo(member_name).file_size, os.stat(zip_path).st_mtime_ns
+
+
+class DecompressingFile(io.RawIOBase):
+    """
+    A read-only binary file that decompresses a compressed file as it is read. tell() reports the position reached in
+    the compressed file rather than in the decompressed data, so it can be compared to get_input_size().
+    A zip file's member (zip_info) only knows its position in its decompressed data, which is scaled down to its
+    compressed size.
+    """
+
+    def __init__(self, compressed_file, decompressed_file, zip_file: zipfile.ZipFile = None, zip_info: zipfile.ZipInfo = None):
+        super().__init__()
+        self.compressed_file = compressed_file
+        self.decompressed_file = decompressed_file
+        self.zip_file = zip_file
+        self.zip_info = zip_info
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self.decompressed_file.read(size)
+
+    def readinto(self, buffer) -> int:
+        return self.decompressed_file.readinto(buffer)
+
+    def tell(self) -> int:
+        position = self.compressed_file.tell()
+        if self.zip_info is not None and self.zip_info.file_size > 0:
+            return position * self.zip_info.compress_size // self.zip_info.file_size
+        return position
+
+    def close(self) -> None:
+        if not self.closed:
+            self.decompressed_file.close()
+            self.compressed_file.close()
+            if self.zip_file is not None:
+                self.zip_file.close()
+        super().close()
+
+
+def open_input(path: str):
+    """
+    Opens a backup file for reading in binary mode, decompressing it on the fly if needed. Plain files are opened as
+    is. path can also be the path of a zip file's member (see list_input_files()).
+    """
+    zip_member = split_zip_member_path(path)
+    compression_suffix = get_compression_suffix(path)
+
+    if zip_member is None and compression_suffix is None:
+        return open(path, 'rb')
+
+    zip_file, zip_info = None, None
+    if zip_member is None:
+        compressed_file = open(path, 'rb')
+    else:
+        zip_file = zipfile.ZipFile(zip_member[0])
+        zip_info = zip_file.getinfo(zip_member[1])
+        compressed_file = zip_file.open(zip_info)
+
+    if compression_suffix is None:
+        # A zip file's member is decompressed by the zip file itself
+        return DecompressingFile(compressed_file, compressed_file, zip_file, zip_info)
+
+    return DecompressingFile(compressed_file, DECOMPRESSORS[compression_suffix](compressed_file), zip_file, zip_info)
+
+
+def open_input_text(path: str):
+    """
+    Same as open_input(), but in text mode
+    """
+    return io.TextIOWrapper(open_input(path))
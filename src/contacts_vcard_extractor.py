@@ -1,88 +1,104 @@
+import contextlib
+import logging
 import os
 import random
 import string
 import sys
 
 # local
+from . import compressed_input
+from . import extraction_stats
+from . import progress_reporter
 from . import vcf_field_parser
 from . import vcard_multimedia_helper
 
+logger = logging.getLogger(__name__)
 
 # v2.1 and v3.0 require the first, v4.0 requires the second.
 # However, I've seen some created vCard files that have neither...
 CONTACT_ID_KEY, CONTACT_SECONDARY_ID_KEY = "N", "FN"
 
+VCARD_BEGIN_LINE, VCARD_END_LINE = "BEGIN:VCARD", "END:VCARD"
+# A line starting with one of these continues the previous line (RFC 6350, 3.2)
+FOLDING_WHITESPACE = (" ", "\t")
 
-def parse_vcard_line(file_line: str) -> dict:
+
+def iter_unfolded_lines(vcf_file):
     """
-    Takes the line of a VCF file, and extracts the property and value, returning it
+    Yields (line number, line) for the logical lines of a VCF file, unfolding them on the fly: a line starting with a
+    space or a tab is the continuation of the previous one, without that first character. The line number is the
+    one of the logical line's first line.
     """
+    line_parts = []
+    first_line_num = 0
 
-    print(f"[DEBUG] Parsing line | {file_line}")
+    for line_num, file_line in enumerate(vcf_file, 1):
+        file_line = file_line.rstrip("\r\n")
 
-    contact = dict()
+        if line_parts and file_line.startswith(FOLDING_WHITESPACE):
+            line_parts.append(file_line[1:])
+            continue
 
-    # This only works because none of the 'simple' key names is a substring of any other key name
-    if any([file_line.startswith(key) for key in vcf_field_parser.SIMPLE_KEYS]):
-        contact[key] = vcf_field_parser.parse_simple_tag(file_line)
+        if line_parts:
+            yield first_line_num, "".join(line_parts)
+        line_parts = [file_line]
+        first_line_num = line_num
 
-    # With the simple keys out of the way, parse the remaining keys
-    else:
-        if file_line.startswith("ADR"):
-            contact["ADR"] = vcf_field_parser.parse_address_tag(file_line)
+    if line_parts:
+        yield first_line_num, "".join(line_parts)
 
-        elif file_line.startswith("CATEGORIES"):
-            contact["CATEGORIES"] = vcf_field_parser.parse_categories_tag(
-                file_line)
 
-        elif file_line.startswith("CLIENTPIDMAP"):
-            contact["CLIENTPIDMAP"] = vcf_field_parser.parse_clientpidmap_tag(
-                file_line)
-
-        elif file_line.startswith("EMAIL"):
-            contact["EMAIL"] = vcf_field_parser.parse_email_tag(file_line)
+def iter_vcards(vcf_file):
+    """
+    Yields the property lines of the vCards of a VCF file, one vCard (the lines between BEGIN:VCARD and END:VCARD) at
+    a time, so memory is bounded by the largest contact rather than the whole file.
 
-        elif file_line.startswith("GEO"):
-            contact["GEO"] = vcf_field_parser.parse_geo_tag(file_line)
+    vCard 2.1 base64 data can also go on over lines that aren't folded, up to an empty line, so a line without a ':'
+    is added to the property before it.
+    """
+    vcard_lines = None
+    # The parts of the property line being read
+    property_parts = []
 
-        elif file_line.startswith("IMPP"):
-            contact["IMPP"] = vcf_field_parser.parse_instant_messenger_handle_tag(
-                file_line)
+    for line_num, vcf_line in iter_unfolded_lines(vcf_file):
+        vcf_line = vcf_line.strip()
 
-        elif file_line.startswith("LABEL"):
-            contact["LABEL"] = vcf_field_parser.parse_mailing_label_tag(
-                file_line)
+        if property_parts and (not vcf_line or vcf_line in (VCARD_BEGIN_LINE, VCARD_END_LINE)
+                               or vcf_field_parser.KEY_VALUE_SEPARATOR in vcf_line):
+            vcard_lines.append("".join(property_parts))
+            property_parts = []
 
-        elif file_line.startswith("MEMBER"):
-            contact["MEMBER"] = vcf_field_parser.parse_member_tag(file_line)
+        if vcf_line == VCARD_BEGIN_LINE:
+            if vcard_lines is not None:
+                logger.error("Missing end tag, at line %d", line_num)
+                sys.exit(1)
 
-        elif file_line.startswith("N"):
-            contact["N"] = vcf_field_parser.parse_name_tag(file_line)
+            vcard_lines = []
 
-        elif file_line.startswith("ORG"):
-            contact["ORG"] = vcf_field_parser.parse_organization_tag(file_line)
+        elif vcf_line == VCARD_END_LINE:
+            yield [] if vcard_lines is None else vcard_lines
+            vcard_lines = None
 
-        elif file_line.startswith("RELATED"):
-            contact["RELATED"] = vcf_field_parser.parse_related_tag(file_line)
+        elif vcard_lines is not None and vcf_line:
+            property_parts.append(vcf_line)
 
-        elif file_line.startswith("TEL"):
-            contact["TEL"] = vcf_field_parser.parse_telephone_tag(file_line)
 
-        elif file_line.startswith("UID"):
-            contact["UID"] = vcf_field_parser.parse_uuid_tag(file_line)
+def parse_vcard_line(file_line: str) -> dict:
+    """
+    Takes the line of a VCF file, and extracts the property and value, returning it
+    """
 
-        # The advanced key types
-        else:
-            multimedia_keys = vcard_multimedia_helper.get_advanced_key_names()
+    logger.debug("Parsing line | %s", file_line)
 
-            for key in multimedia_keys:
+    # One lookup in a table built once, instead of trying every property name on every line
+    property_name = vcf_field_parser.get_property_name(file_line)
+    property_parser = vcf_field_parser.PROPERTY_PARSERS.get(property_name)
 
-                if file_line.startswith(key):
-                    # Remove the actual tag name from the string that gets sent for parsing
-                    contact[key] = vcf_field_parser.parse_multimedia_tag(
-                        file_line[len(key):])
+    if property_parser is None:
+        logger.debug("Unknown property %s, ignored", property_name)
+        return dict()
 
-    return contact
+    return {property_name: property_parser(file_line)}
 
 
 def generate_multimedia_of_contact(contact: dict, output_dir: str):
@@ -108,92 +124,64 @@ def generate_multimedia_of_contact(contact: dict, output_dir: str):
         contact, os.path.join(output_dir, base_filename))
 
 
-def parse_contacts_from_vcf_files(vcf_files_dir: str, output_media_dir: str) -> None:
-
-    all_contacts = []
-
-    for filename in os.listdir(vcf_files_dir):
+def parse_contacts_from_vcf_files(vcf_files_dir: str, output_media_dir: str, stats: extraction_stats.ExtractionStats = None, show_progress: bool = False) -> None:
 
-        num_contacts_in_file = 0
+    if stats is None:
+        stats = extraction_stats.ExtractionStats("vcf")
 
-        print(f"[DEBUG] Parsing {filename}")
+    # Contacts are handled one at a time, and only counted
+    num_contacts = 0
 
-        if filename.endswith(".vcf"):
+    # .vcf files can be compressed, or inside zip files, too
+    vcf_file_paths = compressed_input.list_input_files(vcf_files_dir)
+    vcf_file_sizes = [compressed_input.get_input_size(vcf_file_path) for vcf_file_path in vcf_file_paths
+                      if compressed_input.get_backup_filename(vcf_file_path).endswith(".vcf")]
+    progress = progress_reporter.ProgressReporter(sum(vcf_file_sizes), len(vcf_file_sizes), "contacts") if show_progress else None
 
-            vcf_file_lines = []
+    with (progress if progress is not None else contextlib.nullcontext()):
+        for vcf_file_path in vcf_file_paths:
 
-            with open(os.path.join(vcf_files_dir, filename), 'r') as vcf_file_hndl:
-                vcf_file_lines = vcf_file_hndl.readlines()
+            filename = compressed_input.get_backup_filename(vcf_file_path)
 
-            curr_contact = dict()
-            currently_in_contact = False
-            has_multimedia = False
+            num_contacts_in_file = 0
 
-            line_num = 0
+            logger.debug("Parsing %s", filename)
 
-            while line_num < len(vcf_file_lines):
+            if filename.endswith(".vcf"):
 
-                line_content = vcf_file_lines[line_num]
+                vcf_file_size = compressed_input.get_input_size(vcf_file_path)
+                stats.count("files")
+                stats.count("input_bytes", vcf_file_size)
 
-                if (line_content.strip() == "BEGIN:VCARD"):
-                    if (currently_in_contact):
-                        print(f"[ERROR] Missing end tag, at line {line_num}")
-                        sys.exit(1)
+                with compressed_input.open_input_text(vcf_file_path) as vcf_file_hndl:
+                    if progress is not None:
+                        progress.start_file(vcf_file_path, vcf_file_size)
+                        progress.track(vcf_file_hndl.buffer.tell)
 
-                    else:
-                        currently_in_contact = True
+                    for vcard_lines in stats.timed_iter(iter_vcards(vcf_file_hndl), extraction_stats.PHASE_VCF_PARSE):
+                        curr_contact = dict()
+                        has_multimedia = False
 
-                elif (line_content.strip() == "END:VCARD"):
-                    currently_in_contact = False
-                    all_contacts.append(curr_contact)
-                    num_contacts_in_file += 1
-                    print(
-                        f"[DEBUG] End of Vcard reached! New contact added from file, # of contacts is now {num_contacts_in_file} (Total) {len(all_contacts)}")
-                    if has_multimedia:
-                        generate_multimedia_of_contact(
-                            curr_contact, output_media_dir)
+                        for vcard_line in vcard_lines:
+                            with stats.timed(extraction_stats.PHASE_VCF_PARSE):
+                                new_contact_info = parse_vcard_line(vcard_line)
 
-                    # Reset things for the next contact
-                    has_multimedia = False
-                    curr_contact = dict()
-
-                else:
-                    # TODO: I'd ideally, like NOT to have to rearrange the input file just to make parsing easier...
-                    # Check the "advanced" case first, then the simple case
-                    if (any([line_content.startswith(key) for key in vcard_multimedia_helper.get_advanced_key_names()])):
-
-                        has_multimedia = True
-
-                        multimedia_tag_line = line_content.strip()
-                        next_line_num = line_num + 1
-
-                        while (":" not in vcf_file_lines[next_line_num]):
-
-                            multimedia_tag_line += vcf_file_lines[next_line_num].strip(
-                            )
-
-                            # Empty line means done parsing
-                            if ((vcf_file_lines[next_line_num]) == ""):
-                                break
-
-                            next_line_num += 1
-
-                        new_contact_info = parse_vcard_line(
-                            multimedia_tag_line.strip())
-                        curr_contact.update(new_contact_info)
-                        line_num = next_line_num
-
-                        continue
-
-                    else:
-                        new_contact_info = parse_vcard_line(
-                            line_content.strip())
-
-                        if new_contact_info is not None:
                             curr_contact.update(new_contact_info)
-                        else:
-                            raise Exception(
-                                f"[ERROR] Couldn't parse file line #{line_num} : '{line_content}")
-
-                # Always increment!
-                line_num += 1
+                            has_multimedia = has_multimedia or any(
+                                key in new_contact_info for key in vcard_multimedia_helper.ADVANCED_KEY_NAMES)
+
+                        num_contacts += 1
+                        num_contacts_in_file += 1
+                        stats.count("records")
+                        if progress is not None:
+                            progress.add_items()
+                        logger.debug("End of Vcard reached! New contact added from file, # of contacts is now %d (Total) %d",
+                                     num_contacts_in_file, num_contacts)
+                        if has_multimedia:
+                            stats.count("contacts_with_media")
+                            with stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                                generate_multimedia_of_contact(
+                                    curr_contact, output_media_dir)
+
+                if progress is not None:
+                    progress.finish_file(vcf_file_size)
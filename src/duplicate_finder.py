@@ -0,0 +1,246 @@
+import collections
+import csv
+import hashlib
+import os
+import stat
+import time
+
+# locals
+from . import extraction_stats
+
+# Kept in the media directory itself, like the extraction manifest, so the cache travels with the media it describes
+HASH_CACHE_FILENAME = ".duplicate_hash_cache.tsv"
+HASH_CACHE_FIELDS = ["path", "size", "mtime_ns", "partial_hash", "full_hash"]
+
+# Files of the same size are first told apart by a hash of their beginning, which is all it takes for most of them.
+# Only files that still look alike after that are hashed in full.
+PARTIAL_HASH_BYTES = 64 * 1024
+HASH_BLOCK_BYTES = 1024 * 1024
+# BLAKE2b is faster than MD5 on 64-bit CPUs, and 16 bytes of it are plenty to compare files
+HASH_DIGEST_SIZE = 16
+
+MediaFile = collections.namedtuple("MediaFile", ["path", "rel_path", "size", "mtime_ns"])
+
+
+def get_hash_cache_path(media_dir: str) -> str:
+    return os.path.join(media_dir, HASH_CACHE_FILENAME)
+
+
+def list_media_files(media_dir: str) -> list:
+    """
+    Returns a MediaFile for every file under media_dir, in (sorted) directory order. Hidden files and directories (the extraction
+    manifest, this module's cache, a blob store) and symlinks are left out, and so are extra hardlinks to a file
+    already listed, as they don't take up any more space.
+    """
+    media_files = []
+    seen_inodes = set()
+
+    for dir_path, dir_names, filenames in os.walk(media_dir):
+        dir_names[:] = sorted(dir_name for dir_name in dir_names if not dir_name.startswith("."))
+
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+
+            file_path = os.path.join(dir_path, filename)
+            file_stat = os.lstat(file_path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in seen_inodes:
+                continue
+            seen_inodes.add(inode)
+
+            media_files.append(MediaFile(file_path, os.path.relpath(file_path, media_dir), file_stat.st_size,
+                                         file_stat.st_mtime_ns))
+
+    return media_files
+
+
+def get_file_digest(file_path: str, max_bytes: int = None, stats: extraction_stats.ExtractionStats = None) -> str:
+    """
+    The hex digest of a file's content, or of its first max_bytes bytes
+    """
+    hasher = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+    num_bytes = 0
+
+    with open(file_path, 'rb') as media_file:
+        while max_bytes is None or num_bytes < max_bytes:
+            block_size = HASH_BLOCK_BYTES if max_bytes is None else min(HASH_BLOCK_BYTES, max_bytes - num_bytes)
+            block = media_file.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+            num_bytes += len(block)
+
+    if stats is not None:
+        stats.count("bytes_hashed", num_bytes)
+    return hasher.hexdigest()
+
+
+class HashCache:
+    """
+    Remembers the hashes of the files of a media directory between runs, keyed by path, and only valid as long as
+    the file's size and modification time stay the same. Entries of files that weren't looked at (because they are
+    gone) are dropped on save(). Without a media_dir, hashes are only kept for the current run.
+    """
+
+    def __init__(self, media_dir: str = None):
+        self.cache_path = None if media_dir is None else get_hash_cache_path(media_dir)
+        # {relative path: [size, mtime_ns, partial hash, full hash]}, hashes are "" until computed
+        self.entries = dict()
+        self.used_paths = set()
+
+        if self.cache_path is not None and os.path.isfile(self.cache_path):
+            with open(self.cache_path, 'r', newline='', encoding='utf-8') as cache_file:
+                for row in csv.DictReader(cache_file, delimiter='\t'):
+                    self.entries[row["path"]] = [int(row["size"]), int(row["mtime_ns"]), row["partial_hash"],
+                                                 row["full_hash"]]
+
+    def get_entry(self, media_file: MediaFile) -> list:
+        self.used_paths.add(media_file.rel_path)
+
+        entry = self.entries.get(media_file.rel_path)
+        if entry is None or entry[0] != media_file.size or entry[1] != media_file.mtime_ns:
+            entry = [media_file.size, media_file.mtime_ns, "", ""]
+            self.entries[media_file.rel_path] = entry
+
+        return entry
+
+    def forget(self, media_file: MediaFile) -> None:
+        self.used_paths.discard(media_file.rel_path)
+
+    def save(self) -> None:
+        if self.cache_path is None:
+            return
+
+        temp_cache_path = self.cache_path + ".tmp"
+        with open(temp_cache_path, 'w', newline='', encoding='utf-8') as cache_file:
+            cache_writer = csv.writer(cache_file, delimiter='\t')
+            cache_writer.writerow(HASH_CACHE_FIELDS)
+            cache_writer.writerows([rel_path, *entry] for rel_path, entry in sorted(self.entries.items())
+                                   if rel_path in self.used_paths)
+
+        os.replace(temp_cache_path, self.cache_path)
+
+
+def get_cached_digest(media_file: MediaFile, partial: bool, hash_cache: HashCache,
+                      stats: extraction_stats.ExtractionStats) -> str:
+    """
+    The partial or full hash of a file, from hash_cache if it has it. A file no bigger than PARTIAL_HASH_BYTES is
+    hashed in full for its partial hash.
+    """
+    entry = hash_cache.get_entry(media_file)
+    if partial and media_file.size > PARTIAL_HASH_BYTES:
+        digest_index, max_bytes = 2, PARTIAL_HASH_BYTES
+    else:
+        digest_index, max_bytes = 3, None
+
+    if entry[digest_index]:
+        stats.count("hash_cache_hits")
+        return entry[digest_index]
+
+    stats.count("full_hashes" if max_bytes is None else "partial_hashes")
+    with stats.timed(extraction_stats.PHASE_DEDUP_HASH):
+        entry[digest_index] = get_file_digest(media_file.path, max_bytes, stats)
+    return entry[digest_index]
+
+
+def group_by(media_files: list, get_key) -> list:
+    """
+    Splits media_files into groups sharing the same get_key(media_file), keeping only the groups of more than one
+    file, in order
+    """
+    groups = collections.defaultdict(list)
+    for media_file in media_files:
+        groups[get_key(media_file)].append(media_file)
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicate_files(media_dir: str, hash_cache: HashCache = None, stats: extraction_stats.ExtractionStats = None) -> tuple:
+    """
+    Finds the files under media_dir (see list_media_files()) with identical content, in stages that each only look
+    at the candidates left by the previous one: files of the same size, then of the same partial hash (of their
+    first PARTIAL_HASH_BYTES), then of the same full hash. A file of unique size is never read.
+
+    Returns (empty files, groups of identical files). In each group the first file (in list_media_files() order) is
+    the original.
+    Hashes are looked up in, and added to, hash_cache.
+    """
+    if hash_cache is None:
+        hash_cache = HashCache()
+    if stats is None:
+        stats = extraction_stats.ExtractionStats()
+
+    media_files = list_media_files(media_dir)
+    stats.count("files", len(media_files))
+    stats.count("input_bytes", sum(media_file.size for media_file in media_files))
+
+    empty_files = [media_file for media_file in media_files if media_file.size == 0]
+
+    duplicate_groups = []
+    for size_group in group_by([media_file for media_file in media_files if media_file.size > 0],
+                               lambda media_file: media_file.size):
+        stats.count("size_candidates", len(size_group))
+        for partial_group in group_by(size_group, lambda media_file:
+                                      get_cached_digest(media_file, True, hash_cache, stats)):
+            if partial_group[0].size <= PARTIAL_HASH_BYTES:
+                # Hashed in full already
+                duplicate_groups.append(partial_group)
+                continue
+
+            duplicate_groups.extend(group_by(partial_group, lambda media_file:
+                                             get_cached_digest(media_file, False, hash_cache, stats)))
+
+    duplicate_groups.sort(key=lambda group: group[0].rel_path)
+    return empty_files, duplicate_groups
+
+
+def remove_duplicate_files(media_dir: str, dry_run: bool = False, use_cache: bool = True, stats: extraction_stats.ExtractionStats = None) -> int:
+    """
+    Removes the empty files, and all but the original of each group of identical files (see find_duplicate_files()),
+    under media_dir, returning their number. With dry_run, they are only listed, and nothing in media_dir changes.
+    With use_cache, the hashes are kept in media_dir (see HashCache), so the next run only hashes new or changed files.
+    A dry run only reads the cache, it doesn't save it.
+    """
+    if stats is None:
+        stats = extraction_stats.ExtractionStats("dedup")
+
+    start_time = time.time()
+    print("Looking for duplicates..." if dry_run else "Removing duplicates...", end="", flush=True)
+
+    hash_cache = HashCache(media_dir if use_cache else None)
+    empty_files, duplicate_groups = find_duplicate_files(media_dir, hash_cache, stats)
+
+    # {duplicate: its original}, None for empty files
+    duplicate_files = dict.fromkeys(empty_files)
+    for duplicate_group in duplicate_groups:
+        duplicate_files.update((media_file, duplicate_group[0]) for media_file in duplicate_group[1:])
+
+    for media_file in ([] if dry_run else duplicate_files):
+        try:
+            os.remove(media_file.path)
+        except OSError as e:
+            print(f"ERROR removing file {media_file.path}: {e}")
+            continue
+        hash_cache.forget(media_file)
+
+    if not dry_run:
+        hash_cache.save()
+    stats.count("duplicates", len(duplicate_files))
+    print("complete.", flush=True)
+
+    if dry_run:
+        for media_file, original_file in duplicate_files.items():
+            print(f"{media_file.rel_path}: "
+                  + ("empty" if original_file is None else f"duplicate of {original_file.rel_path}"))
+
+    print(f"{stats.counters['files']} files checked, {len(duplicate_files)} duplicates(or empty files) "
+          + ("found" if dry_run else "removed")
+          + f", {stats.counters['partial_hashes'] + stats.counters['full_hashes']} files hashed"
+          + f" ({stats.counters['hash_cache_hits']} hashes taken from the cache)"
+          + f". Time elapsed: {round(time.time() - start_time, 2)} seconds")
+
+    return len(duplicate_files)
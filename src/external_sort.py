@@ -0,0 +1,102 @@
+import heapq
+import pickle
+import tempfile
+
+# locals
+from . import extraction_stats
+
+# How many records are sorted in memory before they are spilled to disk as a sorted run
+DEFAULT_MAX_RECORDS_IN_MEMORY = 500000
+# Records pickled together in a spilled run. Merging keeps one batch per run in memory.
+SPILL_BATCH_RECORDS = 1000
+# Every spilled run is a temporary file kept open until the merge, so runs of less than a batch would only run out of
+# file descriptors sooner
+MIN_RECORDS_IN_MEMORY = SPILL_BATCH_RECORDS
+
+
+def write_record_batches(records: list, out_file) -> None:
+    """
+    Pickles records into an open (binary) file, SPILL_BATCH_RECORDS at a time
+    """
+    for offset in range(0, len(records), SPILL_BATCH_RECORDS):
+        pickle.dump(records[offset:offset + SPILL_BATCH_RECORDS], out_file, pickle.HIGHEST_PROTOCOL)
+
+
+def iter_record_batches(in_file):
+    """
+    Yields the records written by write_record_batches(), reading one batch at a time
+    """
+    while True:
+        try:
+            batch = pickle.load(in_file)
+        except EOFError:
+            return
+        yield from batch
+
+
+class ExternalSorter:
+    """
+    Sorts more records than fit in memory. Records are collected until max_records_in_memory is reached, then sorted
+    and spilled to an (anonymous) temporary file as a sorted run. iter_sorted() k-way merges the runs, and whatever
+    is still in memory, so memory use stays at max_records_in_memory records plus one batch per run.
+
+    Records must be picklable. The sort is stable: records with equal keys come out in the order they were added.
+
+    Use it as a context manager, so the temporary files are closed (and deleted) in any case. Time spent sorting
+    is added to stats, if given. max_records_in_memory can't be less than MIN_RECORDS_IN_MEMORY.
+    """
+
+    def __init__(self, key, max_records_in_memory: int = DEFAULT_MAX_RECORDS_IN_MEMORY, temp_dir: str = None, stats: extraction_stats.ExtractionStats = None):
+        if max_records_in_memory < MIN_RECORDS_IN_MEMORY:
+            raise ValueError(f"Can't sort less than {MIN_RECORDS_IN_MEMORY} records in memory, got {max_records_in_memory}")
+
+        self.key = key
+        self.max_records_in_memory = max_records_in_memory
+        self.temp_dir = temp_dir
+        self.stats = extraction_stats.ExtractionStats() if stats is None else stats
+        self.records = []
+        self.run_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def add(self, record) -> None:
+        self.records.append(record)
+        if len(self.records) >= self.max_records_in_memory:
+            self.spill()
+
+    def spill(self) -> None:
+        with self.stats.timed(extraction_stats.PHASE_SORT):
+            self.records.sort(key=self.key)
+
+            run_file = tempfile.TemporaryFile(dir=self.temp_dir)
+            write_record_batches(self.records, run_file)
+            run_file.seek(0)
+
+        self.stats.count("sort_runs_spilled")
+        self.run_files.append(run_file)
+        self.records = []
+
+    def iter_sorted(self):
+        """
+        Yields all the records added, in order. Can only be called once.
+        """
+        with self.stats.timed(extraction_stats.PHASE_SORT):
+            self.records.sort(key=self.key)
+
+        if not self.run_files:
+            yield from self.records
+            return
+
+        # heapq.merge() prefers the earlier iterable on equal keys, and the runs are in the order they were added
+        yield from heapq.merge(*[iter_record_batches(run_file) for run_file in self.run_files], self.records, key=self.key)
+
+    def close(self) -> None:
+        for run_file in self.run_files:
+            run_file.close()
+        self.run_files = []
+        self.records = []
@@ -0,0 +1,54 @@
+import csv
+import os
+
+# Kept in the output directory itself, so the manifest always travels with the media it describes
+MANIFEST_FILENAME = ".sms_extraction_manifest.tsv"
+MANIFEST_FIELDS = ["date", "address", "cl", "encoded_length", "hash", "filename"]
+
+
+def get_manifest_path(output_media_dir: str) -> str:
+    return os.path.join(output_media_dir, MANIFEST_FILENAME)
+
+
+def is_manifest_file(filename: str) -> bool:
+    return filename == MANIFEST_FILENAME
+
+
+def get_manifest_key(date: str, address: str, cl: str, encoded_length: int) -> tuple:
+    """
+    Identifies an attachment without having to decode it. The length of the (still encoded) payload tells apart
+    different attachments of the same message that happen to share a content location.
+    """
+    return (date, address, cl, str(encoded_length))
+
+
+def load_manifest(output_media_dir: str) -> dict:
+    """
+    Returns {manifest key: content hash} for every attachment handled by a previous run
+    """
+    known_parts = dict()
+    manifest_path = get_manifest_path(output_media_dir)
+
+    if not os.path.isfile(manifest_path):
+        return known_parts
+
+    with open(manifest_path, 'r', newline='', encoding='utf-8') as manifest_file:
+        for row in csv.DictReader(manifest_file, delimiter='\t'):
+            known_parts[get_manifest_key(row["date"], row["address"], row["cl"], row["encoded_length"])] = row["hash"]
+
+    return known_parts
+
+
+def append_manifest_entries(output_media_dir: str, manifest_entries: list) -> None:
+    """
+    Adds (date, address, cl, encoded length, hash, filename) entries to the manifest. The filename is relative to the
+    output directory, and empty for attachments that weren't written (duplicates, or empty attachments).
+    """
+    manifest_path = get_manifest_path(output_media_dir)
+    write_header = not os.path.isfile(manifest_path)
+
+    with open(manifest_path, 'a', newline='', encoding='utf-8') as manifest_file:
+        manifest_writer = csv.writer(manifest_file, delimiter='\t')
+        if write_header:
+            manifest_writer.writerow(MANIFEST_FIELDS)
+        manifest_writer.writerows(manifest_entries)
@@ -0,0 +1,176 @@
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there
+    resource = None
+
+# Phases the time of an extraction is broken down into
+PHASE_XML_PARSE = "xml_parse"
+PHASE_BASE64_DECODE = "base64_decode"
+PHASE_DEDUP_HASH = "dedup_hash"
+PHASE_FILE_WRITE = "file_write"
+PHASE_CLEANUP = "cleanup"
+PHASE_SORT = "sort"
+PHASE_VCF_PARSE = "vcf_parse"
+
+# Number of allocation sites reported with --trace-memory
+TRACEMALLOC_TOP_ALLOCATIONS = 25
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process, or of the largest of its (finished) worker processes, in MB
+    """
+    if resource is None:
+        return None
+
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Reported in bytes on macOS, and in kilobytes everywhere else
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class ExtractionStats:
+    """
+    Collects per-phase timings and counters of an extraction run. Safe to share between threads; worker processes
+    collect their own, which are combined with merge().
+
+    Phase times are summed over all threads, so with several decode threads they can add up to more than the
+    run's wall clock time.
+    """
+
+    def __init__(self, extractor: str = ""):
+        self.extractor = extractor
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+        self.phase_seconds = collections.Counter()
+        self.counters = collections.Counter()
+        # Attachments (or calls, contacts...) handled per MIME type (or call type...), and skipped by the filters
+        self.content_types = collections.Counter()
+        self.skipped_content_types = collections.Counter()
+        self.memory_snapshot = None
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.phase_seconds[phase] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, phase: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start_time)
+
+    def timed_iter(self, iterable, phase: str):
+        """
+        Passes through the items of iterable, counting the time spent producing them towards phase
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.perf_counter() - start_time)
+                return
+            self.add_time(phase, time.perf_counter() - start_time)
+            yield item
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] += amount
+
+    def count_content_type(self, content_type: str) -> None:
+        with self.lock:
+            self.content_types[content_type] += 1
+
+    def count_skipped(self, content_type: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters["skipped_by_filter"] += amount
+            self.skipped_content_types[content_type] += amount
+
+    def to_dict(self) -> dict:
+        """
+        The collected numbers as plain dicts, e.g. to send them back from a worker process
+        """
+        with self.lock:
+            return {"phase_seconds": dict(self.phase_seconds), "counters": dict(self.counters),
+                    "content_types": dict(self.content_types),
+                    "skipped_content_types": dict(self.skipped_content_types)}
+
+    def merge(self, stats_dict: dict) -> None:
+        with self.lock:
+            self.phase_seconds.update(stats_dict["phase_seconds"])
+            self.counters.update(stats_dict["counters"])
+            self.content_types.update(stats_dict["content_types"])
+            self.skipped_content_types.update(stats_dict["skipped_content_types"])
+
+    def get_report(self) -> dict:
+        wall_seconds = time.perf_counter() - self.start_time
+        stats_dict = self.to_dict()
+        counters = stats_dict["counters"]
+
+        def per_second(amount, seconds):
+            return round(amount / seconds, 2) if seconds else None
+
+        phase_seconds = stats_dict["phase_seconds"]
+        report = {
+            "extractor": self.extractor,
+            "wall_seconds": round(wall_seconds, 4),
+            "input_bytes_per_s": per_second(counters.get("input_bytes", 0), wall_seconds),
+            "records_per_s": per_second(counters.get("records", 0), wall_seconds),
+            "phases": {phase: {"seconds": round(seconds, 4), "share_of_wall": round(seconds / wall_seconds, 4)}
+                       for phase, seconds in sorted(phase_seconds.items())},
+            "decode_bytes_per_s": per_second(counters.get("bytes_decoded", 0), phase_seconds.get(PHASE_BASE64_DECODE)),
+            "write_bytes_per_s": per_second(counters.get("bytes_written", 0), phase_seconds.get(PHASE_FILE_WRITE)),
+            "counters": counters,
+            "content_types": stats_dict["content_types"],
+            "skipped_content_types": stats_dict["skipped_content_types"],
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+
+        if self.memory_snapshot is not None:
+            report["top_allocations"] = [
+                {"location": str(statistic.traceback), "size_bytes": statistic.size, "count": statistic.count}
+                for statistic in self.memory_snapshot.statistics("lineno")[:TRACEMALLOC_TOP_ALLOCATIONS]]
+
+        return report
+
+    def write_json(self, stats_path: str) -> None:
+        with open(stats_path, "w") as stats_file:
+            json.dump(self.get_report(), stats_file, indent=2)
+
+
+@contextlib.contextmanager
+def profiling(stats: ExtractionStats, profile_path: str = None, trace_memory: bool = False):
+    """
+    Optionally runs the enclosed code under cProfile (written to profile_path, for pstats/snakeviz) and/or
+    tracemalloc (the top allocation sites end up in the stats report). Only the main process is covered.
+    """
+    profiler = cProfile.Profile() if profile_path else None
+
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if trace_memory:
+            stats.memory_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
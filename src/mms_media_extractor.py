@@ -1,13 +1,30 @@
-import base64
+import binascii
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import hashlib
 import lxml.etree
+import mmap
 import os
-import random
+import queue
+import re
 import string
-import sys
+import tempfile
+import threading
 import time
 
+# locals
+from . import backup_archive
+from . import backup_index as backup_index_helper
+from . import compressed_input
+from . import extraction_manifest
+from . import extraction_stats
+from . import output_archive as output_archive_helper
+from . import output_layout
+from . import progress_reporter
+from . import record_filter as record_filter_helper
+
 # Constants
 MAX_FILENAME_LENGTH = 200
 MAX_FULLPATH_LENGTH = 252
@@ -18,6 +35,38 @@ VIDEO_SUBTYPES = {"3gpp", "avi", "mp4", "mpeg", "ogg", "quicktime", "webm", "x-m
 AUDIO_SUBTYPES = {"3gpp", "amr", "flac", "mp4", "mpeg", "ogg", "webm", "wav"}
 APPLICATION_SUBTYPES = {"pdf"}
 
+# Number of base64 characters decoded at a time. Must be a multiple of 4 so that every
+# block (except the last) decodes on its own, without needing bytes from the next block.
+BASE64_BLOCK_CHARS = 4 * 64 * 1024
+BASE64_WHITESPACE = b" \t\r\n"
+
+# How many parsed attachments may wait for each decode thread, this bounds the pipeline's memory use
+PIPELINE_QUEUE_RECORDS_PER_THREAD = 2
+
+# Attachments are decoded (and hashed) in memory first, up to this size, as whether one is a duplicate is only known
+# once it is hashed: a duplicate never reaches the output directory. Bigger ones spill to an anonymous temporary file.
+DECODE_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+COPY_BLOCK_BYTES = 1024 * 1024
+
+# Fast scan mode: how much of the backup file is searched for <mms> messages at a time
+FAST_SCAN_CHUNK_BYTES = 1024 * 1024
+MMS_START_TAG = b"<mms"
+MMS_END_TAG = b"</mms>"
+# Bytes that can follow the tag name in a start tag (as ints, since indexing bytes returns ints)
+MMS_START_TAG_TERMINATORS = frozenset(b" \t\r\n/>")
+
+# How backup files are parsed: 'lxml' parses them as XML, 'scan' finds the <mms> and <part> tags and their attributes
+# straight in the bytes of the memory-mapped file
+PARSE_ENGINES = ["lxml", "scan"]
+DEFAULT_PARSE_ENGINE = "lxml"
+SCAN_MMS_START_PATTERN = re.compile(rb"<mms[\s/>]")
+# Inside a message: the start of a <part>, the end of the message, or markup the scan engine doesn't handle (comments,
+# CDATA, processing instructions), which gets the message handed to lxml instead
+SCAN_MESSAGE_MARKUP_PATTERN = re.compile(rb"<part[\s/>]|</mms>|<[!?]")
+SCAN_TAG_NAME_PATTERN = re.compile(rb"<[\w:-]+")
+SCAN_ATTRIBUTE_PATTERN = re.compile(rb"""\s+([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+SCAN_TAG_END_PATTERN = re.compile(rb"\s*(/?)>")
+
 def get_datetime_from_epoch_milliseconds(epoch_milliseconds: str) -> str:
     return datetime.datetime.fromtimestamp(int(epoch_milliseconds) / 1000).strftime('%Y%m%d-%H%M%S')
 
@@ -38,17 +87,80 @@ def safe_filename(base_dir: str, filename: str, max_len=MAX_FILENAME_LENGTH) ->
 
     return short_filename
 
-def handle_duplicate_name(base_dir: str, safe_filename: str) -> str:
-    safe_filename_base, safe_filename_ext = os.path.splitext(safe_filename)
-    unique_output_file = os.path.join(base_dir, safe_filename)
-    i = 0
-    while os.path.exists(unique_output_file):
-        i += 1
-        unique_output_file = os.path.join(base_dir, f"{safe_filename_base}-{i}{safe_filename_ext}")
+def iter_base64_blocks(data, block_chars: int = BASE64_BLOCK_CHARS):
+    """
+    Decodes a base64 string, or bytes-like object (e.g. a memoryview of the backup file), a fixed-size block at a
+    time, yielding the decoded bytes of each block.
+    Only one block is alive at any point, so memory stays flat regardless of the attachment size.
+    """
+    carry = b""
+    for offset in range(0, len(data), block_chars):
+        block = data[offset:offset + block_chars]
+        encoded = (block.encode('ascii') if isinstance(block, str) else bytes(block)).translate(None, BASE64_WHITESPACE)
+        if carry:
+            encoded = carry + encoded
+
+        # Line-wrapped payloads can leave a partial 4-character group at the end of a block,
+        # hold it back until the next block arrives
+        usable_len = len(encoded) - (len(encoded) % 4)
+        carry = encoded[usable_len:]
+        if usable_len:
+            yield binascii.a2b_base64(encoded[:usable_len])
+
+    if carry:
+        # Unpadded trailing group, let the decoder deal with it the same way base64.b64decode() would
+        yield binascii.a2b_base64(carry)
+
+
+def decode_base64_to_file(data, out_f, stats: extraction_stats.ExtractionStats = None) -> tuple:
+    """
+    Decodes base64 data into an open (binary) file, hashing it on the way, returning the MD5 digest and size of the
+    decoded bytes
+    """
+    if stats is None:
+        stats = extraction_stats.ExtractionStats()
+
+    hasher = hashlib.md5()
+    num_bytes = 0
+    for block in stats.timed_iter(iter_base64_blocks(data), extraction_stats.PHASE_BASE64_DECODE):
+        with stats.timed(extraction_stats.PHASE_DEDUP_HASH):
+            hasher.update(block)
+        out_f.write(block)
+        num_bytes += len(block)
+
+    stats.count("bytes_decoded", num_bytes)
+    return hasher.hexdigest(), num_bytes
+
 
-    return unique_output_file
+def copy_decoded_payload(payload_file, out_f, stats: extraction_stats.ExtractionStats = None) -> int:
+    """
+    Writes an attachment decoded by decode_base64_to_file() into an open (binary) file, returning the number of
+    bytes written
+    """
+    if stats is None:
+        stats = extraction_stats.ExtractionStats()
 
-def is_valid_output_directory(output_media_dir: str) -> bool:
+    payload_file.seek(0)
+    with stats.timed(extraction_stats.PHASE_FILE_WRITE):
+        num_bytes = 0
+        while block := payload_file.read(COPY_BLOCK_BYTES):
+            out_f.write(block)
+            num_bytes += len(block)
+
+    stats.count("bytes_written", num_bytes)
+    return num_bytes
+
+
+def get_fallback_content_location(payload_hash: str, ct_subtype: str) -> str:
+    """
+    Name for attachments without a usable content location: 10 letters derived from the attachment's
+    content hash, so re-running an extraction always produces the same names
+    """
+    return "".join(string.ascii_letters[b % len(string.ascii_letters)]
+                   for b in bytes.fromhex(payload_hash)[:10]) + f".{ct_subtype}"
+
+
+def is_valid_output_directory(output_media_dir: str, incremental: bool = False) -> bool:
     if not os.path.exists(output_media_dir):
         os.makedirs(output_media_dir, exist_ok=False)
         return True
@@ -57,6 +169,10 @@ def is_valid_output_directory(output_media_dir: str) -> bool:
         print(f"Error: OUTPUT_DIR is not a directory.")
         return False
 
+    if incremental:
+        # Adding to the media extracted by previous runs
+        return True
+
     with os.scandir(output_media_dir) as entries:
         if any(entries):
             print(f"Error: OUTPUT_DIR is not empty.")
@@ -64,12 +180,827 @@ def is_valid_output_directory(output_media_dir: str) -> bool:
 
     return True
 
-def reconstruct_mms_media(sms_xml_dir: str, output_media_dir: str, process_image: bool, process_video: bool, process_audio: bool, process_pdf: bool) -> None:
-    if not is_valid_output_directory(output_media_dir):
+# A lightweight, parser-independent view of one <part> attachment, and the <mms> message it belongs to
+AttachmentRecord = collections.namedtuple("AttachmentRecord", ["date", "address", "cl", "ct", "data"])
+
+# What extract_media_from_sms_file() found in one backup file
+FileExtractionResult = collections.namedtuple("FileExtractionResult", [
+    "orig_files_count", "num_dup_files", "num_previously_extracted", "written_files", "manifest_entries", "stats"])
+
+
+def is_extracted_content_type(ct_value: str, content_flags: tuple) -> bool:
+    """
+    Checks a (lowercase) MIME type against the types being extracted.
+    content_flags is the (process_image, process_video, process_audio, process_pdf) tuple.
+    """
+    process_image, process_video, process_audio, process_pdf = content_flags
+
+    # Get MIME descrete-type/sub-type
+    ct_type, _, ct_subtype = ct_value.partition('/')
+
+    if not (ct_type in CONTENT_TYPES):
+        # not an image/video/audio/application file. Skip it
+        return False
+
+    if (ct_type == 'image' and (not process_image or ct_subtype not in IMAGE_SUBTYPES)):
+        # skip this image file because we aren't extracting images, or it's an unsupported image subtype
+        return False
+    elif (ct_type == 'video' and (not process_video or ct_subtype not in VIDEO_SUBTYPES)):
+        # skip this video file because we aren't extracting videos, or it's an unsupported video subtype
+        return False
+    elif (ct_type == 'audio' and (not process_audio or ct_subtype not in AUDIO_SUBTYPES)):
+        # skip this audio file because we aren't extracting audio, or it's an unsupported audio subtype
+        return False
+    elif (ct_type == 'application' and (not process_pdf or ct_subtype not in APPLICATION_SUBTYPES)):
+        # skip this PDF file because we aren't extracting PDF, or it's an unsupported application subtype
+        return False
+
+    return True
+
+
+def is_selected_attachment(record: AttachmentRecord, record_filter: record_filter_helper.RecordFilter = None) -> bool:
+    """
+    Whether record_filter, if any, selects the attachment. Its size is judged by its encoded data, without
+    decoding it.
+    """
+    return record_filter is None or (record_filter.selects_record(record.date, record.address)
+                                     and record_filter.selects_payload(record.data))
+
+
+def iter_attachment_records(file_path: str, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Parses an sms*.xml backup file, yielding an AttachmentRecord for every attachment that should be extracted, i.e.
+    of one of the content types being extracted and, if given, selected by record_filter. Parts that aren't extracted
+    are counted in stats, if given. The read position in the file is tracked by progress, if given.
+    """
+    with compressed_input.open_input(file_path) as xml_file:
+        if progress is not None:
+            progress.track(xml_file.tell)
+
+        context = lxml.etree.iterparse(
+            xml_file,
+            events=('end',),
+            huge_tree=True,
+            recover=True
+        )
+
+        for event, elem in context:
+            if elem.tag == 'part':
+                ct_value = elem.get('ct', '').lower()
+
+                if is_extracted_content_type(ct_value, content_flags):
+                    # if we get here, then we have a image/video/audio attachment to process
+                    parent_parts = elem.getparent()  # <parts>
+                    if parent_parts is not None:
+                        mms_node = parent_parts.getparent()  # <mms>
+                        if mms_node is not None:
+                            record = AttachmentRecord(mms_node.get('date', ''), mms_node.get('address', ''),
+                                                      elem.get('cl', ''), ct_value, elem.get('data', ''))
+                            if is_selected_attachment(record, record_filter):
+                                yield record
+                            elif stats is not None:
+                                stats.count("filtered_out")
+                elif stats is not None:
+                    stats.count_skipped(ct_value)
+
+            # Free memory by clearing processed element
+            elem.clear()
+            # Option A: remove from parent
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+
+        # Done parsing this file
+        del context
+
+
+def iter_mms_regions(xml_file):
+    """
+    Reads an (open, binary) sms*.xml backup file, yielding only the bytes from each "<mms" start tag up to and
+    including its "</mms>" end tag. Everything in between messages, i.e. the plain <sms> records, is skipped over with
+    a byte search and never reaches the XML parser.
+
+    A raw '<' can't appear inside XML attribute values or text (it would be escaped as "&lt;"), so "<mms" and
+    "</mms>" can only ever match actual tags.
+    """
+    in_mms = False
+    buf = b""
+
+    while True:
+        chunk = xml_file.read(FAST_SCAN_CHUNK_BYTES)
+        if not chunk:
+            if in_mms and buf:
+                yield buf
+            return
+
+        buf = buf + chunk if buf else chunk
+
+        while True:
+            if not in_mms:
+                start_idx = buf.find(MMS_START_TAG)
+                if start_idx < 0 or start_idx + len(MMS_START_TAG) >= len(buf):
+                    # Keep just enough bytes to catch a start tag that is split across two chunks
+                    keep_from = len(buf) - len(MMS_START_TAG) if start_idx < 0 else start_idx
+                    buf = buf[max(keep_from, 0):]
+                    break
+
+                # Make sure it really is <mms>, and not some other tag that starts the same way
+                if buf[start_idx + len(MMS_START_TAG)] in MMS_START_TAG_TERMINATORS:
+                    in_mms = True
+                    buf = buf[start_idx:]
+                else:
+                    buf = buf[start_idx + len(MMS_START_TAG):]
+            else:
+                end_idx = buf.find(MMS_END_TAG)
+                if end_idx < 0:
+                    # Hand over everything except a possibly split end tag
+                    if len(buf) > len(MMS_END_TAG):
+                        yield buf[:-len(MMS_END_TAG)]
+                        buf = buf[-len(MMS_END_TAG):]
+                    break
+
+                end_idx += len(MMS_END_TAG)
+                yield buf[:end_idx]
+                buf = buf[end_idx:]
+                in_mms = False
+
+
+class MmsPartCollector:
+    """
+    lxml parser target that turns <part> start tags inside an <mms> into AttachmentRecords. No elements are ever
+    built, and the message's date and address are read (and checked against record_filter) once per <mms> rather
+    than once per part.
+    """
+
+    def __init__(self, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, record_filter: record_filter_helper.RecordFilter = None):
+        self.content_flags = content_flags
+        self.stats = stats
+        self.record_filter = record_filter
+        self.records = []
+        # None while not inside an <mms>
+        self.mms_date = None
+        self.mms_address = None
+        self.mms_selected = True
+
+    def start(self, tag, attrib):
+        if tag == 'part':
+            if self.mms_date is not None:
+                ct_value = attrib.get('ct', '').lower()
+                if not is_extracted_content_type(ct_value, self.content_flags):
+                    if self.stats is not None:
+                        self.stats.count_skipped(ct_value)
+                elif self.mms_selected and (self.record_filter is None
+                                            or self.record_filter.selects_payload(attrib.get('data', ''))):
+                    self.records.append(AttachmentRecord(self.mms_date, self.mms_address,
+                                                         attrib.get('cl', ''), ct_value, attrib.get('data', '')))
+                elif self.stats is not None:
+                    self.stats.count("filtered_out")
+        elif tag == 'mms':
+            self.mms_date = attrib.get('date', '')
+            self.mms_address = attrib.get('address', '')
+            self.mms_selected = (self.record_filter is None
+                                 or self.record_filter.selects_record(self.mms_date, self.mms_address))
+
+    def end(self, tag):
+        if tag == 'mms':
+            self.mms_date = None
+            self.mms_address = None
+
+    def close(self):
+        return None
+
+
+def iter_attachment_records_from_regions(mms_regions, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Feeds raw <mms> messages (in as many pieces as needed) to a MmsPartCollector, yielding the attachment records found
+    """
+    collector = MmsPartCollector(content_flags, stats, record_filter)
+    parser = lxml.etree.XMLParser(target=collector, huge_tree=True, recover=True)
+
+    # The messages are fed on their own, without the document's root element, so wrap them in one
+    parser.feed(b"<smses>")
+    for mms_region in mms_regions:
+        parser.feed(mms_region)
+
+        if collector.records:
+            yield from collector.records
+            collector.records = []
+
+    parser.feed(b"</smses>")
+    parser.close()
+    yield from collector.records
+
+
+def iter_attachment_records_fast_scan(file_path: str, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as iter_attachment_records(), but only the <mms> messages of the file are parsed at all
+    """
+    with compressed_input.open_input(file_path) as xml_file:
+        if progress is not None:
+            progress.track(xml_file.tell)
+        yield from iter_attachment_records_from_regions(iter_mms_regions(xml_file), content_flags, stats, record_filter)
+
+
+def iter_attachment_records_indexed(file_path: str, content_flags: tuple, backup_index: backup_index_helper.BackupIndex, stats: extraction_stats.ExtractionStats = None, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as iter_attachment_records(), but using the file's sidecar index to seek straight to the <mms> messages
+    that have attachments (and that record_filter selects, by the date and address in the index). Parts of messages
+    that aren't read at all aren't counted as skipped.
+    """
+    mms_index_records = (index_record for index_record in backup_index.iter_records('mms', record_filter)
+                         if index_record[5] > 0)
+
+    with open(file_path, 'rb') as xml_file:
+        if progress is not None:
+            progress.track(xml_file.tell)
+        yield from iter_attachment_records_from_regions(
+            backup_index_helper.iter_indexed_record_bytes(xml_file, mms_index_records, FAST_SCAN_CHUNK_BYTES),
+            content_flags, stats, record_filter)
+
+
+def scan_start_tag(xml_bytes, tag_start: int):
+    """
+    Reads the start tag at tag_start in a single pass, finding its end and the (start, end) span of each of its
+    attribute values, without copying any of them. Returns (end of the tag, {attribute name: value span}, whether the
+    element is empty), or None if it isn't a well-formed start tag.
+    """
+    name_match = SCAN_TAG_NAME_PATTERN.match(xml_bytes, tag_start)
+    if name_match is None:
+        return None
+
+    position = name_match.end()
+    value_spans = dict()
+    while True:
+        attribute_match = SCAN_ATTRIBUTE_PATTERN.match(xml_bytes, position)
+        if attribute_match is None:
+            break
+        value_group = 2 if attribute_match.start(2) != -1 else 3
+        value_spans[attribute_match.group(1)] = attribute_match.span(value_group)
+        position = attribute_match.end()
+
+    end_match = SCAN_TAG_END_PATTERN.match(xml_bytes, position)
+    if end_match is None:
+        return None
+
+    return end_match.end(), value_spans, end_match.group(1) == b"/"
+
+
+def get_scanned_attribute(xml_bytes, value_spans: dict, name: bytes) -> str:
+    """
+    The value of a scanned attribute, read the way lxml reads it (see backup_index.unescape_xml_attribute()), "" if
+    the tag doesn't have it. None if only lxml can make sense of it.
+    """
+    if name not in value_spans:
+        return ""
+
+    value_start, value_end = value_spans[name]
+    return backup_index_helper.unescape_xml_attribute(xml_bytes[value_start:value_end].decode('utf-8', 'replace'))
+
+
+def get_scanned_payload(xml_bytes, xml_view: memoryview, value_spans: dict):
+    """
+    The base64 data of a scanned <part>, as a memoryview of the file's bytes. Base64 doesn't need escaping, so the
+    value is only copied (to resolve them) if it does contain entities, e.g. encoded line breaks. None if only lxml
+    can make sense of them.
+    """
+    if b'data' not in value_spans:
+        return ""
+
+    value_start, value_end = value_spans[b'data']
+    if xml_bytes.find(b"&", value_start, value_end) != -1:
+        return backup_index_helper.unescape_xml_attribute(xml_bytes[value_start:value_end].decode('ascii', 'replace'))
+
+    return xml_view[value_start:value_end]
+
+
+def scan_mms_message(xml_bytes, xml_view: memoryview, mms_start: int, content_flags: tuple, stats: extraction_stats.ExtractionStats, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Scans the <mms> message starting at mms_start for attachments, see iter_attachment_records_scan().
+    Returns (the end of the message, its attachment records), or None if the message has to be parsed as XML.
+    """
+    mms_tag = scan_start_tag(xml_bytes, mms_start)
+    if mms_tag is None:
+        return None
+
+    mms_tag_end, mms_value_spans, is_empty = mms_tag
+    if is_empty:
+        return mms_tag_end, []
+
+    mms_date = get_scanned_attribute(xml_bytes, mms_value_spans, b'date')
+    mms_address = get_scanned_attribute(xml_bytes, mms_value_spans, b'address')
+    if mms_date is None or mms_address is None:
+        return None
+    mms_selected = record_filter is None or record_filter.selects_record(mms_date, mms_address)
+
+    records = []
+    position = mms_tag_end
+    while True:
+        # Only the bytes in between tags are searched, a raw '<' can't appear inside attribute values
+        markup_match = SCAN_MESSAGE_MARKUP_PATTERN.search(xml_bytes, position)
+        if markup_match is None or markup_match.group()[1] in b"!?":
+            return None
+        if markup_match.group() == MMS_END_TAG:
+            return markup_match.end(), records
+
+        part_tag = scan_start_tag(xml_bytes, markup_match.start())
+        if part_tag is None:
+            return None
+
+        position, part_value_spans, _ = part_tag
+        ct_value = get_scanned_attribute(xml_bytes, part_value_spans, b'ct')
+        if ct_value is None:
+            return None
+        ct_value = ct_value.lower()
+        if not is_extracted_content_type(ct_value, content_flags):
+            stats.count_skipped(ct_value)
+            continue
+
+        data = get_scanned_payload(xml_bytes, xml_view, part_value_spans)
+        if data is None:
+            return None
+        if mms_selected and (record_filter is None or record_filter.selects_payload(data)):
+            content_location = get_scanned_attribute(xml_bytes, part_value_spans, b'cl')
+            if content_location is None:
+                return None
+            records.append(AttachmentRecord(mms_date, mms_address, content_location, ct_value, data))
+        else:
+            stats.count("filtered_out")
+
+
+def scan_or_parse_mms_message(xml_bytes, xml_view: memoryview, mms_start: int, content_flags: tuple, stats: extraction_stats.ExtractionStats, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as scan_mms_message(), but messages the scan engine can't handle (malformed, or with comments, CDATA...) are
+    parsed by lxml instead, recovering from errors the same way the lxml engine does. Always returns
+    (the end of the message, its attachment records).
+    """
+    scanned_message = scan_mms_message(xml_bytes, xml_view, mms_start, content_flags, stats, record_filter)
+    if scanned_message is not None:
+        return scanned_message
+
+    stats.count("scan_fallbacks")
+    mms_end = xml_bytes.find(MMS_END_TAG, mms_start + len(MMS_START_TAG))
+    mms_end = len(xml_bytes) if mms_end == -1 else mms_end + len(MMS_END_TAG)
+    return mms_end, list(iter_attachment_records_from_regions([xml_bytes[mms_start:mms_end]], content_flags, stats,
+                                                              record_filter))
+
+
+def map_backup_file(file_path: str):
+    """
+    Memory-maps a (plain, non-empty) backup file read-only. The map isn't closed explicitly: attachment records hold
+    memoryviews of it that can outlive the parsing (e.g. in a decode pipeline), it is unmapped once they are all gone.
+    """
+    with open(file_path, 'rb') as xml_file:
+        return mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_attachment_records_scan(file_path: str, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, progress: progress_reporter.ProgressReporter = None, record_filter: record_filter_helper.RecordFilter = None, backup_index: backup_index_helper.BackupIndex = None):
+    """
+    Same as iter_attachment_records(), but with the scan engine: the file is memory-mapped, the <mms> and <part> start
+    tags are found with byte searches, and the attachments' base64 data is handed over as memoryviews of the file,
+    without ever being copied into a string. With a sidecar index, only the messages with attachments (selected by
+    record_filter) are scanned.
+
+    Compressed backup files can't be memory-mapped, they are parsed by lxml instead.
+    """
+    if stats is None:
+        stats = extraction_stats.ExtractionStats()
+
+    if not compressed_input.is_plain_file(file_path) or os.path.getsize(file_path) == 0:
+        yield from iter_attachment_records(file_path, content_flags, stats, progress, record_filter)
         return
 
+    xml_bytes = map_backup_file(file_path)
+    xml_view = memoryview(xml_bytes)
+    position = 0
+    if progress is not None:
+        progress.track(lambda: position)
+
+    if backup_index is not None:
+        mms_starts = (index_record[1] for index_record in backup_index.iter_records('mms', record_filter)
+                      if index_record[5] > 0)
+    else:
+        mms_starts = None
+
+    while True:
+        if mms_starts is not None:
+            mms_start = next(mms_starts, None)
+        else:
+            mms_match = SCAN_MMS_START_PATTERN.search(xml_bytes, position)
+            mms_start = None if mms_match is None else mms_match.start()
+
+        if mms_start is None:
+            return
+
+        position, records = scan_or_parse_mms_message(xml_bytes, xml_view, mms_start, content_flags, stats,
+                                                      record_filter)
+        yield from records
+
+
+def iter_attachment_records_from_archive(archive_path: str, content_flags: tuple, stats: extraction_stats.ExtractionStats = None, record_filter: record_filter_helper.RecordFilter = None):
+    """
+    Same as iter_attachment_records(), but reading the MMS parts out of a backup archive (see backup_archive), looking
+    them up by content type, and by the addresses, date range and size record_filter selects. Parts left out by the
+    filter are never read, so they aren't counted. Parts archived without their payload can't be extracted, they are
+    counted in stats.
+    """
+    extracted_content_types = []
+    for ct_value, num_parts in backup_archive.get_archived_part_content_types(archive_path).items():
+        if is_extracted_content_type(ct_value, content_flags):
+            extracted_content_types.append(ct_value)
+        elif stats is not None:
+            stats.count_skipped(ct_value, num_parts)
+
+    if record_filter is None:
+        record_filter = record_filter_helper.RecordFilter()
+
+    addresses = None
+    if record_filter.addresses is not None:
+        addresses = [address for address in backup_archive.get_archived_addresses(archive_path, "mms")
+                     if record_filter.selects_address(address)]
+
+    for date, address, cl, ct_value, data in backup_archive.iter_archived_parts(
+            archive_path, extracted_content_types, addresses, record_filter.since_ms, record_filter.until_ms,
+            record_filter.max_size):
+        if data is None:
+            if stats is not None:
+                stats.count("parts_without_data")
+            continue
+
+        # The archive only narrowed the parts down by their length, see iter_archived_parts()
+        if not record_filter.selects_payload(data):
+            if stats is not None:
+                stats.count("filtered_out")
+            continue
+
+        yield AttachmentRecord("" if date is None else str(date), address or "", cl or "", ct_value, data)
+
+
+class AttachmentWriter:
+    """
+    Decodes attachment records and writes them to the output directory, skipping duplicates (by content hash),
+    empty attachments, and attachments already handled by a previous run (found in known_parts, see
+    extraction_manifest). Attachments of the same message seen twice in one run (in overlapping backup files,
+    tracked in seen_parts) are counted as duplicates without being decoded again.
+    One writer can be shared by all the threads of a decode pipeline.
+
+    With a blob_link_mode (one of output_layout.BLOB_LINK_MODES), each unique attachment is written once into the
+    blob store, and every attachment, duplicates included, gets its usual filename as a link to its blob.
+    With an output_archive (see output_archive.OutputArchive), attachments are written as its entries instead, under
+    the names (and layout subdirectories) they would get in the output directory.
+
+    Each attachment is decoded once, in memory (see DECODE_SPOOL_MAX_BYTES), hashing it on the way, and only written
+    out if it isn't a duplicate. Time spent decoding, hashing and writing is added to stats.
+    """
+
+    def __init__(self, output_media_dir: str, unique_hashes: set = None, known_parts: dict = None, layout: str = output_layout.DEFAULT_OUTPUT_LAYOUT, blob_link_mode: str = None, seen_parts: set = None, stats: extraction_stats.ExtractionStats = None, output_archive: output_archive_helper.OutputArchive = None):
+        self.output_media_dir = output_media_dir
+        self.layout = layout
+        self.blob_link_mode = blob_link_mode
+        self.output_archive = output_archive
+        self.name_registry = output_layout.OutputNameRegistry(output_media_dir)
+        self.unique_hashes = set() if unique_hashes is None else unique_hashes
+        self.known_parts = dict() if known_parts is None else known_parts
+        self.seen_parts = set() if seen_parts is None else seen_parts
+        self.stats = extraction_stats.ExtractionStats() if stats is None else stats
+        self.lock = threading.Lock()
+
+        self.orig_files_count = 0
+        self.num_dup_files = 0
+        self.num_previously_extracted = 0
+        # (hash, path) of every file written, in the order they were written
+        self.written_files = []
+        # Manifest entries for every attachment handled, see extraction_manifest.append_manifest_entries()
+        self.manifest_entries = []
+
+    def get_output_name(self, record: AttachmentRecord, payload_hash: str) -> tuple:
+        """
+        Returns (layout subdirectory, filename) for an attachment, before any length limit or unique suffix
+        """
+        ct_subtype = record.ct.partition('/')[2]
+        content_location = record.cl
+
+        # Clean phone number
+        clean_phone = "".join(
+            c for c in record.address if c.isdigit()
+        )
+
+        # If empty, give it a name based on its content
+        if not content_location or content_location == 'null':
+            content_location = get_fallback_content_location(payload_hash, ct_subtype)
+
+        # Build base filename
+        base_name = (
+            get_datetime_from_epoch_milliseconds(record.date)
+            + f"_{clean_phone}_{content_location}"
+        )
+
+        # If there's no '.' in content_location, add the subtype as extension
+        if '.' not in content_location:
+            base_name += f".{ct_subtype}"
+
+        return output_layout.get_layout_subdir(self.layout, record.date, clean_phone, payload_hash), base_name
+
+    def write(self, record: AttachmentRecord) -> None:
+        manifest_key = extraction_manifest.get_manifest_key(record.date, record.address, record.cl, len(record.data))
+        self.stats.count("records")
+        self.stats.count_content_type(record.ct)
+
+        with self.lock:
+            if manifest_key in self.known_parts:
+                # Already extracted, no need to even decode it
+                self.num_previously_extracted += 1
+                return
+
+            if manifest_key in self.seen_parts:
+                self.orig_files_count += 1
+                self.num_dup_files += 1
+                return
+
+            self.seen_parts.add(manifest_key)
+
+        with tempfile.SpooledTemporaryFile(DECODE_SPOOL_MAX_BYTES) as payload_file:
+            try:
+                payload_hash, payload_size = decode_base64_to_file(record.data, payload_file, self.stats)
+            except Exception as e:
+                print(f"ERROR decoding attachment '{record.cl}': {e}")
+                with self.lock:
+                    self.seen_parts.discard(manifest_key)
+                return
+
+            self.write_payload(record, manifest_key, payload_file, payload_hash, payload_size)
+
+    def write_payload(self, record: AttachmentRecord, manifest_key: tuple, payload_file, payload_hash: str, payload_size: int) -> None:
+        """
+        Writes an attachment decoded into payload_file (see write()), unless it is a duplicate or empty
+        """
+        # Claim the hash before writing, so another thread can't write the same attachment in the meantime
+        with self.lock:
+            self.orig_files_count += 1
+
+            # Skip duplicates and empty attachments, nothing needs to be written for them
+            # (with a blob store, duplicates still get a link to the already written blob)
+            is_duplicate = payload_hash in self.unique_hashes
+            if payload_size == 0 or is_duplicate:
+                self.num_dup_files += 1
+                if payload_size == 0 or self.blob_link_mode is None:
+                    self.manifest_entries.append([*manifest_key, payload_hash, ""])
+                    return
+            else:
+                self.unique_hashes.add(payload_hash)
+
+        # An archive's entries are named relative to the archive
+        output_base_dir = self.output_media_dir if self.output_archive is None else ""
+        # Until its name is built, an attachment is reported by its content location
+        output_file_path = record.cl
+        try:
+            output_subdir, base_name = self.get_output_name(record, payload_hash)
+
+            # Now ensure it fits the filesystem limit
+            target_filename = safe_filename(os.path.join(output_base_dir, output_subdir), base_name)
+
+            # Write decoded data
+            output_file_path = os.path.join(output_base_dir, output_subdir, target_filename)
+            if self.output_archive is not None:
+                # Entries are written one at a time, so this waits for any other thread's entry to be written
+                with self.output_archive.open_entry(output_subdir, target_filename, payload_size,
+                                                    int(record.date) / 1000) as (output_file_path, entry_file):
+                    copy_decoded_payload(payload_file, entry_file, self.stats)
+            elif self.blob_link_mode is None:
+                # Messages with multiple attachments could have the same name, so this picks a unique one
+                with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                    output_file_path, out_f = self.name_registry.open_unique_file(output_subdir, target_filename)
+                try:
+                    copy_decoded_payload(payload_file, out_f, self.stats)
+                except BaseException:
+                    # Not left half-written
+                    out_f.close()
+                    os.remove(output_file_path)
+                    raise
+                with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                    out_f.close()
+                with self.lock:
+                    self.written_files.append((payload_hash, output_file_path))
+            else:
+                blob_path = output_layout.get_blob_path(self.output_media_dir, payload_hash)
+                # A known blob only gets a new link. Even a duplicate may have to store its blob though, if the
+                # original was extracted without a blob store.
+                is_blob_stored = False
+                if not os.path.exists(blob_path):
+                    with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                        blob_file = output_layout.create_blob_file(blob_path)
+                    try:
+                        copy_decoded_payload(payload_file, blob_file, self.stats)
+                        with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                            blob_file.close()
+                            is_blob_stored = output_layout.store_blob_file(blob_file, blob_path)
+                    except BaseException:
+                        blob_file.close()
+                        output_layout.discard_blob_file(blob_file)
+                        raise
+
+                if not is_blob_stored and not is_duplicate:
+                    # Stored by another worker process, or a previous run
+                    with self.lock:
+                        self.num_dup_files += 1
+                with self.stats.timed(extraction_stats.PHASE_FILE_WRITE):
+                    output_file_path = self.name_registry.link_unique_file(output_subdir, target_filename,
+                                                                           blob_path, self.blob_link_mode)
+
+            with self.lock:
+                self.manifest_entries.append([*manifest_key, payload_hash,
+                                              os.path.relpath(output_file_path, output_base_dir or os.curdir)])
+        except Exception as e:
+            print(f"ERROR writing file {output_file_path}: {e}")
+            with self.lock:
+                if not is_duplicate:
+                    self.unique_hashes.discard(payload_hash)
+                # Not in the manifest, so the next incremental run tries again
+                self.seen_parts.discard(manifest_key)
+
+
+def run_decode_pipeline(records, writer: AttachmentWriter, decode_threads: int) -> None:
+    """
+    Hands attachment records over to a pool of decode/write threads through a bounded queue, so decoding and
+    file I/O overlap with parsing, while only a few payloads are ever waiting in memory at once.
+
+    If writing a record raises, parsing stops, and the exception is raised again here once all threads are done, the
+    same as it would be without decode threads.
+    """
+    record_queue = queue.Queue(maxsize=decode_threads * PIPELINE_QUEUE_RECORDS_PER_THREAD)
+    # The exceptions raised by the decode threads, only the first one is raised again
+    errors = []
+
+    def decode_worker():
+        while True:
+            record = record_queue.get()
+            if record is None:
+                return
+            if errors:
+                # Keep emptying the queue, so the parsing thread can't block on it
+                continue
+            try:
+                writer.write(record)
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=decode_worker, daemon=True) for _ in range(decode_threads)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for record in records:
+            if errors:
+                break
+            record_queue.put(record)
+    finally:
+        # One stop marker per thread
+        for _ in workers:
+            record_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        raise errors[0]
+
+
+def iter_counted(records, progress: progress_reporter.ProgressReporter):
+    """
+    Passes through the attachment records, counting them towards the progress
+    """
+    for record in records:
+        progress.add_items()
+        yield record
+
+
+def extract_media_from_sms_file(file_path: str, output_media_dir: str, content_flags: tuple, unique_hashes: set = None, decode_threads: int = 0, fast_scan: bool = False, build_index: bool = False, known_parts: dict = None, incremental: bool = False, layout: str = output_layout.DEFAULT_OUTPUT_LAYOUT, blob_link_mode: str = None, seen_parts: set = None, progress: progress_reporter.ProgressReporter = None, from_archive: bool = False, record_filter: record_filter_helper.RecordFilter = None, engine: str = DEFAULT_PARSE_ENGINE, output_archive: output_archive_helper.OutputArchive = None) -> FileExtractionResult:
+    """
+    Extracts the media attachments out of a single sms*.xml backup file.
+
+    This runs either in the main process, or in a worker process when extracting with more than one job, so everything
+    it needs is passed in and everything it found is returned as a FileExtractionResult.
+
+    layout is one of output_layout.OUTPUT_LAYOUTS, see AttachmentWriter for blob_link_mode and output_archive (which
+    can only be used from the main process).
+
+    With incremental, attachments listed in the output directory's manifest are skipped. The manifest is loaded here
+    unless it is passed in as known_parts. seen_parts is shared between the files of a single process run.
+
+    With decode_threads > 0 the parsing, and the decoding/writing, of attachments run as separate pipeline stages.
+    Which copy of an attachment duplicated within the file is kept then depends on thread scheduling.
+
+    With fast_scan, only the <mms> messages are handed to the XML parser, see iter_mms_regions(). If the file has an
+    up-to-date sidecar index (built first, with build_index), only the messages with attachments are read at all.
+    engine is one of PARSE_ENGINES, the 'scan' engine (see iter_attachment_records_scan()) makes fast_scan redundant.
+    With from_archive, file_path is a backup archive (see backup_archive) rather than a backup file.
+
+    Only the attachments record_filter (if any) selects are extracted, it is applied before anything is decoded.
+
+    The file's own extraction_stats are returned (as a dict) in the result, for the caller to merge.
+
+    progress, if given, is told about the file and follows the position read in it. Only for use in the main process.
+    """
+    if incremental and known_parts is None:
+        known_parts = extraction_manifest.load_manifest(output_media_dir)
+        if unique_hashes is None:
+            unique_hashes = set(known_parts.values())
+
+    stats = extraction_stats.ExtractionStats()
+    writer = AttachmentWriter(output_media_dir, unique_hashes, known_parts, layout, blob_link_mode, seen_parts, stats,
+                              output_archive)
+
+    # Scanning the file for an index counts as parsing it
+    with stats.timed(extraction_stats.PHASE_XML_PARSE):
+        backup_index = None if from_archive else backup_index_helper.get_backup_index(file_path, build_index)
+
+    if from_archive:
+        records = iter_attachment_records_from_archive(file_path, content_flags, stats, record_filter)
+    elif engine == "scan":
+        records = iter_attachment_records_scan(file_path, content_flags, stats, progress, record_filter, backup_index)
+    elif backup_index is not None:
+        records = iter_attachment_records_indexed(file_path, content_flags, backup_index, stats, progress, record_filter)
+    elif fast_scan:
+        records = iter_attachment_records_fast_scan(file_path, content_flags, stats, progress, record_filter)
+    else:
+        records = iter_attachment_records(file_path, content_flags, stats, progress, record_filter)
+
+    records = stats.timed_iter(records, extraction_stats.PHASE_XML_PARSE)
+
+    file_size = compressed_input.get_input_size(file_path)
+    if progress is not None:
+        progress.start_file(file_path, file_size)
+        records = iter_counted(records, progress)
+
+    if decode_threads > 0:
+        run_decode_pipeline(records, writer, decode_threads)
+    else:
+        for record in records:
+            writer.write(record)
+
+    if progress is not None:
+        progress.finish_file(file_size)
+
+    return FileExtractionResult(writer.orig_files_count, writer.num_dup_files, writer.num_previously_extracted,
+                                writer.written_files, writer.manifest_entries, stats.to_dict())
+
+
+def remove_cross_file_duplicates(written_files: list, unique_hashes: set) -> set:
+    """
+    Worker processes only deduplicate against what they wrote themselves, so the same attachment can be
+    extracted once per backup file. This removes those copies, keeping the first one (in backup file order),
+    and returns the paths removed.
+    """
+    removed_paths = set()
+    for payload_hash, output_file_path in written_files:
+        if payload_hash in unique_hashes:
+            os.remove(output_file_path)
+            removed_paths.add(output_file_path)
+        else:
+            unique_hashes.add(payload_hash)
+
+    return removed_paths
+
+
+def report_file_result(progress: progress_reporter.ProgressReporter, file_size: int, future: concurrent.futures.Future) -> None:
+    """
+    Counts a backup file extracted by a worker process towards the progress
+    """
+    if not future.cancelled() and future.exception() is None:
+        file_result = future.result()
+        progress.add_items(file_result.orig_files_count + file_result.num_previously_extracted)
+    progress.finish_file(file_size)
+
+
+def reconstruct_mms_media(sms_xml_dir: str, output_media_dir: str, process_image: bool, process_video: bool, process_audio: bool, process_pdf: bool, jobs: int = 1, decode_threads: int = 0, fast_scan: bool = False, build_index: bool = False, incremental: bool = False, layout: str = output_layout.DEFAULT_OUTPUT_LAYOUT, blob_link_mode: str = None, stats: extraction_stats.ExtractionStats = None, show_progress: bool = False, from_archive: bool = False, record_filter: record_filter_helper.RecordFilter = None, engine: str = DEFAULT_PARSE_ENGINE, output_format: str = output_archive_helper.DEFAULT_OUTPUT_FORMAT) -> None:
+    """
+    Extracts the media attachments of all sms*.xml backup files in sms_xml_dir, or with from_archive, of the backup
+    archive in sms_xml_dir (see backup_archive), to output_media_dir. Only the attachments selected by record_filter,
+    if given, are extracted.
+
+    With an output_format other than 'dir' (see output_archive.OUTPUT_FORMATS), output_media_dir is the path of a
+    tar or zip file to create instead (or '-' for stdout), which gets all attachments as its entries. Everything is
+    then extracted in this process, without a manifest, so it can't be combined with jobs, incremental or
+    blob_link_mode.
+    """
+    output_archive = None
+    if output_archive_helper.is_archive_output(output_format):
+        if output_media_dir != output_archive_helper.STDOUT_PATH and os.path.exists(output_media_dir):
+            print(f"Error: OUTPUT_DIR already exists.")
+            return
+        output_archive = output_archive_helper.OutputArchive(output_media_dir, output_format)
+    elif not is_valid_output_directory(output_media_dir, incremental):
+        return
+
+    if stats is None:
+        stats = extraction_stats.ExtractionStats("sms")
+
     start_time = time.time()
     orig_files_count = 0
+    num_dup_files = 0
+    num_previously_extracted = 0
+
+    # Every run records what it extracted, so that a later incremental run can pick up where it left off
+    known_parts = extraction_manifest.load_manifest(output_media_dir) if incremental else dict()
+    previously_extracted_hashes = set(known_parts.values())
 
     contentMsg = (f"Processing messages ({', '.join([x for cond, x in [
         (process_image, 'images'),
@@ -78,130 +1009,108 @@ def reconstruct_mms_media(sms_xml_dir: str, output_media_dir: str, process_image
         (process_pdf, 'PDFs')
     ] if cond])})...")
 
-    print(contentMsg, end="", flush=True)
-    for filename in os.listdir(sms_xml_dir):
-        if filename.endswith(".xml") and filename.startswith("sms"):
-            file_path = os.path.join(sms_xml_dir, filename)
-
-            context = lxml.etree.iterparse(
-                file_path,
-                events=('end',),
-                huge_tree=True,
-                recover=True
-            )
-
-            for event, elem in context:
-                if elem.tag == 'part':
-                    # Get MIME descrete-type/sub-type
-                    ct_value = elem.get('ct', '').lower()
-                    ct_type, _, ct_subtype = ct_value.partition('/')
-
-                    if not (ct_type in CONTENT_TYPES):
-                        # not an image/video/audio/application file. Skip it
-                        continue
-
-                    if (ct_type == 'image' and (not process_image or ct_subtype not in IMAGE_SUBTYPES)):
-                        # skip this image file because we aren't extracting images, or it's an unsupported image subtype
-                        continue
-                    elif (ct_type == 'video' and (not process_video or ct_subtype not in VIDEO_SUBTYPES)):
-                        # skip this video file because we aren't extracting videos, or it's an unsupported video subtype
-                        continue 
-                    elif (ct_type == 'audio' and (not process_audio or ct_subtype not in AUDIO_SUBTYPES)):
-                        # skip this audio file because we aren't extracting audio, or it's an unsupported audio subtype
-                        continue
-                    elif (ct_type == 'application' and (not process_pdf or ct_subtype not in APPLICATION_SUBTYPES)):
-                        # skip this PDF file because we aren't extracting PDF, or it's an unsupported application subtype
-                        continue
+    # The progress line goes below this one
+    print(contentMsg, end="\n" if show_progress else "", flush=True)
 
-                    # if we get here, then we have a image/video/audio attachment to process
-                    parent_parts = elem.getparent()  # <parts>
-                    if parent_parts is not None:
-                        mms_node = parent_parts.getparent()  # <mms>
-                        if mms_node is not None:
-                            media_date_field = mms_node.get('date', '')
-                            media_sender_field = mms_node.get('address', '')
-
-                            data = elem.get('data', '')
-                            content_location = elem.get('cl', '')
-
-                            # Clean phone number
-                            clean_phone = "".join(
-                                c for c in media_sender_field if c.isdigit()
-                            )
-
-                            # If empty, give random name
-                            if not content_location or content_location == 'null':
-                                content_location = (
-                                    "".join(random.sample(string.ascii_letters, 10))
-                                    + f".{ct_subtype}"
-                                )
-
-                            # Build base filename
-                            base_name = (
-                                get_datetime_from_epoch_milliseconds(media_date_field)
-                                + f"_{clean_phone}_{content_location}"
-                            )
-
-                            # If there's no '.' in content_location, add the subtype as extension
-                            if '.' not in content_location:
-                                base_name += f".{ct_subtype}"
-
-                            # Now ensure it fits the filesystem limit
-                            target_filename = safe_filename(output_media_dir, base_name)
-
-                            # Messages with multiple attachments could have the same name.
-                            # Create a unique output_file_path using the target_filename
-                            output_file_path = handle_duplicate_name(output_media_dir, target_filename)
-
-                            # Write decoded data
-                            try:
-                                with open(output_file_path, 'wb') as out_f:
-                                    out_f.write(base64.b64decode(data))
-                                    orig_files_count += 1
-                            except Exception as e:
-                                print(f"ERROR writing file {output_file_path}: {e}")
-
-                # Free memory by clearing processed element
-                elem.clear()
-                # Option A: remove from parent
-                parent = elem.getparent()
-                if parent is not None:
-                    parent.remove(elem)
-
-            # Done parsing this file
-            del context
+    # Sorted, so that which copy of a duplicated attachment is kept doesn't depend on the directory listing order
+    sms_file_paths = []
+    for file_path in ([] if from_archive else compressed_input.list_input_files(sms_xml_dir)):
+        filename = compressed_input.get_backup_filename(file_path)
+        if backup_index_helper.is_index_file(filename):
+            continue
+        elif filename.endswith(".xml") and filename.startswith("sms"):
+            sms_file_paths.append(file_path)
         else:
             print(f"ERROR: {filename} does not match the specified pattern for SMS backup files")
 
-    print("complete.", flush=True)
-    # Remove duplicates after extraction
-    num_dup_files = remove_duplicate_files(output_media_dir)
-    end_time = time.time()
+    if from_archive:
+        sms_file_paths.append(backup_archive.get_archive_path(sms_xml_dir))
 
-    print(f"{orig_files_count} media files found in messages, "
-          f"{num_dup_files} duplicates(or empty files) removed. Time elapsed: "
-          f"{round(end_time - start_time, 2)} seconds")
+    content_flags = (process_image, process_video, process_audio, process_pdf)
+    input_bytes = sum(compressed_input.get_input_size(file_path) for file_path in sms_file_paths)
+    stats.count("files", len(sms_file_paths))
+    stats.count("input_bytes", input_bytes)
 
+    progress = progress_reporter.ProgressReporter(input_bytes, len(sms_file_paths), "attachments") if show_progress else None
 
-def remove_duplicate_files(output_media_dir: str) -> int:
-    duplicate_files_count = 0
-    unique_hashes = set()
-    
-    print("Removing duplicates...", end="", flush=True)
-    for filename in os.listdir(output_media_dir):
-        file_path = os.path.join(output_media_dir, filename)
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as f:
-                file_hash = hashlib.md5(f.read()).hexdigest()
-
-            if file_hash in unique_hashes or (os.path.getsize(file_path) == 0):
-                os.remove(file_path)
-                duplicate_files_count += 1
-            else:
-                unique_hashes.add(file_hash)
+    with (progress if progress is not None else contextlib.nullcontext()), \
+            (output_archive if output_archive is not None else contextlib.nullcontext()):
+        if jobs > 1 and len(sms_file_paths) > 1 and output_archive is None:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Start the biggest files first, so one large file doesn't end up running alone at the end
+                futures = {file_path: executor.submit(extract_media_from_sms_file, file_path, output_media_dir, content_flags,
+                                                      decode_threads=decode_threads, fast_scan=fast_scan,
+                                                      build_index=build_index, incremental=incremental,
+                                                      layout=layout, blob_link_mode=blob_link_mode,
+                                                      record_filter=record_filter, engine=engine)
+                           for file_path in sorted(sms_file_paths, key=compressed_input.get_input_size, reverse=True)}
+
+                if progress is not None:
+                    # Worker processes can't report their read position, so progress advances a whole file at a time
+                    for file_path, future in futures.items():
+                        future.add_done_callback(lambda future, file_size=compressed_input.get_input_size(file_path):
+                                                 report_file_result(progress, file_size, future))
+
+                file_results = [futures[file_path].result() for file_path in sms_file_paths]
         else:
-            print("ERROR: Subdirectory found in output directory")
-            sys.exit(1)
+            # A single process can share one set of hashes across all files, so cross-file duplicates are never written
+            extracted_hashes = set(previously_extracted_hashes)
+            seen_parts = set()
+            file_results = [extract_media_from_sms_file(file_path, output_media_dir, content_flags, unique_hashes=extracted_hashes,
+                                                        decode_threads=decode_threads, fast_scan=fast_scan,
+                                                        build_index=build_index, known_parts=known_parts,
+                                                        layout=layout, blob_link_mode=blob_link_mode,
+                                                        seen_parts=seen_parts, progress=progress,
+                                                        from_archive=from_archive, record_filter=record_filter,
+                                                        engine=engine, output_archive=output_archive)
+                            for file_path in sms_file_paths]
+
+    cleanup_start_time = time.perf_counter()
+    # Hashes of the attachments kept so far, so repeated (e.g. forwarded) media only ends up on disk once
+    unique_hashes = set(previously_extracted_hashes)
+    # Attachments kept so far, so a message that is in several (overlapping) backup files only gets one file
+    merged_parts = set()
+    for file_result in file_results:
+        stats.merge(file_result.stats)
+        orig_files_count += file_result.orig_files_count
+        num_previously_extracted += file_result.num_previously_extracted
+
+        removed_paths = remove_cross_file_duplicates(file_result.written_files, unique_hashes)
+        num_dup_files += file_result.num_dup_files + len(removed_paths)
+
+        for manifest_entry in file_result.manifest_entries:
+            manifest_key = tuple(manifest_entry[:-2])
+            if manifest_entry[-1]:
+                output_file_path = os.path.join(output_media_dir, manifest_entry[-1])
+                if manifest_key in merged_parts and output_file_path not in removed_paths:
+                    # Only happens with a blob store, where the copies are links to the same blob
+                    os.remove(output_file_path)
+                    removed_paths.add(output_file_path)
+
+                if output_file_path in removed_paths:
+                    manifest_entry[-1] = ""
+
+            merged_parts.add(manifest_key)
+        if output_archive is None:
+            extraction_manifest.append_manifest_entries(output_media_dir, file_result.manifest_entries)
+
+    stats.add_time(extraction_stats.PHASE_CLEANUP, time.perf_counter() - cleanup_start_time)
+    stats.count("attachments_found", orig_files_count)
+    stats.count("duplicates", num_dup_files)
+    stats.count("attachments_written", orig_files_count - num_dup_files)
+    stats.count("previously_extracted", num_previously_extracted)
 
     print("complete.", flush=True)
-    return duplicate_files_count
+    end_time = time.time()
+
+    print(f"{orig_files_count} media files found in messages, "
+          f"{num_dup_files} duplicates(or empty files) "
+          + ("not stored again" if blob_link_mode else "removed")
+          + (f", {num_previously_extracted} already extracted by a previous run" if incremental else "")
+          + (f", {stats.counters['filtered_out']} left out by the filters" if stats.counters["filtered_out"] else "")
+          + f". Time elapsed: {round(end_time - start_time, 2)} seconds")
+
+    if stats.counters["parts_without_data"]:
+        print(f"WARNING: {stats.counters['parts_without_data']} attachments were archived without their data, "
+              f"archive the backups with --archive-part-data to extract them")
+
@@ -0,0 +1,146 @@
+import contextlib
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+
+# Where extracted media goes: files in the output directory, or entries of a single tar or zip file
+OUTPUT_FORMATS = ["dir", "tar", "zip"]
+DEFAULT_OUTPUT_FORMAT = "dir"
+# Writes the tar or zip file to stdout instead, e.g. to pipe it into another program
+STDOUT_PATH = "-"
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# A tar file ends with two empty blocks, and is padded to a whole number of records
+TAR_END_OF_ARCHIVE = b"\0" * (2 * TAR_BLOCK_SIZE)
+TAR_RECORD_SIZE = tarfile.RECORDSIZE
+
+
+def is_archive_output(output_format: str) -> bool:
+    return output_format != "dir"
+
+
+def open_output_stream(output_path: str):
+    """
+    Opens the file the archive is written to, for (binary) writing. Refuses to overwrite an existing file.
+    """
+    if output_path == STDOUT_PATH:
+        # A duplicate of the stdout file descriptor, so the archive can't get mixed up with anything printed
+        return os.fdopen(os.dup(1), 'wb')
+
+    return open(output_path, 'xb')
+
+
+class TarEntryFile:
+    """
+    The data of one tar entry, written straight into the tar stream. The size is in the entry's header, which has
+    been written already, so exactly that many bytes have to be written.
+    """
+
+    def __init__(self, output_stream, size: int):
+        self.output_stream = output_stream
+        self.size = size
+        self.num_bytes = 0
+
+    def write(self, data) -> int:
+        self.output_stream.write(data)
+        self.num_bytes += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.num_bytes != self.size:
+            raise Exception(f"Wrote {self.num_bytes} bytes for a tar entry of {self.size} bytes")
+
+        # Entries start on a block boundary
+        self.output_stream.write(b"\0" * (-self.size % TAR_BLOCK_SIZE))
+
+
+class OutputArchive:
+    """
+    Writes extracted media as the entries of a single tar or zip file (output_format, see OUTPUT_FORMATS), created at
+    output_path, or written to stdout. Everything goes out as one sequential stream: no file is created per
+    attachment, and picking a unique name for an entry is a set lookup.
+
+    Entries are written one at a time, the threads of a decode pipeline take turns (see open_entry()).
+    Attachments are already compressed (images, videos...), so zip entries are stored as is.
+    """
+
+    def __init__(self, output_path: str, output_format: str):
+        self.output_format = output_format
+        self.output_stream = open_output_stream(output_path)
+        self.zip_file = zipfile.ZipFile(self.output_stream, 'w') if output_format == "zip" else None
+        self.tar_offset = 0
+        self.entry_names = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def claim(self, subdir: str, filename: str) -> str:
+        """
+        Returns an entry name in subdir that isn't taken yet, adding a "-<n>" suffix to filename if needed, the same
+        way output_layout.OutputNameRegistry does
+        """
+        filename_base, filename_ext = os.path.splitext(filename)
+        subdir = subdir.replace(os.sep, "/")
+
+        entry_name = posixpath.join(subdir, filename)
+        i = 0
+        while entry_name in self.entry_names:
+            i += 1
+            entry_name = posixpath.join(subdir, f"{filename_base}-{i}{filename_ext}")
+
+        self.entry_names.add(entry_name)
+        return entry_name
+
+    @contextlib.contextmanager
+    def open_entry(self, subdir: str, filename: str, size: int, mtime: float):
+        """
+        Adds an entry of size bytes (which have to be known up front, for tar), yielding (its name, a file to write
+        its data to). No other entry can be added until the data is written.
+        """
+        with self.lock:
+            entry_name = self.claim(subdir, filename)
+
+            if self.zip_file is not None:
+                zip_info = zipfile.ZipInfo(entry_name, get_zip_date_time(mtime))
+                zip_info.file_size = size
+                zip_info.compress_type = zipfile.ZIP_STORED
+                with self.zip_file.open(zip_info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as entry_file:
+                    yield entry_name, entry_file
+                return
+
+            tar_info = tarfile.TarInfo(entry_name)
+            tar_info.size = size
+            tar_info.mtime = int(mtime)
+            tar_info.mode = 0o644
+            tar_header = tar_info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            self.output_stream.write(tar_header)
+
+            entry_file = TarEntryFile(self.output_stream, size)
+            yield entry_name, entry_file
+            entry_file.close()
+            self.tar_offset += len(tar_header) + size + (-size % TAR_BLOCK_SIZE)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.zip_file is not None:
+                self.zip_file.close()
+            else:
+                self.output_stream.write(TAR_END_OF_ARCHIVE)
+                self.tar_offset += len(TAR_END_OF_ARCHIVE)
+                self.output_stream.write(b"\0" * (-self.tar_offset % TAR_RECORD_SIZE))
+            self.output_stream.close()
+
+
+def get_zip_date_time(mtime: float) -> tuple:
+    """
+    Zip timestamps are local dates and times, and can't go back further than 1980
+    """
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
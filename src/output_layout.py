@@ -0,0 +1,143 @@
+import datetime
+import os
+import tempfile
+import threading
+
+# How extracted media is spread over subdirectories of the output directory
+OUTPUT_LAYOUTS = ["flat", "year-month", "sender", "hash-prefix"]
+DEFAULT_OUTPUT_LAYOUT = "flat"
+
+# With a blob store, every unique attachment is stored once under its content hash in this subdirectory, and the
+# human-readable names are links to it
+BLOB_STORE_DIR = ".blobs"
+BLOB_LINK_MODES = ["hardlink", "symlink"]
+
+# Subdirectory for media whose message has no usable sender/recipient
+UNKNOWN_SENDER_DIR = "unknown"
+# Number of hex digits of the content hash used as the subdirectory name, 256 subdirectories for 2 digits
+HASH_PREFIX_LENGTH = 2
+# Blobs are written under a temporary name ending with this, next to where they go, until they are complete
+TEMP_BLOB_SUFFIX = ".tmp"
+
+
+def get_layout_subdir(layout: str, date: str, clean_phone: str, payload_hash: str) -> str:
+    """
+    Returns the subdirectory (relative to the output directory) an attachment goes into
+    """
+    if layout == "year-month":
+        message_datetime = datetime.datetime.fromtimestamp(int(date) / 1000)
+        return os.path.join(f"{message_datetime.year:04d}", f"{message_datetime.month:02d}")
+
+    elif layout == "sender":
+        return clean_phone or UNKNOWN_SENDER_DIR
+
+    elif layout == "hash-prefix":
+        return payload_hash[:HASH_PREFIX_LENGTH]
+
+    return ""
+
+
+def get_blob_path(output_media_dir: str, payload_hash: str) -> str:
+    return os.path.join(output_media_dir, BLOB_STORE_DIR, payload_hash[:HASH_PREFIX_LENGTH], payload_hash)
+
+
+def create_blob_file(blob_path: str):
+    """
+    Creates a temporary file for the blob of an attachment, returning it open for (binary) writing. Once written and
+    closed, it is put in place with store_blob_file(), or removed with discard_blob_file() if writing it failed, so
+    a blob that other attachments link to is always complete.
+    """
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    return tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(blob_path), prefix=os.path.basename(blob_path) + ".",
+                                       suffix=TEMP_BLOB_SUFFIX, delete=False)
+
+
+def store_blob_file(blob_file, blob_path: str) -> bool:
+    """
+    Puts a blob file written in full (see create_blob_file()) in place, as blob_path. Returns False if the blob
+    already exists, i.e. it was stored by a previous run or another process, the one already in place is kept then.
+    """
+    try:
+        # Unlike a rename, a link never replaces a blob other files may already be linked to
+        os.link(blob_file.name, blob_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(blob_file.name)
+
+
+def discard_blob_file(blob_file) -> None:
+    try:
+        os.remove(blob_file.name)
+    except OSError:
+        pass
+
+
+class OutputNameRegistry:
+    """
+    Keeps track of the filenames in use in each output (sub)directory, so picking a unique name for a new file is a
+    set lookup instead of probing the filesystem. A directory is listed once, when it is first used, to pick up
+    files left by previous runs.
+
+    Other processes may be writing to the same directories, so a claimed name is only a candidate: the file still
+    gets created exclusively, see open_unique_file().
+    """
+
+    def __init__(self, output_media_dir: str):
+        self.output_media_dir = output_media_dir
+        self.names_by_dir = dict()
+        self.lock = threading.Lock()
+
+    def get_dir_names(self, subdir: str) -> set:
+        if subdir not in self.names_by_dir:
+            full_dir = os.path.join(self.output_media_dir, subdir)
+            os.makedirs(full_dir, exist_ok=True)
+            self.names_by_dir[subdir] = set(os.listdir(full_dir))
+
+        return self.names_by_dir[subdir]
+
+    def claim(self, subdir: str, filename: str) -> str:
+        """
+        Returns the path of a name in subdir that isn't taken yet, adding a "-<n>" suffix to filename if needed
+        """
+        filename_base, filename_ext = os.path.splitext(filename)
+
+        with self.lock:
+            dir_names = self.get_dir_names(subdir)
+            unique_filename = filename
+            i = 0
+            while unique_filename in dir_names:
+                i += 1
+                unique_filename = f"{filename_base}-{i}{filename_ext}"
+
+            dir_names.add(unique_filename)
+
+        return os.path.join(self.output_media_dir, subdir, unique_filename)
+
+    def open_unique_file(self, subdir: str, filename: str) -> tuple:
+        """
+        Claims a name and creates the file, returning (path, open binary file)
+        """
+        while True:
+            output_file_path = self.claim(subdir, filename)
+            try:
+                return output_file_path, open(output_file_path, 'xb')
+            except FileExistsError:
+                # Created by another process since the directory was listed, the name stays claimed so try the next one
+                continue
+
+    def link_unique_file(self, subdir: str, filename: str, blob_path: str, link_mode: str) -> str:
+        """
+        Claims a name and creates it as a hard link, or a (relative) symbolic link, to blob_path. Returns the link's path.
+        """
+        while True:
+            output_file_path = self.claim(subdir, filename)
+            try:
+                if link_mode == "symlink":
+                    os.symlink(os.path.relpath(blob_path, os.path.dirname(output_file_path)), output_file_path)
+                else:
+                    os.link(blob_path, output_file_path)
+                return output_file_path
+            except FileExistsError:
+                continue
@@ -0,0 +1,137 @@
+import datetime
+import os
+import sys
+import threading
+import time
+
+# How often the progress line is refreshed on a terminal, and how often a progress line is logged otherwise
+PROGRESS_INTERVAL_SECONDS = 0.5
+PROGRESS_LOG_INTERVAL_SECONDS = 10
+
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+    return f"{num_bytes:.1f} GB"
+
+
+class ProgressReporter:
+    """
+    Reports the progress of an extraction on stderr, based on how far into each input file the reader is.
+
+    The extraction loop itself only hands over a position source (see track()) and bumps a counter, a background
+    thread does all the formatting and printing at a throttled rate, so reporting costs next to nothing per record.
+
+    Use it as a context manager:
+
+        with ProgressReporter(total_bytes, num_files, "attachments") as progress:
+            progress.start_file(file_path, file_size)
+            progress.track(xml_file.tell)
+            ...
+            progress.add_items(1)
+            ...
+            progress.finish_file(file_size)
+    """
+
+    def __init__(self, total_bytes: int, num_files: int, item_name: str, stream=None):
+        self.total_bytes = total_bytes
+        self.num_files = num_files
+        self.item_name = item_name
+        self.stream = sys.stderr if stream is None else stream
+        self.is_terminal = self.stream.isatty()
+        self.interval = PROGRESS_INTERVAL_SECONDS if self.is_terminal else PROGRESS_LOG_INTERVAL_SECONDS
+
+        self.num_items = 0
+        # Bytes of the files already finished
+        self.done_bytes = 0
+        self.file_number = 0
+        self.file_name = None
+        self.file_size = 0
+        # Callable returning the current byte position in the file being read, None while no file is tracked
+        self.position_source = None
+
+        self.start_time = None
+        self.last_line_len = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+        self.print_progress(final=True)
+        return False
+
+    def start_file(self, file_path: str, file_size: int) -> None:
+        self.file_number += 1
+        self.file_name = os.path.basename(file_path)
+        self.file_size = file_size
+        self.position_source = None
+
+    def track(self, position_source) -> None:
+        """
+        position_source is called (from the reporting thread) for the byte position reached in the current file,
+        e.g. the tell() method of the open input file
+        """
+        self.position_source = position_source
+
+    def add_items(self, num_items: int = 1) -> None:
+        self.num_items += num_items
+
+    def finish_file(self, file_size: int) -> None:
+        self.position_source = None
+        self.file_name = None
+        self.done_bytes += file_size
+
+    def get_file_position(self) -> int:
+        position_source = self.position_source
+        if position_source is None:
+            return 0
+
+        try:
+            return min(position_source(), self.file_size)
+        except (ValueError, OSError):
+            # The file was closed in the meantime
+            return 0
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.print_progress()
+
+    def print_progress(self, final: bool = False) -> None:
+        elapsed_s = max(time.monotonic() - self.start_time, 1e-9)
+        file_position = 0 if final else self.get_file_position()
+        processed_bytes = self.done_bytes + file_position
+        bytes_per_s = processed_bytes / elapsed_s
+
+        parts = []
+        if self.file_name is not None and not final:
+            file_percent = 100 * file_position / self.file_size if self.file_size else 100
+            parts.append(f"[{self.file_number}/{self.num_files}] {self.file_name} {file_percent:5.1f}%")
+
+        total_percent = 100 * processed_bytes / self.total_bytes if self.total_bytes else 100
+        parts.append(f"total {total_percent:5.1f}% of {format_bytes(self.total_bytes)}")
+        parts.append(f"{format_bytes(bytes_per_s)}/s")
+        parts.append(f"{self.num_items} {self.item_name}")
+
+        if final:
+            parts.append(f"done in {datetime.timedelta(seconds=int(elapsed_s))}")
+        elif bytes_per_s > 0:
+            eta_s = (self.total_bytes - processed_bytes) / bytes_per_s
+            parts.append(f"ETA {datetime.timedelta(seconds=int(eta_s))}")
+
+        line = " | ".join(parts)
+        if self.is_terminal:
+            # Overwrite the previous line, padding over whatever is left of it
+            self.stream.write("\r" + line.ljust(self.last_line_len) + ("\n" if final else ""))
+            self.last_line_len = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
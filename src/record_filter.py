@@ -0,0 +1,158 @@
+import datetime
+import re
+
+# Phone numbers are compared on their digits, and a number matches another that ends with it (e.g. "8183457890"
+# matches "+1 (818) 345-7890"), as long as it has at least this many digits. Shorter ones (short codes) must match
+# exactly.
+MIN_SUFFIX_MATCH_DIGITS = 7
+
+# The recipients of a group MMS are separated by "~" in its address attribute
+ADDRESS_SEPARATOR = "~"
+
+SIZE_PATTERN = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# base64 data ends with up to 2 "=" of padding, and can be wrapped into lines of at least 64 characters (PEM, MIME
+# uses 76), each followed by a line break of up to 2 characters (CRLF)
+MAX_BASE64_PADDING = 2
+MIN_BASE64_LINE_LENGTH = 64
+MAX_LINE_BREAK_LENGTH = 2
+BASE64_WHITESPACE = " \t\r\n"
+
+
+def parse_date(date_text: str) -> int:
+    """
+    Converts a local date (YYYY-MM-DD), or date and time (YYYY-MM-DD HH:MM[:SS]), into epoch milliseconds
+    """
+    return int(datetime.datetime.fromisoformat(date_text).timestamp() * 1000)
+
+
+def parse_size(size_text: str) -> int:
+    """
+    Converts a size in bytes, optionally with a K, M or G (binary) unit, e.g. "500K" or "2.5M", into bytes
+    """
+    size_match = SIZE_PATTERN.fullmatch(size_text)
+    if size_match is None:
+        raise ValueError(f"Not a size: {size_text}")
+
+    return int(float(size_match.group(1)) * SIZE_UNITS[size_match.group(2).upper()])
+
+
+def normalize_address(address: str) -> str:
+    """
+    The digits of a phone number, or the whole (lowercase) address if it has none, e.g. an e-mail address
+    """
+    digits = "".join(char for char in address if char.isdigit())
+    return digits if digits else address.strip().lower()
+
+
+def is_same_address(address: str, other_address: str) -> bool:
+    """
+    Compares two normalized addresses, allowing for one of them to lack the country code or trunk prefix
+    """
+    if address == other_address:
+        return True
+
+    shorter_address, longer_address = sorted((address, other_address), key=len)
+    return (shorter_address.isdigit() and len(shorter_address) >= MIN_SUFFIX_MATCH_DIGITS
+            and longer_address.endswith(shorter_address))
+
+
+def get_max_decoded_size(encoded_length: int) -> int:
+    """
+    The most bytes a base64 payload of encoded_length characters can decode to, i.e. without padding or line breaks
+    """
+    return encoded_length * 3 // 4
+
+
+def get_min_decoded_size(encoded_length: int) -> int:
+    """
+    The fewest bytes a base64 payload of encoded_length characters can decode to, with full padding, and wrapped into
+    the shortest lines it usually gets
+    """
+    data_length = encoded_length * MIN_BASE64_LINE_LENGTH // (MIN_BASE64_LINE_LENGTH + MAX_LINE_BREAK_LENGTH)
+    return max(data_length * 3 // 4 - MAX_BASE64_PADDING, 0)
+
+
+def get_decoded_size(data) -> int:
+    """
+    The exact number of bytes base64 data (a string, or bytes-like) decodes to, not counting its padding and
+    whitespace
+    """
+    if not isinstance(data, str):
+        data = bytes(data).decode("ascii", "replace")
+
+    data = data.rstrip(BASE64_WHITESPACE)
+    padding = len(data) - len(data.rstrip("="))
+    data_length = len(data) - sum(data.count(whitespace) for whitespace in BASE64_WHITESPACE)
+    return data_length * 3 // 4 - padding
+
+
+class RecordFilter:
+    """
+    Selects messages and calls by date (since_ms inclusive, until_ms exclusive, both epoch milliseconds) and by
+    address (any of addresses, see is_same_address()), and attachments by their size (at most max_size bytes).
+    Criteria left as None select everything.
+
+    The checks only need a record's attributes, and an attachment's encoded length, so they run while parsing,
+    before anything is decoded.
+    """
+
+    def __init__(self, since_ms: int = None, until_ms: int = None, addresses: list = None, max_size: int = None):
+        self.since_ms = since_ms
+        self.until_ms = until_ms
+        self.addresses = None if not addresses else [normalize_address(address) for address in addresses]
+        self.max_size = max_size
+        # {address attribute: whether it is selected}, the same few addresses come up over and over
+        self.address_matches = dict()
+
+    def is_selecting_everything(self) -> bool:
+        return self.since_ms is None and self.until_ms is None and self.addresses is None and self.max_size is None
+
+    def selects_date(self, date) -> bool:
+        """
+        date is in epoch milliseconds, as an int or as the string of a date attribute
+        """
+        if self.since_ms is None and self.until_ms is None:
+            return True
+
+        try:
+            date = int(date)
+        except (TypeError, ValueError):
+            return False
+
+        return ((self.since_ms is None or date >= self.since_ms)
+                and (self.until_ms is None or date < self.until_ms))
+
+    def selects_address(self, address: str) -> bool:
+        if self.addresses is None:
+            return True
+
+        if address not in self.address_matches:
+            self.address_matches[address] = any(
+                is_same_address(normalize_address(record_address), filter_address)
+                for record_address in (address or "").split(ADDRESS_SEPARATOR)
+                for filter_address in self.addresses)
+
+        return self.address_matches[address]
+
+    def selects_record(self, date, address: str) -> bool:
+        return self.selects_date(date) and self.selects_address(address)
+
+    def selects_payload_length(self, encoded_length: int) -> bool:
+        """
+        Whether a payload of encoded_length characters can be selected at all, see selects_payload()
+        """
+        return self.max_size is None or get_min_decoded_size(encoded_length) <= self.max_size
+
+    def selects_payload(self, data) -> bool:
+        """
+        Whether the base64 data of an attachment decodes to at most max_size bytes. Its length alone settles it,
+        unless it is too close to max_size to tell (by its padding and line breaks), then its characters are counted.
+        """
+        if self.max_size is None or get_max_decoded_size(len(data)) <= self.max_size:
+            return True
+        if not self.selects_payload_length(len(data)):
+            return False
+
+        return get_decoded_size(data) <= self.max_size
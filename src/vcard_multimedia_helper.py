@@ -8,12 +8,15 @@ MULTIMEDIA_TAG_TAG_DATA_KEY = "tag_data"
 MULTIMEDIA_TAG_TAG_URL_KEY = "tag_url"
 MULTIMEDIA_TAG_TAG_MIME_TYPE_KEY = "tag_mime_type"
 
+# Key names that might have multi-line content
+ADVANCED_KEY_NAMES = ("KEY", "LOGO", "PHOTO", "SOUND")
 
-def get_advanced_key_names() -> typing.List:
+
+def get_advanced_key_names() -> typing.Tuple:
     """
-    Key names that might have multi-line content.
+    Key names that might have multi-line content, see ADVANCED_KEY_NAMES
     """
-    return ["KEY", "LOGO", "PHOTO", "SOUND"]
+    return ADVANCED_KEY_NAMES
 
 
 def get_multimedia_tag_list() -> typing.List:
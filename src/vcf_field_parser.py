@@ -1,3 +1,4 @@
+import re
 import typing
 
 # locals
@@ -7,6 +8,9 @@ TAG_FIELD_SEPARATOR = ";"
 KEY_VALUE_SEPARATOR = ":"
 TYPE_ASSIGNMENT_OR_LABEL_SEPARATOR = "="
 
+# A property's name is everything before its first parameter (";") or its value (":")
+PROPERTY_NAME_PATTERN = re.compile(r"[^;:]*")
+
 # These are properties that are declared with just a simple key-value pair, and no additional processing, like so:
 # ANNIVERSARY:19901021
 # FN:Dr. John Doe
@@ -282,3 +286,37 @@ def helper_match_generic_label_and_types(text_line) -> dict:
         data_type = text_line_split[0].split(";")[1]
 
     return dict({data_type: data})
+
+
+def get_property_name(file_line) -> str:
+    """
+    The (uppercase) name of the property on a line, e.g. "TEL" for "TEL;TYPE=cell:(123) 555-5832"
+    """
+    return PROPERTY_NAME_PATTERN.match(file_line).group().upper()
+
+
+def parse_multimedia_property(multimedia_line) -> tuple:
+    """
+    Same as parse_multimedia_tag(), for the whole line, property name included
+    """
+    return parse_multimedia_tag(multimedia_line[PROPERTY_NAME_PATTERN.match(multimedia_line).end():])
+
+
+# {property name: function parsing the whole line of that property}, see get_property_name()
+PROPERTY_PARSERS = {
+    **{simple_key: parse_simple_tag for simple_key in SIMPLE_KEYS},
+    "ADR": parse_address_tag,
+    "CATEGORIES": parse_categories_tag,
+    "CLIENTPIDMAP": parse_clientpidmap_tag,
+    "EMAIL": parse_email_tag,
+    "GEO": parse_geo_tag,
+    "IMPP": parse_instant_messenger_handle_tag,
+    "LABEL": parse_mailing_label_tag,
+    "MEMBER": parse_member_tag,
+    "N": parse_name_tag,
+    "ORG": parse_organization_tag,
+    "RELATED": parse_related_tag,
+    "TEL": parse_telephone_tag,
+    "UID": parse_uuid_tag,
+    **{advanced_key: parse_multimedia_property for advanced_key in vcard_multimedia_helper.ADVANCED_KEY_NAMES},
+}
@@ -0,0 +1,53 @@
+import base64
+import io
+import os
+import tempfile
+import unittest
+
+# locals
+from src import contacts_vcard_extractor
+
+PHOTO_BYTES = bytes(range(256)) * 4
+
+
+def get_folded_vcf() -> str:
+    """
+    Three contacts, with a folded NOTE, a v4.0 PHOTO folded over several lines, and a v2.1 PHOTO whose base64 data goes
+    on over lines that aren't folded, up to an empty line
+    """
+    photo_data = base64.b64encode(PHOTO_BYTES).decode("ascii")
+    folded_photo = "\r\n ".join(photo_data[i:i + 74] for i in range(0, len(photo_data), 74))
+    unfolded_photo = "\r\n".join(photo_data[i:i + 76] for i in range(0, len(photo_data), 76))
+
+    return ("BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Jane Doe\r\nNOTE:A note folded\r\n  over two lines\r\nEND:VCARD\r\n"
+            f"BEGIN:VCARD\r\nVERSION:4.0\r\nFN:John Doe\r\nPHOTO;TYPE=JPEG;ENCODING=b:{folded_photo}\r\nEND:VCARD\r\n"
+            f"BEGIN:VCARD\r\nVERSION:2.1\r\nFN:Old Phone\r\nPHOTO;ENCODING=BASE64;GIF:{unfolded_photo}\r\n\r\n"
+            "END:VCARD\r\n")
+
+
+class StreamingReaderTest(unittest.TestCase):
+
+    def test_iter_vcards(self):
+        vcards = list(contacts_vcard_extractor.iter_vcards(io.StringIO(get_folded_vcf(), newline="")))
+
+        self.assertEqual(len(vcards), 3)
+        self.assertEqual(vcards[0], ["VERSION:4.0", "FN:Jane Doe", "NOTE:A note folded over two lines"])
+        for vcard_lines in vcards[1:]:
+            self.assertEqual(len(vcard_lines), 3)
+            self.assertEqual(base64.b64decode(vcard_lines[2].partition(":")[2]), PHOTO_BYTES)
+
+    def test_parse_contacts_from_vcf_files(self):
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            with open(os.path.join(input_dir, "contacts.vcf"), 'w', newline="") as vcf_file:
+                vcf_file.write(get_folded_vcf())
+
+            contacts_vcard_extractor.parse_contacts_from_vcf_files(input_dir, output_dir)
+
+            self.assertEqual(sorted(os.listdir(output_dir)), ["John Doe.JPEG", "Old Phone.GIF"])
+            for filename in os.listdir(output_dir):
+                with open(os.path.join(output_dir, filename), 'rb') as media_file:
+                    self.assertEqual(media_file.read(), PHOTO_BYTES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import base64
+import os
+import tempfile
+import unittest
+
+# locals
+from src import mms_media_extractor
+
+CONTENT_FLAGS = (True, True, True, True)
+
+# Content locations the scan engine has to read exactly as lxml does
+CONTENT_LOCATIONS = [
+    "a&amp;b&#128;.jpg",  # a numeric reference in the 0x80-0x9F range is U+0080, not the "€" of HTML
+    "&#x9F;&#65;&lt;&gt;&quot;&apos;.jpg",
+    "&nbsp;x.jpg",  # HTML only, left to lxml
+    "&copy.jpg",  # no ';', left to lxml
+    "tab\tand\r\nline break.jpg",
+]
+
+
+def write_backup_file(file_path: str) -> None:
+    data = base64.b64encode(b"attachment").decode("ascii")
+    with open(file_path, 'w', encoding='utf-8', newline='') as backup_file:
+        backup_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<smses count="1">\n')
+        for i, content_location in enumerate(CONTENT_LOCATIONS):
+            backup_file.write(f'<mms date="{1600000000000 + i}" address="+1 555 0100">\n<parts>\n'
+                              f'<part seq="0" ct="image/jpeg" cl="{content_location}" data="{data}" />\n'
+                              '</parts>\n</mms>\n')
+        backup_file.write('</smses>\n')
+
+
+class ScanEngineTest(unittest.TestCase):
+
+    def test_attributes_read_like_lxml(self):
+        with tempfile.TemporaryDirectory() as input_dir:
+            file_path = os.path.join(input_dir, "sms-1.xml")
+            write_backup_file(file_path)
+
+            lxml_records = list(mms_media_extractor.iter_attachment_records(file_path, CONTENT_FLAGS))
+            scan_records = list(mms_media_extractor.iter_attachment_records_scan(file_path, CONTENT_FLAGS))
+
+        self.assertEqual(len(lxml_records), len(CONTENT_LOCATIONS))
+        self.assertEqual(lxml_records[0].cl, "a&b\x80.jpg")
+        self.assertEqual([record[:4] for record in scan_records], [record[:4] for record in lxml_records])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import base64
+import unittest
+
+# locals
+from src import record_filter
+
+
+def encode_wrapped(payload: bytes, line_length: int = 76, line_break: str = "\r\n") -> str:
+    encoded = base64.b64encode(payload).decode("ascii")
+    return line_break.join(encoded[i:i + line_length] for i in range(0, len(encoded), line_length)) + line_break
+
+
+class MaxSizeTest(unittest.TestCase):
+    """
+    --max-size 1K has to keep an attachment of exactly 1024 bytes, whatever its padding and line breaks
+    """
+
+    def setUp(self):
+        self.record_filter = record_filter.RecordFilter(max_size=record_filter.parse_size("1K"))
+
+    def test_padded_payload_at_limit(self):
+        data = base64.b64encode(b"x" * 1024).decode("ascii")
+        self.assertTrue(data.endswith("=="))
+        self.assertEqual(record_filter.get_decoded_size(data), 1024)
+        self.assertTrue(self.record_filter.selects_payload(data))
+
+    def test_wrapped_payload_at_limit(self):
+        for line_length in (64, 76):
+            data = encode_wrapped(b"x" * 1024, line_length)
+            self.assertEqual(record_filter.get_decoded_size(data), 1024)
+            self.assertTrue(self.record_filter.selects_payload(data))
+            self.assertTrue(self.record_filter.selects_payload(memoryview(data.encode("ascii"))))
+            self.assertTrue(self.record_filter.selects_payload_length(len(data)))
+
+    def test_payload_over_limit(self):
+        for data in (base64.b64encode(b"x" * 1025).decode("ascii"), encode_wrapped(b"x" * 1025)):
+            self.assertEqual(record_filter.get_decoded_size(data), 1025)
+            self.assertFalse(self.record_filter.selects_payload(data))
+
+    def test_no_max_size(self):
+        self.assertTrue(record_filter.RecordFilter().selects_payload(encode_wrapped(b"x" * 4096)))
+
+
+if __name__ == "__main__":
+    unittest.main()